@@ -1,9 +1,7 @@
 import logging
 import os
-from datetime import date
 
 from flask import Flask
-from flask.json import JSONEncoder
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -11,6 +9,7 @@ from flask_migrate import Migrate
 
 from app.core.cache import CACHE
 from app.config import Config
+from app.json_provider import json_provider
 
 SCAN_SLEEP = 2
 
@@ -24,19 +23,6 @@ logging.basicConfig(level=logging.DEBUG,
 log = logging.getLogger(__name__)
 
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, obj):
-        try:
-            if isinstance(obj, date):
-                return obj.isoformat()
-            iterable = iter(obj)
-        except TypeError:
-            pass
-        else:
-            return list(iterable)
-        return JSONEncoder.default(self, obj)
-
-
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
@@ -47,7 +33,7 @@ def create_app(config_class=Config):
 
     db.init_app(app)
     db.app = app  # global db
-    app.json_encoder = CustomJSONEncoder  # encode datetime as ISO
+    app.json = json_provider(app)  # encode datetime as ISO
 
     # flask migrate
     opts = {"autoflush": False}
@@ -65,6 +51,10 @@ def create_app(config_class=Config):
     global config
     config = app.config
 
+    from app.core.cache import HISTORY_CACHE
+    HISTORY_CACHE.configure(ttl=config.get('HISTORY_CACHE_TTL_SECONDS'),
+                            max_bytes=config.get('HISTORY_CACHE_MAX_BYTES'))
+
     from app.core.plugins import plugin_manager
     plugin_manager.initialize()
 
@@ -1,4 +1,6 @@
 import threading
+import time
+from collections import OrderedDict
 
 
 class Cache:
@@ -10,8 +12,17 @@ class Cache:
     def __init__(self):
         self.__active_devices = dict()
         self.__active_schedulers = dict()
+        self.__initializing = set()  # db ids of devices not yet initialized (startup)
+        self.is_owner = True  # this process talks to the devices (see app.system.startup)
+        self.owner_pid = None
+        self.owner_state = None  # owner's snapshot(), mirrored by the others (app.system.ipc)
+        self.listeners = []  # called (no args) when the device state changes
         self.lock = threading.Lock()
 
+    def __changed(self):
+        for listener in self.listeners:
+            listener()
+
     def get_all_active_devices(self):
         return list(self.__active_devices.values())
 
@@ -27,14 +38,66 @@ class Cache:
     def add_active_device(self, device):
         with self.lock:
             self.__active_devices[device.uuid] = self.__sanitize(device)
+        self.__changed()
 
     def remove_active_device(self, device):
         with self.lock:
             del self.__active_devices[device.uuid]
+        self.__changed()
 
     def clear_devices(self):
         with self.lock:
             self.__active_devices.clear()
+        self.__changed()
+
+    def set_initializing(self, device_ids):
+        with self.lock:
+            self.__initializing = set(device_ids)
+        self.__changed()
+
+    def set_initialized(self, device_id=None):
+        """Single device (or all of them) initialized."""
+        with self.lock:
+            if device_id is None:
+                self.__initializing.clear()
+            else:
+                self.__initializing.discard(device_id)
+        self.__changed()
+
+    def is_initializing(self, device_id):
+        return device_id in self.__initializing
+
+    @property
+    def initializing_count(self):
+        return len(self.__initializing)
+
+    def snapshot(self):
+        """Device state of this process, JSON serializable."""
+        with self.lock:
+            return {
+                'active': sorted(str(device) for device in self.__active_devices.values()),
+                'schedulers': sorted(uuid for uuid, scheduler in self.__active_schedulers.items()
+                                     if scheduler.is_running),
+                'initializing': sorted(self.__initializing),
+            }
+
+    def state(self):
+        """Device state of the owner process (this one or mirrored), None if not known."""
+        return self.snapshot() if self.is_owner else self.owner_state
+
+    def device_state(self, uuid, device_id):
+        """(scheduler running, initializing) as seen by the owner, (None, None) if not known."""
+        if self.is_owner:
+            return self.has_active_scheduler(uuid), self.is_initializing(device_id)
+        if self.owner_state is None:
+            return None, None
+        return uuid in self.owner_state['schedulers'], \
+            device_id in self.owner_state['initializing']
+
+    def set_owner(self, is_owner, pid=None):
+        """Whether this process owns the devices, pid of the owner (if known)."""
+        self.is_owner = is_owner
+        self.owner_pid = pid
 
     def has_active_scheduler(self, uuid):
         return self.__active_schedulers.get(uuid) is not None \
@@ -49,11 +112,150 @@ class Cache:
             return  # not allowed more than 1
         with self.lock:
             self.__active_schedulers[uuid] = scheduler
+        self.__changed()
 
     def remove_scheduler(self, uuid):
-        if self.has_active_scheduler(uuid):
-            with self.lock:
-                del self.__active_schedulers[uuid]
+        with self.lock:  # (already terminated by stop_scheduler, i.e. not running)
+            self.__active_schedulers.pop(uuid, None)
+        self.__changed()
+
+
+class ScheduleCache:
+    """
+    Compiled task schedules per device: {task_id: (stamp, compiled)}.
+    Device schedule is valid until any of its tasks is invalidated, unchanged
+    tasks can still be reused (looked-up by their stamp).
+    """
+
+    def __init__(self):
+        self.__schedules = dict()
+        self.__valid = set()
+        self.__generations = dict()
+        self.lock = threading.Lock()
+
+    def get_schedule(self, device_id):
+        """
+        :return: (compiled schedule or None if invalid, generation)
+        """
+        with self.lock:
+            generation = self.__generations.get(device_id, 0)
+            if device_id not in self.__valid:
+                return None, generation
+            return dict(self.__schedules[device_id]), generation
+
+    def get_compiled(self, device_id, task_id, stamp):
+        """Previously compiled task, only if its stamp is still the same."""
+        cached = self.__schedules.get(device_id, {}).get(task_id)
+        if cached and cached[0] == stamp:
+            return cached
+        return None
+
+    def set_schedule(self, device_id, schedule, generation):
+        """Ignored in case anything was invalidated since 'get_schedule'."""
+        with self.lock:
+            if self.__generations.get(device_id, 0) != generation:
+                return False
+            self.__schedules[device_id] = schedule
+            self.__valid.add(device_id)
+            return True
+
+    def invalidate(self, device_id, task_id=None):
+        """Drop a single task (or the entire device schedule)."""
+        with self.lock:
+            self.__generations[device_id] = self.__generations.get(device_id, 0) + 1
+            self.__valid.discard(device_id)
+            if task_id is None:
+                self.__schedules.pop(device_id, None)
+            else:
+                self.__schedules.get(device_id, {}).pop(task_id, None)
+
+
+class ResultCache:
+    """
+    Encoded query results (bytes) with a TTL and a total size limit in bytes, the
+    least recently used entries are evicted first. Entries are tagged (e.g. by
+    sensor id) so they can be invalidated once the underlying data changes.
+    """
+
+    def __init__(self, ttl=300, max_bytes=4 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.__entries = OrderedDict()  # key: (expires, tag, value)
+        self.__generations = dict()
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def configure(self, ttl=None, max_bytes=None):
+        with self.lock:
+            self.ttl = self.ttl if ttl is None else ttl
+            self.max_bytes = self.max_bytes if max_bytes is None else max_bytes
+            self.__evict()
+
+    def __remove(self, key):
+        _, _, value = self.__entries.pop(key)
+        self.__size -= len(value)
+
+    def __evict(self):
+        while self.__entries and self.__size > self.max_bytes:
+            self.__remove(next(iter(self.__entries)))
+            self.evictions += 1
+
+    def generation(self, tag):
+        """Pass to 'set', so that a result computed before an invalidation isn't stored."""
+        return self.__generations.get(tag, 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.__entries.get(key)
+            if entry and entry[0] < time.monotonic():
+                self.__remove(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value: bytes, tag=None, generation=0):
+        with self.lock:
+            if self.__generations.get(tag, 0) != generation or len(value) > self.max_bytes:
+                return False
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.monotonic() + self.ttl, tag, value)
+            self.__size += len(value)
+            self.__evict()
+            return True
+
+    def invalidate(self, tag):
+        with self.lock:
+            self.__generations[tag] = self.__generations.get(tag, 0) + 1
+            for key in [key for key, entry in self.__entries.items() if entry[1] == tag]:
+                self.__remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.__entries),
+                'bytes': self.__size,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
 
 
 CACHE = Cache()
+SCHEDULE_CACHE = ScheduleCache()
+HISTORY_CACHE = ResultCache()
@@ -0,0 +1,244 @@
+import functools
+import math
+import re
+import zlib
+from datetime import datetime, timedelta
+
+from croniter import croniter
+from croniter.croniter import CroniterError
+
+
+class CronError(ValueError):
+    """Invalid (or never firing) cron definition"""
+    pass
+
+
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+               'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+MAX_YEARS = 8  # give up searching for e.g. '0 0 30 2 *'
+
+INTERVAL_PREFIX = 'every:'
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+EPOCH = datetime(1970, 1, 1)
+
+
+def _next_bit(mask, start):
+    """Lowest set bit of the mask >= start (or None)"""
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
+
+
+class CronExpression:
+    """
+    Standard 5-field cron expression compiled into bitsets (one int per field),
+    so that matching a datetime is just a few bit operations.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise CronError(f"Expected 5 fields, got '{expression}'")
+        minute, hour, dom, month, dow = fields
+
+        self.minutes = self.__parse(minute, 0, 59)
+        self.hours = self.__parse(hour, 0, 23)
+        self.days = self.__parse(dom, 1, 31)
+        self.months = self.__parse(month, 1, 12, names=MONTH_NAMES, offset=1)
+        weekdays = self.__parse(dow, 0, 7, names=DAY_NAMES)
+        self.weekdays = (weekdays | weekdays >> 7) & 0x7f  # 7 is sunday as well
+
+        # both day fields restricted -> either of them has to match (as in cron)
+        self.days_restricted = not self.__is_any(dom)
+        self.weekdays_restricted = not self.__is_any(dow)
+
+    def __repr__(self):
+        return f"<CronExpression ({self.expression})>"
+
+    @staticmethod
+    def __is_any(field):
+        """'*' or '*/1' (as in croniter, '*/2' restricts the day)"""
+        item, _, step = field.partition('/')
+        return item in ('*', '?') and (not step or step.isdigit() and int(step) == 1)
+
+    @staticmethod
+    def __parse_value(value, names, offset):
+        value = value.lower()
+        if names and value in names:
+            return names.index(value) + offset
+        if not value.isdigit():
+            raise CronError(f"Unsupported value '{value}'")
+        return int(value)
+
+    @classmethod
+    def __parse(cls, field, low, high, names=None, offset=0):
+        mask = 0
+        for item in field.split(','):
+            item, slash, step = item.partition('/')
+            step = int(step) if step.isdigit() else (0 if slash else 1)
+            if step < 1:
+                raise CronError(f"Invalid step in '{field}'")
+
+            if item in ('*', '?'):
+                start, end = low, high
+            elif '-' in item:
+                start, end = (cls.__parse_value(v, names, offset) for v in item.split('-', 1))
+            else:
+                start = cls.__parse_value(item, names, offset)
+                end = high if slash else start
+
+            if not low <= start <= end <= high:
+                raise CronError(f"Value out of range in '{field}' ({low}-{high})")
+            for value in range(start, end + 1, step):
+                mask |= 1 << value
+        return mask
+
+    def match_day(self, time: datetime):
+        day = self.days >> time.day & 1
+        weekday = self.weekdays >> (time.weekday() + 1) % 7 & 1
+        if self.days_restricted and self.weekdays_restricted:
+            return bool(day or weekday)
+        return bool(day and weekday)
+
+    def next_after(self, start: datetime):
+        """The first fire time strictly after 'start' (naive, same tz as 'start')."""
+        time = start.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last_year = time.year + MAX_YEARS
+        first_month = _next_bit(self.months, 1)
+
+        while time.year <= last_year:
+            month = _next_bit(self.months, time.month)
+            if month is None:
+                time = datetime(time.year + 1, first_month, 1)
+                continue
+            if month != time.month:
+                time = datetime(time.year, month, 1)
+
+            if not self.match_day(time):
+                time = datetime(time.year, time.month, time.day) + timedelta(days=1)
+                continue
+
+            hour = _next_bit(self.hours, time.hour)
+            if hour is None:
+                time = datetime(time.year, time.month, time.day) + timedelta(days=1)
+                continue
+            if hour != time.hour:
+                time = time.replace(hour=hour, minute=0)
+
+            minute = _next_bit(self.minutes, time.minute)
+            if minute is None:
+                time = time.replace(minute=0) + timedelta(hours=1)
+                continue
+            return time.replace(minute=minute)
+
+        raise CronError(f"'{self.expression}' doesn't fire in the next {MAX_YEARS} years.")
+
+    def next_n(self, start: datetime, count: int):
+        times = []
+        for _ in range(count):
+            start = self.next_after(start)
+            times.append(start)
+        return times
+
+
+class IntervalExpression:
+    """
+    'every:<n>[s|m|h]' trigger, e.g. 'every:15s'. Fires each n seconds, shifted
+    by a phase (fraction of the period), so that devices with a different phase
+    don't fire at the same instant.
+    """
+
+    __pattern = re.compile(r'^every:(?P<count>\d+)(?P<unit>[smh]?)$')
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        match = re.match(self.__pattern, expression.strip().lower())
+        if not match:
+            raise CronError(f"Invalid interval definition '{expression}', "
+                            f"expected e.g. '{INTERVAL_PREFIX}15s'")
+        self.seconds = int(match['count']) * INTERVAL_UNITS[match['unit'] or 's']
+        if self.seconds < 1:
+            raise CronError(f"Interval '{expression}' must be at least 1 second.")
+
+    def __repr__(self):
+        return f"<IntervalExpression ({self.expression})>"
+
+    def next_after(self, start: datetime, phase=0.0):
+        offset = phase * self.seconds
+        periods = math.floor(((start - EPOCH).total_seconds() - offset) / self.seconds) + 1
+        return EPOCH + timedelta(seconds=periods * self.seconds + offset)
+
+    def next_n(self, start: datetime, count: int, phase=0.0):
+        times = []
+        for _ in range(count):
+            start = self.next_after(start, phase=phase)
+            times.append(start)
+        return times
+
+
+def get_phase(key):
+    """Stable pseudo-random phase in [0, 1) for e.g. a device uuid."""
+    return zlib.crc32(str(key).encode('utf-8')) / 2 ** 32
+
+
+class CroniterExpression:
+    """Fallback for syntax not handled by CronExpression (e.g. seconds, 'L', '#')"""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            croniter(expression)
+        except CroniterError as e:
+            raise CronError(f"Invalid cron definition '{expression}': {e}")
+
+    def __repr__(self):
+        return f"<CroniterExpression ({self.expression})>"
+
+    def next_after(self, start: datetime):
+        try:
+            return croniter(self.expression, start).get_next(datetime)
+        except CroniterError as e:
+            raise CronError(e)
+
+    def next_n(self, start: datetime, count: int):
+        iterator = croniter(self.expression, start)
+        return [iterator.get_next(datetime) for _ in range(count)]
+
+
+@functools.lru_cache(maxsize=256)
+def compile_cron(expression):
+    """Compiled (and cached) cron expression, raises CronError."""
+    if not isinstance(expression, str):
+        raise CronError(f"Cron definition must be a string, not '{expression}'")
+    if expression.strip().lower().startswith(INTERVAL_PREFIX):
+        return IntervalExpression(expression)
+    try:
+        return CronExpression(expression)
+    except CronError:
+        return CroniterExpression(expression)
+
+
+def next_fire_times(expressions, start=None, count=1):
+    """
+    Batch version: next 'count' fire times for each of the expressions. Every
+    distinct expression is computed only once, no matter how many tasks share it.
+
+    :return: list of lists, in the order of 'expressions'
+    """
+    start = start or datetime.utcnow()
+    computed = {expression: compile_cron(expression).next_n(start, count)
+                for expression in set(expressions)}
+    return [computed[expression] for expression in expressions]
@@ -1,18 +1,33 @@
+import asyncio
+import copy
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from enum import Enum
 
 from app import Config
+from app.core.device.breaker import CircuitBreaker, State as BreakerState
 
 log = logging.getLogger(__name__)
 
 
+def setting(key):
+    """Value from the app config (incl. HYDROSERVER_CONFIG), the Config default otherwise."""
+    from app import config
+    value = (config or {}).get(key)
+    return getattr(Config, key) if value is None else value
+
+
 class Command(Enum):
     """Available device communication commands"""
     PING = Config.PRECONFIGURED_COMMAND["ping"]
     STATUS = Config.PRECONFIGURED_COMMAND["status"]
     CONTROL = Config.PRECONFIGURED_COMMAND["control_prefix"]
     SENSOR = Config.PRECONFIGURED_COMMAND["sensor_prefix"]
+    READ = Config.PRECONFIGURED_COMMAND["read"]
 
     def __str__(self):
         return self.value
@@ -56,6 +71,11 @@ class DeviceCommunicationException(DeviceException):
     pass
 
 
+class DeviceUnavailableException(DeviceCommunicationException):
+    """Device's circuit is open (it kept failing), the request was not even sent."""
+    pass
+
+
 class DeviceResponse:
     """Generic response object. Pops-out status item, everything else is dict."""
     def __init__(self, status, data=None, reason=None):
@@ -159,8 +179,21 @@ class Device(object):
     """
 
     device_type = DeviceType.GENERIC
+    push_listeners = []  # callables (device, data), notified of unsolicited device data
+    batched_read = None  # device supports Command.READ, None = not known yet
 
     def __init__(self):
+        self.breaker = CircuitBreaker(
+            str(self),
+            threshold=setting('BREAKER_FAILURE_THRESHOLD'),
+            backoff=setting('BREAKER_BACKOFF_SECONDS'),
+            max_backoff=setting('BREAKER_MAX_BACKOFF_SECONDS'),
+            jitter=setting('BREAKER_JITTER'))
+        self.coalesce_seconds = setting('COMMAND_COALESCE_SECONDS')
+        self.__flights = dict()  # read-only request key: (Future, write generation), in flight
+        self.__results = dict()  # read-only request key: (response, time.monotonic(), generation)
+        self.__generation = 0  # of writes, reads started before a write are not reused after it
+        self.__flights_lock = threading.Lock()
         self._init()
         log.info(f"[OK] Initialized: {self}")
 
@@ -179,6 +212,29 @@ class Device(object):
         """
         pass
 
+    # may be overridden
+    def _send_many(self, data_list):
+        """
+        Send several requests at once (e.g. pipelined, if the device supports it).
+
+        :param list data_list: request data
+        :return: response dictionaries, in the order of requests
+        :rtype: list
+        """
+        return [self._send_raw(data) for data in data_list]
+
+    # may be overridden
+    async def _send_raw_async(self, data):
+        """
+        Non-blocking _send_raw, by default the blocking one is run in the I/O
+        loop's executor.
+
+        :param dict data: request data
+        :return: response dictionary
+        :rtype: dict
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._send_raw, data)
+
     # to be overridden
     def _get_uuid(self):
         """UUID getter"""
@@ -194,6 +250,11 @@ class Device(object):
         """Initialization method -> fetch status and make device responding"""
         pass
 
+    # may be overridden
+    def close(self):
+        """Release the connection (port, sockets), e.g. of a device no longer used."""
+        pass
+
     # to be overridden
     def _is_connected(self):
         """Device is sending/receiving'"""
@@ -204,6 +265,15 @@ class Device(object):
         """Device is sending/receiving according to 'protocol'"""
         pass
 
+    def _on_push(self, data):
+        """Data sent by the device on its own (e.g. a changed sensor value)."""
+        log.debug(f"{self}: pushed {data}")
+        for listener in self.push_listeners:
+            try:
+                listener(self, data)
+            except Exception as e:
+                log.error(f"{self}: push listener '{listener}' failed: {e}")
+
     @property
     def is_responding(self):
         """Device is sending/receiving according to 'protocol'"""
@@ -235,6 +305,9 @@ class Device(object):
         """
         public wrapper for _send_raw() with retry mechanism.
 
+        Concurrent identical read-only requests (status, sensor reads) share one
+        round trip, its result is reused for COMMAND_COALESCE_SECONDS.
+
         :param request_data: data to be sent
         :param in retries: number of retries
         :rtype: dict
@@ -243,9 +316,118 @@ class Device(object):
         if type(request_data) is not dict:
             request_data = self._simple_request(str(request_data))
 
+        if not self.__is_read_only(request_data):
+            self.__forget_results()  # reads in flight now won't be reused either
+            try:
+                return self.__send(request_data, retries)
+            finally:
+                self.__forget_results()  # e.g. a control changed, don't reuse the old status
+
+        key = json.dumps(request_data, sort_keys=True)
+        response, future, generation, leader = self.__join(key)
+        if future is None:
+            return copy.deepcopy(response)  # the callers may modify it
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            response = self.__send(request_data, retries)
+        except BaseException as e:
+            self.__landed(key, future)  # failures are not reused
+            future.set_exception(e)
+            raise
+        self.__landed(key, future, (response, time.monotonic(), generation))
+        future.set_result(response)
+        return copy.deepcopy(response)
+
+    async def send_command_async(self, request_data, retries=2):
+        """Same as send_command(), to be awaited in the I/O loop (see loop.IO_LOOP)."""
+        if type(request_data) is not dict:
+            request_data = self._simple_request(str(request_data))
+
+        if not self.__is_read_only(request_data):
+            self.__forget_results()
+            try:
+                return await self.__send_async(request_data, retries)
+            finally:
+                self.__forget_results()
+
+        key = json.dumps(request_data, sort_keys=True)
+        response, future, generation, leader = self.__join(key)
+        if future is None:
+            return copy.deepcopy(response)
+        if not leader:
+            # shielded: a cancelled follower doesn't cancel the leader's flight
+            return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(future)))
+
+        try:
+            response = await self.__send_async(request_data, retries)
+        except BaseException as e:
+            self.__landed(key, future)
+            future.set_exception(e)
+            raise
+        self.__landed(key, future, (response, time.monotonic(), generation))
+        future.set_result(response)
+        return copy.deepcopy(response)
+
+    def __join(self, key):
+        """
+        Reusable result of the read or its flight: (response, Future, generation,
+        is leader), the Future is None if the response is reused.
+        """
+        with self.__flights_lock:
+            response, finished, generation = self.__results.get(key, (None, None, None))
+            if generation == self.__generation \
+                    and time.monotonic() - finished < self.coalesce_seconds:
+                return response, None, generation, False
+            future, generation = self.__flights.get(key, (None, None))
+            leader = generation != self.__generation
+            if leader:
+                future, generation = Future(), self.__generation
+                self.__flights[key] = (future, generation)
+            return None, future, generation, leader
+
+    def __landed(self, key, future, result=None):
+        """The flight is over, its result is reused unless there was a write meanwhile."""
+        with self.__flights_lock:
+            if self.__flights.get(key, (None, None))[0] is future:
+                del self.__flights[key]
+            now = time.monotonic()
+            for expired in [k for k, (_, finished, _) in self.__results.items()
+                            if now - finished >= self.coalesce_seconds]:
+                del self.__results[expired]
+            if result is not None and result[2] == self.__generation:
+                self.__results[key] = result
+
+    def __forget_results(self):
+        with self.__flights_lock:
+            self.__generation += 1
+            self.__results.clear()
+
+    @staticmethod
+    def __is_read_only(request_data):
+        request = str(request_data.get('request', ''))
+        return request in (Command.STATUS.value, Command.PING.value, Command.READ.value) \
+            or request.startswith(Command.SENSOR.value)
+
+    def __send(self, request_data, retries):
+        if not self.breaker.allow():
+            raise DeviceUnavailableException(
+                f"{self}: not responding, retry in {self.breaker.retry_in:.1f}s.")
+        try:
+            response = self.__send_with_retries(request_data, retries)
+        except DeviceCommunicationException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    def __send_with_retries(self, request_data, retries):
         try:
             return self._send_raw(request_data)
         except DeviceCommunicationException:
+            if self.breaker.state == BreakerState.HALF_OPEN:
+                raise  # a single probe
             for i in range(retries):
                 if self.ensure_connectivity():
                     try:
@@ -254,6 +436,39 @@ class Device(object):
                         pass
             raise
 
+    async def ensure_connectivity_async(self):
+        try:
+            await self._send_raw_async(self._simple_request(Command.STATUS))
+            return True
+        except DeviceException:
+            return False
+
+    async def __send_async(self, request_data, retries):
+        if not self.breaker.allow():
+            raise DeviceUnavailableException(
+                f"{self}: not responding, retry in {self.breaker.retry_in:.1f}s.")
+        try:
+            response = await self.__send_with_retries_async(request_data, retries)
+        except DeviceCommunicationException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    async def __send_with_retries_async(self, request_data, retries):
+        try:
+            return await self._send_raw_async(request_data)
+        except DeviceCommunicationException:
+            if self.breaker.state == BreakerState.HALF_OPEN:
+                raise
+            for i in range(retries):
+                if await self.ensure_connectivity_async():
+                    try:
+                        return await self._send_raw_async(request_data)
+                    except DeviceCommunicationException:
+                        pass
+            raise
+
     def read_status(self):
         """
         READ full device status (expecting dev info + sensors/controls values
@@ -262,6 +477,11 @@ class Device(object):
         return StatusResponse.from_response_data(
             self.send_command(Command.STATUS.value))
 
+    async def read_status_async(self):
+        """:rtype: StatusResponse"""
+        return StatusResponse.from_response_data(
+            await self.send_command_async(Command.STATUS.value))
+
     def read_sensor(self, sensor_name: str):
         """
         READ a sensor value and return number
@@ -271,6 +491,34 @@ class Device(object):
         response_dict = self.send_command(cmd)
         return SensorResponse.from_response_data(response_dict)
 
+    def read_sensors(self, sensor_names):
+        """
+        READ several sensors with one request, falls back to a request per
+        sensor if it fails. Devices replying UNKNOWN_CMD are not asked again.
+        :rtype: dict of SensorResponse by sensor name
+        """
+        sensor_names = list(sensor_names)
+        if sensor_names and self.batched_read is not False:
+            request = {'request': Command.READ.value, 'sensors': sensor_names}
+            response = DeviceResponse.from_response_data(self.send_command(request))
+            if response.is_success and all(name in response.data for name in sensor_names):
+                self.batched_read = True
+                return {name: SensorResponse(Status.OK, self.__sensor_data(response[name]))
+                        for name in sensor_names}
+            if str(response.get('cause', '')).startswith('UNKNOWN_CMD'):
+                log.info(f"{self}: batched read not supported, reading one by one.")
+                self.batched_read = False
+            else:
+                log.warning(f"{self}: batched read failed ({response}), reading one by one.")
+        return {name: self.read_sensor(name) for name in sensor_names}
+
+    @staticmethod
+    def __sensor_data(item):
+        """Sensor item of a batched response: value only or status-like dict."""
+        if type(item) is dict:
+            return item
+        return {'value': item}
+
     def send_control(self, control_name: str, value=None, strict=True):
         """
         SEND a control command
@@ -286,6 +534,8 @@ class Device(object):
         return SensorResponse.from_response_data(self.send_command(request))
 
     def health_check(self):
+        if not self.breaker.available:
+            return False  # known to be dead, not even checked until the backoff elapses
         if self.is_responding:
             return True
         log.info(f"{self} is offline, checking if something changed...")
@@ -304,16 +554,90 @@ class Device(object):
         return {'request': str(string_requst)}
 
 
+class ProbeReport:
+    """Outcome of probing several devices: reachable devices and reasons for the rest."""
+
+    def __init__(self):
+        self.reachable = {}  # key: device
+        self.unreachable = {}  # key: reason
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return f"<ProbeReport (reachable={len(self.reachable)}, " \
+               f"unreachable={len(self.unreachable)}, elapsed={self.elapsed:.1f}s)>"
+
+    @property
+    def devices(self):
+        return list(self.reachable.values())
+
+    def to_dict(self):
+        return {
+            'reachable': {str(key): str(device) for key, device in self.reachable.items()},
+            'unreachable': {str(key): reason for key, reason in self.unreachable.items()},
+            'elapsed_seconds': round(self.elapsed, 3),
+        }
+
+
+def _close_late(future):
+    """A device connected after the probe's deadline isn't used, close it."""
+    if future.cancelled() or future.exception() is not None or future.result() is None:
+        return
+    log.info(f"Closing {future.result()}, connected after the probe deadline.")
+    future.result().close()
+
+
+def probe(connectors, max_workers=None, timeout=None):
+    """
+    Run the connectors (key: callable returning a responding device or raising)
+    concurrently, in a bounded pool and within an overall deadline. Devices
+    connected after the deadline are closed.
+
+    :rtype: ProbeReport
+    """
+    max_workers = max_workers or setting('DISCOVERY_MAX_WORKERS')
+    timeout = timeout or setting('DISCOVERY_TIMEOUT_SECONDS')
+    report = ProbeReport()
+    start = time.monotonic()
+    if not connectors:
+        return report
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(connectors)),
+                                  thread_name_prefix='probe')
+    futures = {executor.submit(connect): key for key, connect in connectors.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+    for future in not_done:
+        future.add_done_callback(_close_late)  # still connecting, e.g. a slow serial port
+
+    for future, key in futures.items():
+        if future in not_done:
+            report.unreachable[key] = f"No response within {timeout}s."
+        elif future.exception():
+            report.unreachable[key] = str(future.exception()) or repr(future.exception())
+        elif future.result() is None:
+            report.unreachable[key] = "Not responding."
+        else:
+            report.reachable[key] = future.result()
+    report.elapsed = time.monotonic() - start
+    log.info(f"Probe complete: {report}")
+    return report
+
+
 from app.core.device.serial import scan as serial_scan
 from app.core.device.mock import scan as mock_scan
 
 
-def scan():
+def scan(report=False):
+    """
+    Scan all device types.
+    :param report: return the whole ProbeReport, not just the found devices
+    """
     try:
         mocked_devices = os.getenv("MOCK_DEV", "0")
         mocked_devices = int(mocked_devices)
     except Exception:
         mocked_devices = 0
-    scans = serial_scan() or []
-    scans.extend(mock_scan(num=mocked_devices))
-    return scans
+    result = serial_scan(report=True)
+    for device in mock_scan(num=mocked_devices):
+        result.reachable[device.url] = device
+    return result if report else result.devices
@@ -0,0 +1,84 @@
+import logging
+import random
+import threading
+import time
+from enum import Enum
+
+log = logging.getLogger(__name__)
+
+
+class State(Enum):
+    CLOSED = "closed"  # requests go through
+    OPEN = "open"  # known to be dead, requests fail right away until the backoff elapses
+    HALF_OPEN = "half-open"  # backoff elapsed, a single probe request is let through
+
+
+class CircuitBreaker:
+    """
+    Per device: after 'threshold' consecutive failures the circuit opens and
+    requests are short-circuited. Once the backoff elapses, one request probes
+    the device - success closes the circuit, failure opens it again with the
+    backoff doubled (up to 'max_backoff', randomized by 'jitter').
+    """
+
+    def __init__(self, name, threshold=3, backoff=5.0, max_backoff=300.0, jitter=0.2):
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.state = State.CLOSED
+        self.failures = 0  # consecutive
+        self.opened = 0  # times opened in a row, i.e. the backoff exponent
+        self.retry_at = 0.0  # time.monotonic() the next probe is allowed
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<CircuitBreaker (name={self.name}, state={self.state.value})>"
+
+    @property
+    def retry_in(self):
+        """Seconds until the next probe, 0 if not open."""
+        if self.state != State.OPEN:
+            return 0.0
+        return max(0.0, self.retry_at - time.monotonic())
+
+    @property
+    def available(self):
+        """Requests are (or the probe is) allowed, nothing changes."""
+        return self.state == State.CLOSED or \
+            (self.state == State.OPEN and time.monotonic() >= self.retry_at)
+
+    def allow(self):
+        """Request may go through: closed, or the one probe of an elapsed backoff."""
+        with self.__lock:
+            if self.state == State.CLOSED:
+                return True
+            if self.state == State.OPEN and time.monotonic() >= self.retry_at:
+                self.state = State.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.__lock:
+            if self.state != State.CLOSED:
+                log.info(f"{self.name}: responding again, circuit closed.")
+            self.state = State.CLOSED
+            self.failures = 0
+            self.opened = 0
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.state == State.HALF_OPEN or self.failures >= self.threshold:
+                self.__open()
+
+    def __open(self):
+        """(!) caller holds the lock"""
+        delay = min(self.max_backoff, self.backoff * 2 ** self.opened)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.opened += 1
+        self.retry_at = time.monotonic() + delay
+        if self.state != State.OPEN:
+            log.warning(f"{self.name}: not responding, circuit open (retry in {delay:.1f}s).")
+        self.state = State.OPEN
@@ -1,16 +1,30 @@
+import asyncio
 import json
 import logging
 import threading
+import time
 import traceback
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from app.core.device import Device, DeviceType, Command, DeviceCommunicationException, Status
+from app.core.device import Device, DeviceType, Command, DeviceCommunicationException, Status, \
+    setting
+from app.core.device.loop import IO_LOOP
 
 log = logging.getLogger(__name__)
 
 
 class HttpDevice(Device):
+    """
+    Requests go through a per-device session (keep-alive, pooled connections)
+    with connect/read timeouts. Whether the site is online is remembered for
+    HTTP_ONLINE_CHECK_TTL_SECONDS, every request refreshes it.
+
+    Awaited requests (_send_raw_async) don't take a thread: they are sent by
+    the shared I/O loop over its own kept-alive connections (asyncio streams).
+    """
 
     device_type = DeviceType.WIFI
 
@@ -19,6 +33,14 @@ class HttpDevice(Device):
         self.lock = threading.Lock()
         self.__uuid = None
         self.__is_responding = True
+        self.__online = None  # (is online, time.monotonic() of the check)
+        self.timeout = (setting('HTTP_CONNECT_TIMEOUT_SECONDS'),
+                        setting('HTTP_READ_TIMEOUT_SECONDS'))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=setting('HTTP_POOL_SIZE'))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.__idle = []  # (loop) kept-alive (reader, writer) streams of the awaited requests
         super(HttpDevice, self).__init__()
 
     def _get_uuid(self):
@@ -29,7 +51,7 @@ class HttpDevice(Device):
 
     def _init(self):
         # 1) network issues - unreachable
-        if not self.is_site_online():
+        if not self.is_site_online(max_age=0):
             self.__is_responding = False
             return
 
@@ -55,27 +77,57 @@ class HttpDevice(Device):
         self.__is_responding = True
         self.__uuid = uuid
 
-    def is_site_online(self):
-        """A basic Wi-Fi device is realized as an HTTP server accepting GET on '/'"""
+    def __set_online(self, online):
+        self.__online = (online, time.monotonic())
+        return online
+
+    def is_site_online(self, max_age=None):
+        """
+        A basic Wi-Fi device is realized as an HTTP server accepting GET on '/'.
+        :param max_age: seconds a previous result is trusted (default from config)
+        """
+        if max_age is None:
+            max_age = setting('HTTP_ONLINE_CHECK_TTL_SECONDS')
+        if self.__online and time.monotonic() - self.__online[1] < max_age:
+            return self.__online[0]
         try:
-            return not requests.get(self.url).status_code >= 300
+            online = not self.session.get(self.url, timeout=self.timeout).status_code >= 300
         except requests.RequestException:
-            return False
+            online = False
+        return self.__set_online(online)
 
     # [!] one and only send method implementation
     def _send_raw(self, request_dict):
         try:
-            response = requests.post(self.url, json=request_dict)
+            response = self.session.post(self.url, json=request_dict, timeout=self.timeout)
         except requests.RequestException as e:
-            self.__is_responding = False
-            raise DeviceCommunicationException(e)
-        if response.status_code >= 300:
+            raise self.__unreachable(e)
+        return self.__received(response.status_code, lambda: response.text, response.json)
+
+    async def _send_raw_async(self, request_dict):
+        try:
+            status_code, body = await self.__post_async(request_dict)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError, asyncio.LimitOverrunError) as e:
+            raise self.__unreachable(e)
+        return self.__received(status_code, lambda: body.decode('utf-8', errors='replace'),
+                               lambda: json.loads(body))
+
+    def __unreachable(self, error):
+        """The request failed, the exception to raise."""
+        self.__is_responding = False
+        self.__set_online(False)
+        return DeviceCommunicationException(error)
+
+    def __received(self, status_code, text, load):
+        """Response -> dict: HTTP errors as a FAIL status, JSON encoded items decoded."""
+        self.__set_online(True)
+        if status_code >= 300:
             return {
                 'status': Status.FAIL,
-                'reason': f'HTTP {response.status_code}, {response.text}'
+                'reason': f'HTTP {status_code}, {text()}'
             }
 
-        response_dict = response.json()
+        response_dict = load()
         for k, v in response_dict.items():
             # Item values can be dicts encoded as string.
             try:
@@ -86,6 +138,88 @@ class HttpDevice(Device):
         self.__is_responding = True
         return response_dict
 
+    async def __post_async(self, request_dict):
+        """
+        (I/O loop) POST the JSON over an idle connection if there is one, a new
+        one if not or if the idle one turns out to be closed by the device.
+        :return: (status code, body)
+        """
+        url = urlsplit(str(self.url))
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError(f"Invalid URL '{self.url}'.")
+        body = json.dumps(request_dict).encode('utf-8')
+        target = (url.path or '/') + (f'?{url.query}' if url.query else '')
+        head = f"POST {target} HTTP/1.1\r\nHost: {url.netloc}\r\n" \
+               f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+        connect_timeout, read_timeout = self.timeout
+
+        while True:
+            reused = bool(self.__idle)
+            if reused:
+                reader, writer = self.__idle.pop()
+                if reader.at_eof():  # closed by the device while idle
+                    writer.close()
+                    continue
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                    url.hostname, url.port or (443 if url.scheme == 'https' else 80),
+                    ssl=url.scheme == 'https' or None), connect_timeout)
+            try:
+                writer.write(head.encode('latin-1') + body)
+                status_code, keep_alive, content = await asyncio.wait_for(
+                    self.__read_response(reader), read_timeout)
+            except (ConnectionError, EOFError):
+                writer.close()
+                if reused:
+                    continue  # closed meanwhile
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive and len(self.__idle) < setting('HTTP_POOL_SIZE'):
+                self.__idle.append((reader, writer))
+            else:
+                writer.close()
+            return status_code, content
+
+    @staticmethod
+    async def __read_response(reader):
+        """:return: (status code, connection can be reused, body) of the HTTP response"""
+        version, status_code = (await reader.readuntil(b"\r\n")).decode('latin-1').split()[:2]
+        status_code = int(status_code)
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+        if status_code < 200 or status_code in (204, 304):
+            body = b''
+        elif headers.get('transfer-encoding') == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if not size:
+                    break
+                body += (await reader.readexactly(size + 2))[:-2]
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass  # trailers
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()  # until the device closes the connection
+            keep_alive = False
+        return status_code, keep_alive, bytes(body)
+
+    def close(self):
+        self.session.close()
+        idle, self.__idle = self.__idle, []
+        for _, writer in idle:
+            IO_LOOP.call_soon(writer.close)
+
     def _is_connected(self):
         return self.is_site_online()
 
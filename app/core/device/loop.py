@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    A single asyncio event loop (in a daemon thread) shared by all devices for
+    non-blocking I/O, started on first use. run() is the sync shim for blocking
+    callers (routes, Controller, tasks).
+    """
+
+    def __init__(self):
+        self.__loop = None
+        self.__lock = threading.Lock()
+        self.__dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='device-push')
+
+    def __repr__(self):
+        return f"<EventLoopThread (running={self.is_running})>"
+
+    @property
+    def is_running(self):
+        return self.__loop is not None and self.__loop.is_running()
+
+    @property
+    def loop(self):
+        with self.__lock:
+            if self.__loop is None or self.__loop.is_closed():
+                self.__loop = asyncio.new_event_loop()
+                threading.Thread(target=self.__loop.run_forever, name='device-io-loop',
+                                 daemon=True).start()
+            return self.__loop
+
+    def in_loop(self):
+        """Called from the loop thread (where blocking is not allowed)."""
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+
+    def run(self, coro, timeout=None):
+        """Run the coroutine in the loop, block until it's done and return its result."""
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("Blocking call from the device I/O loop.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def call_soon(self, fn, *args):
+        """Run the (non-blocking) callback in the loop thread."""
+        return self.loop.call_soon_threadsafe(fn, *args)
+
+    def dispatch(self, fn, *args):
+        """
+        Run a blocking callback (e.g. a model update) outside the loop, all of
+        them in one thread, in the order they were dispatched.
+        """
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error(f"Dispatched '{fn}' failed: {e}")
+        return self.__dispatcher.submit(run)
+
+
+IO_LOOP = EventLoopThread()
@@ -57,6 +57,9 @@ class MockedDevice(Device):
             }
         }
 
+    async def _send_raw_async(self, data):
+        return self._send_raw(data)  # nothing blocks
+
     def _init(self):
         super()._init()
 
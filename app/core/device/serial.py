@@ -1,15 +1,25 @@
+import asyncio
 import glob
+import itertools
 import json
 import logging
+import os
 import re
 import termios
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from enum import Enum
+from functools import partial
 
 from serial import Serial, SerialException
 
 from app import Config
-from app.core.device import Device, DeviceType, DeviceException, DeviceCommunicationException,  Command
+from app.core.device import Device, DeviceType, DeviceException, DeviceCommunicationException,  Command, \
+    probe, setting
+from app.core.device.loop import IO_LOOP
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +28,18 @@ baud_rate = Config.BAUD_RATE
 serial_prefix = Config.SERIAL_PREFIX
 
 
+class Protocol(Enum):
+    """
+    LEGACY: one bare JSON request at a time, the response is the next line.
+    FRAMED: newline-terminated JSON requests with an 'id', echoed back by the
+    device, so requests can be written back-to-back and matched by id.
+    AUTO: framed if the device echoes the 'id' of the first request, else legacy.
+    """
+    AUTO = "auto"
+    LEGACY = "legacy"
+    FRAMED = "framed"
+
+
 class DeviceSerialException(DeviceException):
     """Something wrong with serial connection"""
     pass
@@ -34,19 +56,33 @@ class DeviceNotRespondingException(DeviceException):
 
 
 class SerialDevice(Device):
+    """
+    Each open connection is served by the shared I/O loop: it reads whatever
+    arrives and writes the queued requests once the port takes them (if the
+    port has no fd, a reader thread reads it and the callers write it). The
+    responses are handed over to the waiting requests (by 'id' or in order for
+    the legacy protocol), anything unsolicited is dispatched to the push
+    listeners. The waiting requests are only touched in the loop thread.
+    """
 
     device_type = DeviceType.SERIAL
     TIMEOUT = 5
-    WAIT_FOR_RESPONSE = 0.1
 
     __url_pattern = re.compile('^serial://(?P<port>[\w/-]+):(?P<baud>\d+)$')
 
-    def __init__(self, port, baud):
+    def __init__(self, port, baud, protocol=None):
         self.port = port
         self.baud = baud
-        self.lock = threading.Lock()
+        self.protocol = Protocol(protocol or setting('SERIAL_PROTOCOL'))
+        self.lock = threading.Lock()  # writing, if not done by the loop
+        self.legacy_lock = threading.Lock()  # legacy: one request at a time
         self.serial = None
         self.__uuid = None
+        self.__loop_io = False  # the loop writes the connection as well
+        self.__request_ids = itertools.count(1)
+        self.__pending = dict()  # (loop) request id: Future
+        self.__waiting = deque()  # (loop) Futures answered in order (legacy/protocol detection)
+        self.__outgoing = bytearray()  # (loop) not written yet, the port is busy
         try:
             super(SerialDevice, self).__init__()
         except DeviceCommunicationException:
@@ -73,8 +109,9 @@ class SerialDevice(Device):
         try:
             self.serial = Serial(self.port, self.baud, timeout=self.TIMEOUT)
             time.sleep(2)  # serial takes time to be ready to receive
+            self.__start_io(self.serial)
 
-            device_info = self._send_raw(self._simple_request(Command.STATUS))
+            device_info = self.__detect_protocol()
             if device_info:
                 if "uuid" in device_info:
                     self.__uuid = device_info['uuid']
@@ -89,37 +126,281 @@ class SerialDevice(Device):
             self.serial = None
             raise DeviceCommunicationException("Failed to open serial connection.", e)
 
-    # [!] one and only send method
-    def _send_raw(self, request_dict):
-        if not self.serial:
+    def __start_io(self, connection):
+        """
+        Watch the connection's fd in the shared I/O loop, which writes it too.
+        If there is none (e.g. a non-posix port) read it in a thread.
+        """
+        try:
+            fd = connection.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.__loop_io = False
+            threading.Thread(target=self.__read_loop, args=(connection,),
+                             name=f"serial-reader-{self.port}", daemon=True).start()
+        else:
+            self.__loop_io = True
+            IO_LOOP.call_soon(self.__watch, connection, fd)
+
+    def __watch(self, connection, fd):
+        """(I/O loop) Read whatever is available and handle the complete lines."""
+        loop = IO_LOOP.loop
+        buffer = bytearray()
+        if self.serial is not connection:
+            connection.close()  # reset before it was watched
+            return
+
+        def on_readable():
+            if self.serial is not connection:
+                return  # reset, see __release
+            try:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    raise SerialException("Device reports readiness to read but returned no data.")
+            except (SerialException, OSError) as e:
+                self.__closed(connection, e)
+                return
+            buffer.extend(chunk)
+            while b"\n" in buffer:
+                line, _, rest = buffer.partition(b"\n")
+                buffer[:] = rest
+                self.__handle_line(line)
+
+        loop.add_reader(fd, on_readable)
+
+    def __flush(self, connection):
+        """(I/O loop) Write what the (non-blocking) port takes, the rest once it's writable."""
+        if self.serial is not connection:
+            return  # reset, see __release
+        fd = connection.fileno()
+        try:
+            del self.__outgoing[:os.write(fd, self.__outgoing)]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.__closed(connection, e)
+            return
+        if self.__outgoing:
+            IO_LOOP.loop.add_writer(fd, self.__flush, connection)
+        else:
+            IO_LOOP.loop.remove_writer(fd)
+
+    def __release(self, connection):
+        """(I/O loop) Stop watching the reset connection and close the port."""
+        try:
+            fd = connection.fileno()
+            IO_LOOP.loop.remove_reader(fd)
+            IO_LOOP.loop.remove_writer(fd)
+        except (AttributeError, OSError, ValueError, SerialException):
+            pass  # read by a thread, or closed already
+        self.__outgoing.clear()
+        connection.close()
+        self.__fail_waiting(connection)
+
+    def __read_loop(self, connection):
+        """Reader thread, runs until the connection is reset or broken."""
+        try:
+            while self.serial is connection:
+                line = connection.readline()
+                if line.strip():  # else readline timed out
+                    IO_LOOP.call_soon(self.__handle_line, line)
+        except (SerialException, termios.error, OSError) as e:
+            if self.serial is connection:  # i.e. not reset
+                IO_LOOP.call_soon(self.__closed, connection, e)
+
+    def __handle_line(self, line):
+        """(I/O loop)"""
+        line = line.decode("utf-8", errors="replace").strip()
+        if not line:
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            log.debug(f"{self}: skipping unexpected output '{line}'")
+            return
+        if not self.__resolve(message):
+            IO_LOOP.dispatch(self._on_push, message)
+
+    def __closed(self, connection, error):
+        """(I/O loop)"""
+        log.warning(f"{self}: device got probably disconnected: {error}")
+        if self.serial is connection:
+            self.__uuid = None
+            self.reset_serial()
+        else:
+            self.__fail_waiting(connection)
+
+    def __resolve(self, message):
+        """(I/O loop) Hand the message over to its waiting request, False if it's unsolicited."""
+        has_id = type(message) is dict and 'id' in message
+        if has_id and message['id'] in self.__pending:
+            future = self.__pending.pop(message.pop('id'))
+            if future in self.__waiting:
+                self.__waiting.remove(future)
+        elif has_id:
+            log.debug(f"{self}: dropping late response '{message}'")
+            return True
+        elif self.__waiting and self.protocol != Protocol.FRAMED:
+            future = self.__waiting.popleft()
+            for request_id in [i for i, f in self.__pending.items() if f is future]:
+                del self.__pending[request_id]
+        else:
+            return False
+
+        if self.protocol == Protocol.AUTO:
+            self.protocol = Protocol.FRAMED if has_id else Protocol.LEGACY
+            log.info(f"{self}: using {self.protocol.value} protocol.")
+        try:
+            future.set_result(message)
+        except InvalidStateError:
+            pass  # cancelled (timed out) meanwhile
+        return True
+
+    def __fail_waiting(self, connection):
+        """(I/O loop)"""
+        futures = set(self.__pending.values()) | set(self.__waiting)
+        self.__pending.clear()
+        self.__waiting.clear()
+        self.__fail(futures, connection)
+
+    def __fail(self, futures, connection):
+        for future in futures:
+            try:
+                future.set_exception(DeviceCommunicationException(
+                    f"{self}: serial connection '{connection}' closed."))
+            except InvalidStateError:
+                pass
+
+    def __submit(self, connection, futures, in_order, data=None):
+        """
+        (I/O loop) Register the (request id, Future) pairs - by id and/or to be
+        answered in order - and queue the requests' data, if the loop writes.
+        """
+        if self.serial is not connection:
+            self.__fail([future for _, future in futures], connection)
+            return
+        for request_id, future in futures:
+            if request_id is not None:
+                self.__pending[request_id] = future
+            if in_order:
+                self.__waiting.append(future)
+        if data:
+            self.__outgoing.extend(data)
+            if len(self.__outgoing) == len(data):  # else waiting for the port already
+                self.__flush(connection)
+
+    def __write(self, futures, data, in_order=False):
+        """
+        Hand the requests over to the loop, which writes them (the caller does
+        if the connection is read by a thread). Never blocks the loop: it
+        neither takes a lock nor waits for the port.
+        """
+        connection = self.serial
+        if not connection:
             raise DeviceCommunicationException("Serial is None. Connection wasn't initialized"
                                                "or was broken.")
+        if self.__loop_io:
+            IO_LOOP.call_soon(self.__submit, connection, futures, in_order, data)
+            return
+        IO_LOOP.call_soon(self.__submit, connection, futures, in_order)  # before any response
+        with self.__io_errors():
+            connection.write(data)
+
+    @contextmanager
+    def __io_errors(self):
+        """Serial errors -> DeviceCommunicationException (and unresponsive device)."""
         with self.lock:
             try:
-                self.serial.flush()
-                to_write = json.dumps(request_dict).encode('utf-8')
-                self.serial.write(to_write)
-                time.sleep(self.WAIT_FOR_RESPONSE)
-                response = self.serial.readline().decode("utf-8").rstrip()
-                if not response:
-                    self.__uuid = None
-                    raise DeviceCommunicationException(
-                        "{}: response for '{}' not received..".format(self, request_dict))
-
-                return json.loads(response)
+                yield
             except SerialException as e:
                 log.warning(e)
                 self.__uuid = None
-                self.serial = None
+                self.reset_serial()
                 raise DeviceCommunicationException(e)
             except termios.error as e:
                 log.fatal("{}: device got probably disconnected".format(e))
                 self.__uuid = None
-                self.serial = None
+                self.reset_serial()
                 raise DeviceCommunicationException("Device got probably disconnected.", e)
 
+    def __wait(self, futures, requests):
+        """Responses of the (request id, Future) pairs, all within TIMEOUT."""
+        deadline = time.monotonic() + self.TIMEOUT
+        try:
+            return [future.result(timeout=max(0, deadline - time.monotonic()))
+                    for _, future in futures]
+        except FutureTimeoutError:
+            self.__uuid = None
+            IO_LOOP.call_soon(self.__forget, futures)
+            raise DeviceCommunicationException(
+                "{}: response for '{}' not received..".format(self, requests))
+
+    def __detect_protocol(self):
+        """Read the status, in AUTO mode the response decides the protocol."""
+        request = self._simple_request(Command.STATUS)
+        if self.protocol == Protocol.LEGACY:
+            return self._send_raw(request)
+
+        futures = [(next(self.__request_ids), Future())]
+        data = (json.dumps({**request, 'id': futures[0][0]}) + "\n").encode('utf-8')
+        # in AUTO mode a response without 'id' is fine as well
+        self.__write(futures, data, in_order=self.protocol == Protocol.AUTO)
+        return self.__wait(futures, [request])[0]
+
+    def __write_framed(self, requests):
+        """Write all the requests at once, return their (request id, Future) pairs."""
+        futures = []
+        frames = []
+        for request in requests:
+            request_id, future = next(self.__request_ids), Future()
+            futures.append((request_id, future))
+            frames.append(json.dumps({**request, 'id': request_id}))
+        self.__write(futures, ("\n".join(frames) + "\n").encode('utf-8'))
+        return futures
+
+    def __forget(self, futures):
+        """(I/O loop)"""
+        for request_id, future in futures:
+            self.__pending.pop(request_id, None)
+            if future in self.__waiting:
+                self.__waiting.remove(future)
+
+    def __send_legacy(self, request_dict):
+        with self.legacy_lock:
+            future = Future()
+            self.__write([(None, future)], json.dumps(request_dict).encode('utf-8'), in_order=True)
+            return self.__wait([(None, future)], [request_dict])[0]
+
+    # [!] one and only send method
+    def _send_raw(self, request_dict):
+        return self._send_many([request_dict])[0]
+
+    def _send_many(self, requests):
+        """Framed: pipelined, all requests written at once. Legacy: one by one."""
+        if self.protocol == Protocol.FRAMED:
+            return self.__wait(self.__write_framed(requests), requests)
+        return [self.__send_legacy(request) for request in requests]
+
+    async def _send_raw_async(self, request_dict):
+        """Framed, written by the loop: awaits the response without blocking a thread."""
+        if self.protocol != Protocol.FRAMED or not self.__loop_io:
+            return await super()._send_raw_async(request_dict)
+        futures = self.__write_framed([request_dict])
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(futures[0][1]), self.TIMEOUT)
+        except asyncio.TimeoutError:
+            self.__uuid = None
+            IO_LOOP.call_soon(self.__forget, futures)
+            raise DeviceCommunicationException(
+                "{}: response for '{}' not received..".format(self, request_dict))
+
     def reset_serial(self):
-        self.serial = None
+        """Drop the connection: its reader stops, the port is closed, waiting requests fail."""
+        connection, self.serial = self.serial, None
+        if connection is not None:
+            IO_LOOP.call_soon(self.__release, connection)
+
+    def close(self):
+        self.reset_serial()
 
     def _is_connected(self):
         return self.serial is not None
@@ -131,7 +412,8 @@ class SerialDevice(Device):
         return self.__repr__()
 
     def __repr__(self):
-        return f"{super().__repr__()[:-2]}, port={self.port}, baud={self.baud})>"
+        return f"{super().__repr__()[:-2]}, port={self.port}, baud={self.baud}, " \
+               f"protocol={self.protocol.value})>"
 
 
 def get_connected_devices():
@@ -140,27 +422,23 @@ def get_connected_devices():
     return devices
 
 
-def scan(exclude=None):
+def scan(exclude=None, report=False):
     """
-    Run scan for all configured serial ports
+    Run scan for all configured serial ports (concurrently).
+    :param report: return the whole ProbeReport, not just the found devices
     """
     if not exclude:
         exclude = []
     log.info("Scanning for serial devices...")
-    found_devices = []
-    for port in get_connected_devices():
-        if port in exclude:
-            log.info("{}: skipping...".format(port))
-            continue
-        try:
-            device = SerialDevice(port, baud_rate)
-        except SerialException as e:
-            log.warning(e)
-            continue
-        if device.is_responding:
-            found_devices.append(device)
-        else:
-            log.warning("{} not responding.".format(device))
-    log.info("Scan complete, found devices: {}".format(found_devices))
-    return found_devices
 
+    def connect(port):
+        device = SerialDevice(port, baud_rate)
+        if not device.is_responding:
+            device.close()
+            return None
+        return device
+
+    ports = [port for port in get_connected_devices() if port not in exclude]
+    result = probe({port: partial(connect, port) for port in ports})
+    log.info("Scan complete, found devices: {}".format(result.devices))
+    return result if report else result.devices
@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Events of some devices (all if device_ids is None) for one client."""
+
+    def __init__(self, device_ids=None, size=100):
+        self.device_ids = device_ids
+        self.__queue = queue.Queue(size)
+        self.__overflowed = False
+
+    def __repr__(self):
+        return f"<Subscription (devices={self.device_ids}, queued={self.__queue.qsize()})>"
+
+    def wants(self, e):
+        return self.device_ids is None or e.get('device_id') in self.device_ids
+
+    def put(self, e):
+        try:
+            self.__queue.put_nowait(e)
+        except queue.Full:
+            self.__overflowed = True  # a slow client
+
+    def get(self, timeout=None):
+        """
+        Next event, None on timeout. If some events were dropped meanwhile,
+        a 'resync' event instead, i.e. the client should re-fetch the state.
+        """
+        if self.__overflowed:
+            self.__overflowed = False
+            with self.__queue.mutex:
+                self.__queue.queue.clear()
+            return {'type': 'resync'}
+        try:
+            return self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """
+    Device state changes (sensor/control values, online/offline, task runs)
+    pushed to the subscribers, e.g. the /events stream. Emitted changes are
+    published once committed, i.e. as seen by the clients re-fetching them.
+    """
+    PENDING = 'events_pending'  # session.info keys
+    FLUSHED = 'events_flushed'
+
+    def __init__(self):
+        self.__subscriptions = set()
+        self.lock = threading.Lock()
+        self.listeners = []  # called with each published event
+
+    def __repr__(self):
+        return f"<EventBus (subscriptions={len(self.__subscriptions)})>"
+
+    def subscribe(self, device_ids=None):
+        subscription = Subscription(device_ids)
+        with self.lock:
+            self.__subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.__subscriptions.discard(subscription)
+
+    def publish(self, e):
+        with self.lock:
+            subscriptions = list(self.__subscriptions)
+        for subscription in subscriptions:
+            if subscription.wants(e):
+                subscription.put(e)
+        for listener in self.listeners:
+            listener(e)
+
+    def emit(self, session, target, build):
+        """
+        Event build(target) of a changed model instance, built once flushed
+        (ids assigned) and published on commit - dropped on rollback. Emitted
+        more than once in a transaction, it's published just once.
+        """
+        session.info.setdefault(self.PENDING, {})[(build, id(target))] = target
+
+    def _flushed(self, session):
+        for (build, _), target in session.info.pop(self.PENDING, {}).items():
+            try:
+                session.info.setdefault(self.FLUSHED, []).append(build(target))
+            except Exception as e:
+                log.error(f"Failed to build the event of {target}: {e}")
+
+    def _committed(self, session):
+        session.info.pop(self.PENDING, None)  # i.e. not changed after all
+        for e in session.info.pop(self.FLUSHED, []):
+            try:
+                self.publish(e)
+            except Exception as ex:
+                log.error(f"Failed to publish {e}: {ex}")
+
+    def _rolled_back(self, session):
+        session.info.pop(self.PENDING, None)
+        session.info.pop(self.FLUSHED, None)
+
+
+EVENTS = EventBus()
+
+
+@event.listens_for(Session, 'after_flush')
+def _events_flushed(session, flush_context):
+    EVENTS._flushed(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _events_committed(session):
+    EVENTS._committed(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _events_rolled_back(session):
+    EVENTS._rolled_back(session)
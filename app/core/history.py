@@ -0,0 +1,416 @@
+import logging
+import math
+from datetime import datetime
+
+from sqlalchemy import desc, func, select, type_coerce
+
+from app import db
+from app.core.cache import HISTORY_CACHE
+from app.models import HistoryItem, HistoryRollup, EpochDateTime, Sensor
+
+log = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 24 * HOUR
+ROLLUP_RESOLUTIONS = [DAY, HOUR]  # the coarsest first
+DELETE_BATCH_SIZE = 5000
+
+
+def _rollup_upsert(dialect):
+    """INSERT of rollup rows, added to the existing ones of the same period."""
+    table = HistoryRollup.__table__
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        insert = insert(table)
+        return insert.on_duplicate_key_update(
+            count=table.c.count + insert.inserted.count,
+            total=table.c.total + insert.inserted.total,
+            min_value=func.least(table.c.min_value, insert.inserted.min_value),
+            max_value=func.greatest(table.c.max_value, insert.inserted.max_value),
+            last_value=insert.inserted.last_value)
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        least, greatest = func.min, func.max  # with several arguments
+    else:
+        raise NotImplementedError(f"History rollups are not supported on '{dialect}'.")
+    insert = insert(table)
+    return insert.on_conflict_do_update(
+        index_elements=[table.c.sensor_id, table.c.resolution, table.c.timestamp],
+        set_={'count': table.c.count + insert.excluded.count,
+              'total': table.c.total + insert.excluded.total,
+              'min_value': least(table.c.min_value, insert.excluded.min_value),
+              'max_value': greatest(table.c.max_value, insert.excluded.max_value),
+              'last_value': insert.excluded.last_value})
+
+
+class HistoryStore:
+    """
+    Sensor history (time-series) access. Writes are a single executemany INSERT,
+    reads select just the (timestamp, value) columns using the (sensor_id, timestamp)
+    index - no ORM objects are built either way. Hourly and daily rollups are
+    upserted with every write, long ranges are read from them.
+    """
+
+    @staticmethod
+    def to_number(value):
+        """Numeric sample value (bool -> 1.0/0.0), None if not numeric."""
+        if type(value) in [bool, int, float]:
+            return float(value)
+        if type(value) is str:
+            if value in ["True", "true"]:
+                return 1.0
+            if value in ["False", "false"]:
+                return 0.0
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        return None
+
+    def append(self, samples, timestamp=None):
+        """
+        Bulk-insert samples, the caller commits.
+
+        :param samples: iterable of (sensor_id, value)
+        :param timestamp: naive UTC datetime shared by all samples (default: now)
+        :return: number of stored samples
+        """
+        timestamp = timestamp or datetime.utcnow()
+        rows = []
+        for sensor_id, value in samples:
+            number = self.to_number(value)
+            if number is None:
+                log.warning(f"Sensor '{sensor_id}': non-numeric value '{value}' not logged.")
+                continue
+            rows.append({'sensor_id': sensor_id, 'timestamp': timestamp, 'value': number})
+        if rows:
+            db.session.execute(HistoryItem.__table__.insert(), rows)
+            self.__bump_versions({row['sensor_id'] for row in rows})
+            self.__update_rollups(rows, timestamp)
+        return len(rows)
+
+    @staticmethod
+    def __bump_versions(sensor_ids):
+        db.session.execute(Sensor.__table__.update()
+                           .where(Sensor.id.in_(sensor_ids))
+                           .values(history_version=Sensor.history_version + 1))
+
+    @staticmethod
+    def __update_rollups(rows, timestamp):
+        """Add the rows to their rollups, upserted - concurrent appends don't conflict."""
+        epoch = EpochDateTime.to_epoch(timestamp)
+        values = {}  # sensor id: aggregate of the rows
+        for row in rows:
+            value, aggregate = row['value'], values.get(row['sensor_id'])
+            if aggregate is None:
+                values[row['sensor_id']] = {'count': 1, 'total': value, 'min_value': value,
+                                            'max_value': value, 'last_value': value}
+                continue
+            aggregate['count'] += 1
+            aggregate['total'] += value
+            aggregate['min_value'] = min(aggregate['min_value'], value)
+            aggregate['max_value'] = max(aggregate['max_value'], value)
+            aggregate['last_value'] = value
+
+        upsert = _rollup_upsert(db.engine.dialect.name)
+        for resolution in ROLLUP_RESOLUTIONS:
+            start = datetime.utcfromtimestamp(epoch - epoch % resolution)
+            db.session.execute(upsert, [{'sensor_id': sensor_id, 'resolution': resolution,
+                                         'timestamp': start, **aggregate}
+                                        for sensor_id, aggregate in values.items()])
+
+    @staticmethod
+    def get_range(sensor_id, since=None, until=None):
+        """[(timestamp, value), ...] ordered by time, both bounds inclusive."""
+        query = db.session.query(HistoryItem.timestamp, HistoryItem.value) \
+            .filter(HistoryItem.sensor_id == sensor_id)
+        if since:
+            query = query.filter(HistoryItem.timestamp >= since)
+        if until:
+            query = query.filter(HistoryItem.timestamp <= until)
+        query = query.order_by(HistoryItem.timestamp, HistoryItem.id)
+        return [(timestamp, value) for timestamp, value in query]
+
+    @staticmethod
+    def get_recent(sensor_id, count=5):
+        """Last 'count' values, the most recent first."""
+        query = db.session.query(HistoryItem.value) \
+            .filter(HistoryItem.sensor_id == sensor_id) \
+            .order_by(desc(HistoryItem.timestamp), desc(HistoryItem.id)) \
+            .limit(count)
+        return [value for value, in query]
+
+    @staticmethod
+    def get_bounds(sensor_id, since=None, until=None, resolution=None):
+        """
+        (first, last) sample timestamp in the range, (None, None) if empty. With
+        a 'resolution' the rollups are used: (first, last) period start.
+        """
+        model = HistoryRollup if resolution else HistoryItem
+        query = db.session.query(func.min(model.timestamp), func.max(model.timestamp)) \
+            .filter(model.sensor_id == sensor_id)
+        if resolution:
+            query = query.filter(HistoryRollup.resolution == resolution)
+            if since:
+                since = EpochDateTime.to_epoch(since)
+                since = datetime.utcfromtimestamp(since - since % resolution)
+        if since:
+            query = query.filter(model.timestamp >= since)
+        if until:
+            query = query.filter(model.timestamp <= until)
+        return tuple(query.one())
+
+    @staticmethod
+    def get_rollup_resolution(width, aligned=False):
+        """The coarsest rollup resolution not wider than 'width' (None if there's none)."""
+        for resolution in ROLLUP_RESOLUTIONS:
+            if width >= resolution and (not aligned or width % resolution == 0):
+                return resolution
+        return None
+
+    @staticmethod
+    def __raw_rows(sensor_id, since, until):
+        """(epoch, count, sum, min, max, last) per sample"""
+        epoch = type_coerce(HistoryItem.timestamp, db.Integer)
+        query = db.session.query(epoch, HistoryItem.value) \
+            .filter(HistoryItem.sensor_id == sensor_id)
+        if since:
+            query = query.filter(HistoryItem.timestamp >= since)
+        if until:
+            query = query.filter(HistoryItem.timestamp <= until)
+        query = query.order_by(HistoryItem.timestamp, HistoryItem.id).yield_per(1000)
+        for timestamp, value in query:
+            yield timestamp, 1, value, value, value, value
+
+    @staticmethod
+    def __rollup_rows(sensor_id, resolution, since, until):
+        """(epoch, count, sum, min, max, last) per rollup period overlapping the range"""
+        epoch = type_coerce(HistoryRollup.timestamp, db.Integer)
+        query = db.session.query(epoch, HistoryRollup.count, HistoryRollup.total,
+                                 HistoryRollup.min_value, HistoryRollup.max_value,
+                                 HistoryRollup.last_value) \
+            .filter(HistoryRollup.sensor_id == sensor_id,
+                    HistoryRollup.resolution == resolution)
+        if since:
+            since = EpochDateTime.to_epoch(since)
+            query = query.filter(epoch >= since - since % resolution)
+        if until:
+            query = query.filter(HistoryRollup.timestamp <= until)
+        query = query.order_by(HistoryRollup.timestamp).yield_per(1000)
+        yield from query
+
+    def get_buckets(self, sensor_id, width=None, points=None, since=None, until=None):
+        """
+        Downsample the range into buckets, either 'width' seconds wide (aligned to
+        the epoch) or sized to give at most 'points' buckets (aligned to the first
+        sample). Rows are streamed and aggregated on the fly, so memory doesn't
+        depend on the size of the range.
+
+        Buckets of whole hours/days are built from the coarsest fitting rollup
+        instead of raw samples; the edge buckets then cover whole rollup periods.
+
+        :return: [{'timestamp', 'value' (=avg), 'min', 'max', 'avg', 'last', 'count'}, ...]
+        """
+        origin = 0
+        if width:
+            resolution = self.get_rollup_resolution(width, aligned=True)
+        else:
+            finest = ROLLUP_RESOLUTIONS[-1]
+            first, last = self.get_bounds(sensor_id, since=since, until=until)
+            raw = first is not None
+            if not raw:  # raw samples already cleaned-up, rollups are kept longer
+                first, last = self.get_bounds(sensor_id, since, until, resolution=finest)
+                if first is None:
+                    return []
+            origin, last = EpochDateTime.to_epoch(first), EpochDateTime.to_epoch(last)
+            width = max(1, math.ceil((last - origin + 1) / points))
+            resolution = self.get_rollup_resolution(width) or (None if raw else finest)
+            if resolution:
+                # bounds of the rollups actually read (may reach further than raw samples)
+                first, last = self.get_bounds(sensor_id, since, until, resolution=resolution)
+                if first is None:
+                    return []
+                origin = EpochDateTime.to_epoch(first)
+                last = EpochDateTime.to_epoch(last) + resolution - 1
+                width = math.ceil((last - origin + 1) / points / resolution) * resolution
+
+        if resolution:
+            rows = self.__rollup_rows(sensor_id, resolution, since, until)
+        else:
+            rows = self.__raw_rows(sensor_id, since, until)
+
+        buckets = []
+        bucket = None
+        for timestamp, count, total, minimum, maximum, last in rows:
+            start = timestamp - (timestamp - origin) % width
+            if bucket is None or bucket['start'] != start:
+                bucket = {'start': start, 'min': minimum, 'max': maximum,
+                          'sum': 0.0, 'last': last, 'count': 0}
+                buckets.append(bucket)
+            bucket['min'] = min(bucket['min'], minimum)
+            bucket['max'] = max(bucket['max'], maximum)
+            bucket['sum'] += total
+            bucket['last'] = last
+            bucket['count'] += count
+
+        return [{
+            'timestamp': datetime.utcfromtimestamp(b['start']),
+            'value': b['sum'] / b['count'],
+            'min': b['min'],
+            'max': b['max'],
+            'avg': b['sum'] / b['count'],
+            'last': b['last'],
+            'count': b['count'],
+        } for b in buckets]
+
+    def __invalidate(self, sensor_ids):
+        """Drop cached queries (of all processes), call after the change is committed."""
+        self.__bump_versions(sensor_ids)
+        db.session.commit()
+        for sensor_id in sensor_ids:
+            HISTORY_CACHE.invalidate(sensor_id)
+
+    @staticmethod
+    def __delete_batched(model, conditions, batch_size):
+        """DELETE matching rows, 'batch_size' rows per (committed) transaction."""
+        table = model.__table__
+        deleted = 0
+        while True:
+            batch = select(model.id).where(*conditions).limit(batch_size)
+            result = db.session.execute(table.delete().where(table.c.id.in_(batch)))
+            db.session.commit()
+            deleted += result.rowcount
+            if result.rowcount < batch_size:
+                return deleted
+
+    def delete(self, sensor_ids, since=None, until=None, batch_size=DELETE_BATCH_SIZE):
+        """
+        Delete raw samples of the sensors in the range (both bounds inclusive).
+        Runs in batches, each one committed, so the database isn't locked for long.
+
+        :return: number of deleted samples
+        """
+        conditions = [HistoryItem.sensor_id.in_(sensor_ids)]
+        if since:
+            conditions.append(HistoryItem.timestamp >= since)
+        if until:
+            conditions.append(HistoryItem.timestamp <= until)
+        deleted = self.__delete_batched(HistoryItem, conditions, batch_size)
+        self.__invalidate(sensor_ids)
+        return deleted
+
+    def delete_rollups(self, sensor_ids, since=None, until=None, resolution=None,
+                       batch_size=DELETE_BATCH_SIZE):
+        """Same as 'delete', for rollups (periods starting in the range)."""
+        conditions = [HistoryRollup.sensor_id.in_(sensor_ids)]
+        if resolution:
+            conditions.append(HistoryRollup.resolution == resolution)
+        if since:
+            conditions.append(HistoryRollup.timestamp >= since)
+        if until:
+            conditions.append(HistoryRollup.timestamp <= until)
+        deleted = self.__delete_batched(HistoryRollup, conditions, batch_size)
+        self.__invalidate(sensor_ids)
+        return deleted
+
+    def clear(self, sensor_ids, since=None, until=None, batch_size=DELETE_BATCH_SIZE):
+        """
+        Delete the sensors' history in the range (both bounds inclusive, whole
+        history by default) and keep the rollups consistent with what is left.
+
+        :return: number of deleted samples
+        """
+        if not since and not until:
+            deleted = self.delete(sensor_ids, batch_size=batch_size)
+            self.delete_rollups(sensor_ids, batch_size=batch_size)
+            return deleted
+        raw_since = self.__raw_since(sensor_ids)  # before the range is deleted
+        deleted = self.delete(sensor_ids, since=since, until=until, batch_size=batch_size)
+        self.__rebuild_rollups(sensor_ids, since, until, raw_since, batch_size)
+        return deleted
+
+    @staticmethod
+    def __raw_since(sensor_ids):
+        """Epoch of the oldest raw sample by sensor id, i.e. the rollups rebuildable since then."""
+        epoch = type_coerce(HistoryItem.timestamp, db.Integer)
+        return dict(db.session.query(HistoryItem.sensor_id, func.min(epoch))
+                    .filter(HistoryItem.sensor_id.in_(sensor_ids))
+                    .group_by(HistoryItem.sensor_id).all())
+
+    def __rebuild_rollups(self, sensor_ids, since, until, raw_since, batch_size):
+        """
+        Drop the rollup periods within the range and recompute the ones at its
+        edges from the raw samples. Edge periods older than the sensor's raw
+        samples (already cleaned up) can't be recomputed, they are left as they are.
+        """
+        since = EpochDateTime.to_epoch(since) if since else None
+        until = EpochDateTime.to_epoch(until) if until else None
+        for resolution in ROLLUP_RESOLUTIONS:
+            first = since - since % resolution if since is not None else None
+            last = until - until % resolution if until is not None else None
+            edges = set()  # periods partly in the range
+            if first is not None and first != since:
+                edges.add(first)
+                first += resolution
+            if last is not None and last + resolution - 1 != until:
+                edges.add(last)
+                last -= resolution
+            if first is None or last is None or first <= last:
+                self.delete_rollups(
+                    sensor_ids, resolution=resolution, batch_size=batch_size,
+                    since=datetime.utcfromtimestamp(first) if first is not None else None,
+                    until=datetime.utcfromtimestamp(last) if last is not None else None)
+            for edge in sorted(edges):
+                rebuildable = [sensor_id for sensor_id in sensor_ids
+                               if raw_since.get(sensor_id) is not None
+                               and raw_since[sensor_id] <= edge]
+                if rebuildable:
+                    self.__rebuild_period(rebuildable, resolution, edge, batch_size)
+        self.__invalidate(sensor_ids)
+
+    def __rebuild_period(self, sensor_ids, resolution, start, batch_size):
+        """Recompute the sensors' rollups of the period from the raw samples."""
+        timestamp = datetime.utcfromtimestamp(start)
+        self.delete_rollups(sensor_ids, resolution=resolution, since=timestamp, until=timestamp,
+                            batch_size=batch_size)
+        epoch = type_coerce(HistoryItem.timestamp, db.Integer)
+        query = db.session.query(HistoryItem.sensor_id, HistoryItem.value) \
+            .filter(HistoryItem.sensor_id.in_(sensor_ids),
+                    epoch >= start, epoch < start + resolution) \
+            .order_by(HistoryItem.timestamp, HistoryItem.id).yield_per(1000)
+
+        rollups = {}
+        for sensor_id, value in query:
+            rollup = rollups.get(sensor_id)
+            if not rollup:
+                rollup = rollups[sensor_id] = {
+                    'sensor_id': sensor_id, 'resolution': resolution, 'timestamp': timestamp,
+                    'count': 0, 'total': 0.0, 'min_value': value, 'max_value': value}
+            rollup['count'] += 1
+            rollup['total'] += value
+            rollup['min_value'] = min(rollup['min_value'], value)
+            rollup['max_value'] = max(rollup['max_value'], value)
+            rollup['last_value'] = value
+        if rollups:
+            db.session.execute(HistoryRollup.__table__.insert(), list(rollups.values()))
+        db.session.commit()
+
+    @staticmethod
+    def incremental_vacuum():
+        """Release free pages to the OS (sqlite with 'auto_vacuum = INCREMENTAL' only)."""
+        if db.engine.dialect.name != 'sqlite':
+            log.info("Incremental vacuum is supported on sqlite only, skipping.")
+            return False
+        if db.session.execute("PRAGMA auto_vacuum").scalar() != 2:
+            log.warning("Incremental vacuum needs 'PRAGMA auto_vacuum = INCREMENTAL' "
+                        "(followed by a full VACUUM) on the database, skipping.")
+            return False
+        db.session.execute("PRAGMA incremental_vacuum")
+        db.session.commit()
+        return True
+
+
+HISTORY = HistoryStore()
@@ -1,91 +1,336 @@
+import heapq
+import itertools
 import logging
-import pprint
 import threading
-import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
 
 from app import db
-from app.core.cache import CACHE
+from app.core.cache import CACHE, SCHEDULE_CACHE
+from app.core.cron import get_phase
 from app.core.device import Device as PhysicalDevice
+from app.models import Task
 from app.system.device_mapper import DeviceMapper
-from app.core.tasks import ScheduledTask, TaskNotCreatedException
+from app.core.tasks import ScheduledTask, TaskException
 
 
 # todo: create logger for each scheduler (i.e. each device)
 log = logging.getLogger(__name__)
 
 
+class _DeviceSchedule:
+    """Engine's bookkeeping of a single registered device scheduler."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.tasks_version = 0
+        self.task_count = 0
+        self.in_flight = set()  # submitted, not yet finished (task id, None = health check)
+
+
+class SchedulingEngine:
+    """
+    Process-wide scheduling engine, shared by all device schedulers.
+
+    Keeps a single min-heap of next-fire times and a single timer thread, which
+    sleeps until the earliest entry is due. Due entries are dispatched into one
+    shared (bounded) thread pool. Device tasks are loaded from the DB only on
+    registration and when explicitly notified (task created/modified/paused...).
+    """
+
+    MIN_WORKERS = 4
+    MAX_AUTO_WORKERS = 64
+
+    def __init__(self):
+        self.__heap = []
+        self.__devices = {}
+        self.__counter = itertools.count()  # tie-breaker for equal fire times
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__executor = None
+        self.__pending = 0  # submitted, not yet finished jobs
+        self.__auto_size = False
+        self.max_workers = None
+        self.health_check_interval = None
+
+    def __repr__(self):
+        return f"<SchedulingEngine (devices={len(self.__devices)}, " \
+               f"entries={len(self.__heap)})>"
+
+    @property
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self, max_workers, health_check_interval):
+        """:param max_workers: pool size, None = sized for the number of devices"""
+        with self.__condition:
+            if self.is_running:
+                return
+            self.__auto_size = not max_workers
+            self.max_workers = max_workers or self.__workers_needed()
+            self.health_check_interval = timedelta(seconds=health_check_interval)
+            self.__executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                 thread_name_prefix='scheduler')
+            self.__thread = threading.Thread(target=self.__loop, name='scheduling-engine')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def register(self, scheduler):
+        """Start scheduling the device: health-check right away and load its tasks."""
+        with self.__condition:
+            state = _DeviceSchedule(scheduler)
+            self.__devices[scheduler.device.uuid] = state
+            self.__push(datetime.utcnow(), state, None, None)
+            self.__resize()
+        self.notify(scheduler.device.uuid)
+
+    def __workers_needed(self):
+        """A worker per device (e.g. a hung health check) plus a few for the tasks."""
+        return max(self.MIN_WORKERS, min(self.MAX_AUTO_WORKERS, len(self.__devices) + 2))
+
+    def __resize(self):
+        """(!) caller holds the condition. Grow the auto-sized pool, running jobs finish."""
+        needed = self.__workers_needed()
+        if not self.__auto_size or not self.__executor or needed <= self.max_workers:
+            return
+        previous = self.__executor
+        self.max_workers = needed
+        self.__executor = ThreadPoolExecutor(max_workers=needed, thread_name_prefix='scheduler')
+        previous.shutdown(wait=False)
+
+    def unregister(self, uuid):
+        """All the device's heap entries become stale and are dropped lazily."""
+        with self.__condition:
+            self.__devices.pop(uuid, None)
+            self.__condition.notify_all()
+
+    def clear(self):
+        """Unregister all devices."""
+        with self.__condition:
+            self.__devices.clear()
+            self.__condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until all the already submitted jobs are finished."""
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__pending, timeout=timeout)
+
+    def notify(self, uuid):
+        """Device's tasks changed - (re)load them from the DB in the background."""
+        with self.__condition:
+            state = self.__devices.get(uuid)
+            if not state or not self.__executor:
+                return
+            state.tasks_version += 1
+            version = state.tasks_version
+        self.__submit(self.__reload, state, version)
+
+    def notify_devices(self, device_ids):
+        with self.__condition:
+            uuids = [uuid for uuid, state in self.__devices.items()
+                     if state.scheduler.device_id in device_ids]
+        for uuid in uuids:
+            self.notify(uuid)
+
+    def task_count(self, uuid):
+        state = self.__devices.get(uuid)
+        return state.task_count if state else 0
+
+    def __submit(self, fn, *args):
+        with self.__condition:
+            self.__pending += 1
+        self.__executor.submit(fn, *args).add_done_callback(self.__done)
+
+    def __done(self, future):
+        with self.__condition:
+            self.__pending -= 1
+            self.__condition.notify_all()
+
+    def __submit_once(self, state, key, fn, *args):
+        """(!) caller holds the condition. Skipped if the previous run is still in flight."""
+        if key in state.in_flight:
+            log.warning(f"{state.scheduler}: previous "
+                        f"{'health check' if key is None else f'run of task {key}'} "
+                        f"still running, skipping.")
+            return False
+        state.in_flight.add(key)
+        self.__pending += 1
+        self.__executor.submit(fn, *args).add_done_callback(
+            lambda future: self.__finished(state, key))
+        return True
+
+    def __finished(self, state, key):
+        with self.__condition:
+            state.in_flight.discard(key)
+            self.__pending -= 1
+            if key is None and not self.__is_stale(state, None):
+                # the next health check is due an interval after this one *finished*
+                self.__push(datetime.utcnow() + self.health_check_interval, state, None, None)
+            self.__condition.notify_all()
+
+    def __push(self, time, state, version, task):
+        """(!) caller holds the condition"""
+        heapq.heappush(self.__heap, (time, next(self.__counter), state, version, task))
+        self.__condition.notify_all()
+
+    def __is_stale(self, state, version):
+        if self.__devices.get(state.scheduler.device.uuid) is not state:
+            return True  # unregistered
+        return version is not None and version != state.tasks_version
+
+    def __reload(self, state, version):
+        try:
+            tasks = state.scheduler.get_tasks_from_db()
+            with self.__condition:
+                if self.__is_stale(state, version):
+                    return  # superseded by a newer notification
+                state.task_count = len(tasks)
+                for task in tasks:
+                    self.__push(task.scheduled_time, state, version, task)
+            log.debug(f"{state.scheduler}: {len(tasks)} tasks scheduled.")
+        except Exception as e:
+            log.error(f"{state.scheduler}: failed to load tasks: {e}")
+            traceback.print_exc()
+        finally:
+            db.session.close()
+
+    def __dispatch(self, state, version, task):
+        """(!) caller holds the condition"""
+        scheduler = state.scheduler
+        if task is None:
+            self.__submit_once(state, None, scheduler.health_check)
+            return
+
+        next_task = task.next()
+        if next_task:
+            self.__push(next_task.scheduled_time, state, version, next_task)
+        if scheduler.is_online:
+            self.__submit_once(state, task.task_id, scheduler._execute, task)
+        else:
+            log.debug(f"{scheduler}: device offline, skipping {task}")
+
+    def __loop(self):
+        log.info(f"{self}: started.")
+        with self.__condition:
+            while True:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+
+                time, _, state, version, task = self.__heap[0]
+                if self.__is_stale(state, version):
+                    heapq.heappop(self.__heap)
+                    continue
+
+                time_to_next = (time - datetime.utcnow()).total_seconds()
+                if time_to_next > 0:
+                    # woken up either by timeout or a newly pushed entry
+                    self.__condition.wait(timeout=time_to_next)
+                    continue
+
+                heapq.heappop(self.__heap)
+                try:
+                    self.__dispatch(state, version, task)
+                except Exception as e:
+                    log.error(f"{self}: dispatch of {task} failed: {e}")
+                    traceback.print_exc()
+
+
+ENGINE = SchedulingEngine()
+
+
 class Scheduler:
     """
-    1 scheduler per serial device, own thread pool...
+    1 scheduler per device, registered in the shared scheduling ENGINE.
     Creates schedule based on set up tasks and their crons.
     """
 
     def __init__(self, device: PhysicalDevice):
         self.device = DeviceMapper.from_uuid(device.uuid)
+        self.device_id = self.device.model.id
+        SCHEDULE_CACHE.invalidate(self.device_id)  # start from scratch
+        # spread interval tasks (e.g. status) of different devices across the period
+        self.phase = get_phase(device.uuid)
         self.__running = False
-        self.__should_be_running = False
+        self.__online = True
+        self.__attempts = 0
+        self.__idle_checks = 0
+        self.__tasks_version = None  # Task.schedule_version of the last DB load
 
         with current_app.app_context():
             self.MAX_WORKERS = current_app.config['MAX_WORKERS']
-            self.SAFE_INTERVAL = current_app.config['SAFE_INTERVAL']
             self.RECONNECT_ATTEMPTS = current_app.config['RECONNECT_ATTEMPTS']
             self.IDLE_INTERVAL_SECONDS = current_app.config['IDLE_INTERVAL_SECONDS']
 
-        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
-        self.__last_executed = set()
-
     def __repr__(self):
         return f"<Scheduler (device={self.device.model}, running={self.__running})>"
 
     def start(self):
         if self.is_running:
             return
-        self.__should_be_running = True
-
         self._clear_scheduler_error()
 
-        def try_run():
-            try:
-                self.__loop()
-            except Exception as e:
-                log.fatal(f"{self}: [!!!] scheduler FAILED: {e}")
-                traceback.print_exc()
-                self.__running = False
-                self.__should_be_running = False
-                self._set_scheduler_error(str(e))
-
-        t = threading.Thread(target=try_run)
-        t.daemon = True
-        t.start()
+        ENGINE.start(max_workers=self.MAX_WORKERS,
+                     health_check_interval=self.IDLE_INTERVAL_SECONDS)
+        self.__running = True
+        ENGINE.register(self)
 
     def terminate(self):
-        self.__should_be_running = False
+        ENGINE.unregister(self.device.uuid)
+        self.__running = False
+
+    def reload(self):
+        """Tasks were changed, re-schedule."""
+        ENGINE.notify(self.device.uuid)
 
     @property
     def is_running(self):
         return self.__running
 
+    @property
+    def is_online(self):
+        return self.__online
+
     def get_tasks_from_db(self):
         """
+        Tasks are compiled only once and cached (SCHEDULE_CACHE), DB is queried
+        again only when any of the device tasks changes.
         :rtype: set
         """
-        dev = self.device.model
+        schedule, generation = SCHEDULE_CACHE.get_schedule(self.device_id)
+        if schedule is None:
+            schedule = self.__compile_schedule()
+            SCHEDULE_CACHE.set_schedule(self.device_id, schedule, generation)
 
-        def __sanitize(task):
+        compiled = [(task_id, c) for task_id, (_, c) in schedule.items() if c]
+        times = ScheduledTask.get_next_times([cron for _, (cron, _) in compiled],
+                                             phase=self.phase)
+        return {ScheduledTask.from_compiled(task_id, c, time, phase=self.phase)
+                for (task_id, c), time in zip(compiled, times)}
+
+    def __compile_schedule(self):
+        """Re-use compiled tasks with an unchanged stamp, compile the rest."""
+        def __compile(task):
             try:
-                return ScheduledTask.from_db_object(task)
-            except TaskNotCreatedException as e:
+                return ScheduledTask.compile(task)
+            except TaskException as e:  # e.g. invalid cron, only this task is skipped
                 task.last_run = datetime.utcnow()
                 task.last_run_success = False
                 task.last_run_error = str(e)
                 db.session.commit()
 
-        return {task for task in [__sanitize(t) for t in dev.tasks] if task}
+        self.__tasks_version = Task.schedule_version(self.device_id)
+        schedule = {}
+        for task in self.device.model.tasks:
+            stamp = task.schedule_stamp
+            cached = SCHEDULE_CACHE.get_compiled(self.device_id, task.id, stamp)
+            schedule[task.id] = cached or (stamp, __compile(task))
+        return schedule
 
     def _set_device_offline(self):
         dev = self.device.model
@@ -105,7 +350,7 @@ class Scheduler:
     def _execute(self, task):
         """'execute task' function to be spawned in the thread executor."""
         try:
-            log.debug(f"{self.device.model.name}: executing '{task.runnable.type}' "
+            log.debug(f"{self.device.uuid}: executing '{task.runnable.type}' "
                       f"task (id={task.task_id})")
             task.runnable.run(self.device.physical)
         except Exception as e:
@@ -113,81 +358,99 @@ class Scheduler:
             traceback.print_exc()
 
     def _stop_scheduler(self, message=None):
-        """Scheduler stops itself from within the run loop."""
-        self.executor.shutdown(wait=True)
-        self.__running = False
-        self.__should_be_running = False
+        """Scheduler stops itself (from within the engine's executor)."""
+        self.terminate()
         CACHE.remove_scheduler(self.device.uuid)
         if message:
             self._set_scheduler_error(message)
 
-    def __loop(self):
+    def __check_tasks_version(self):
+        """Tasks changed by another process (e.g. a different web worker) -> reload."""
+        version = Task.schedule_version(self.device_id)
+        if self.__tasks_version is not None and version != self.__tasks_version:
+            log.info(f"{self}: tasks changed in the DB, re-scheduling...")
+            SCHEDULE_CACHE.invalidate(self.device_id)
+            self.reload()
+        self.__tasks_version = version
+
+    def health_check(self):
         """
-        * grabs device tasks from DB
-        * sorts by which is to be scheduled the earliest
-        * wait until at least '< safe interval'
-        * execute
+        Periodically run by the engine:
+        * device offline -> tasks are skipped, stop after too many attempts
+          (while its circuit is open, the device is not checked and it doesn't count)
+        * no tasks for quite some time -> stop
         """
-        attempts = 0
-        no_task_retry_limit = 0
-        self.__running = True
-        while self.__should_be_running:
-            # 1) Health-check
-            if not self.device.physical.health_check():
+        try:
+            physical = self.device.physical
+            checked = physical.breaker.available  # not checked at all while the circuit is open
+            if not physical.health_check():
+                self.__online = False
                 self._set_device_offline()
-                attempts += 1
-                if attempts > self.RECONNECT_ATTEMPTS:
+                if not checked:
+                    log.debug(f"{self}: device offline, retry in {physical.breaker.retry_in:.1f}s.")
+                    return
+                self.__attempts += 1
+                if self.__attempts > self.RECONNECT_ATTEMPTS:
                     log.warning(f"{self}: device offline, stopping scheduling...")
                     self._stop_scheduler(message="Device offline.")
                     return
-                to_be_scheduled = set()
-                log.warning(f"{self}: device offline, schedule cleared "
-                            f"(attempts={attempts}/{self.RECONNECT_ATTEMPTS}).")
+                log.warning(f"{self}: device offline, skipping tasks "
+                            f"(attempts={self.__attempts}/{self.RECONNECT_ATTEMPTS}).")
             else:
-                attempts = 0
-                to_be_scheduled = self.get_tasks_from_db() \
-                    .difference(self.__last_executed)
-
-            # 2) handle tasks
-            active_tasks = sorted(to_be_scheduled, key=lambda t: t.scheduled_time)
-            log.debug(f"{self}: {len(active_tasks)} active tasks: \n"
-                      f"{pprint.pformat(active_tasks)}")
-            for task in active_tasks:
-                time_to_next = task.scheduled_time - datetime.utcnow()
-                # if inside the 'safe interval' execute right away and don't wait
-                if time_to_next <= timedelta(seconds=self.SAFE_INTERVAL):
-                    self.__last_executed.add(task)
-                    self.executor.submit(self._execute, task)
-
-            active_tasks = to_be_scheduled.difference(self.__last_executed)
-            active_tasks = sorted(active_tasks, key=lambda t: t.scheduled_time)
-
-            if active_tasks:
-                no_task_retry_limit = 0
-                up_next = active_tasks[0]
-                time_to_next = up_next.scheduled_time - datetime.utcnow()
-                log.debug(f"Up-next: {up_next}, i.e. in {time_to_next}")
-            else:
-                # 3) auto-stop in case of no tasks
-                time_to_next = timedelta(seconds=self.IDLE_INTERVAL_SECONDS)
-                no_task_retry_limit += 1
-                if no_task_retry_limit > self.RECONNECT_ATTEMPTS:
-                    log.warning(
-                        f"{self}: no tasks received for quite some time, stopping scheduling...")
-                    self._stop_scheduler(message="No scheduled tasks.")
-                    return
+                self.__online = True
+                self.__attempts = 0
+
+            self.__check_tasks_version()
+            if ENGINE.task_count(self.device.uuid):
+                self.__idle_checks = 0
+                return
+            self.__idle_checks += 1
+            if self.__idle_checks > self.RECONNECT_ATTEMPTS:
+                log.warning(
+                    f"{self}: no tasks received for quite some time, stopping scheduling...")
+                self._stop_scheduler(message="No scheduled tasks.")
+        except Exception as e:
+            log.fatal(f"{self}: [!!!] scheduler FAILED: {e}")
+            traceback.print_exc()
+            self.terminate()
+            self._set_scheduler_error(str(e))
+        finally:
+            db.session.close()
+
+
+# Keep SCHEDULE_CACHE in sync with the Task table and re-schedule on commit.
+_CHANGED_TASKS = 'changed_tasks'
+
+
+def _track_changed_task(target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_CHANGED_TASKS, set()).add((target.device_id, target.id))
+
+
+@event.listens_for(Task, "after_insert")
+@event.listens_for(Task, "after_delete")
+def _task_inserted_or_deleted(mapper, connection, target):
+    _track_changed_task(target)
+
+
+@event.listens_for(Task, "after_update")
+def _task_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[item].history.has_changes() for item in Task.__schedule_items__):
+        _track_changed_task(target)
+
 
-            # 3) Time delta shenanigans
-            if not time_to_next or time_to_next.seconds >= self.IDLE_INTERVAL_SECONDS:
-                time_to_next = timedelta(seconds=self.IDLE_INTERVAL_SECONDS)
-                log.debug('Clearing last-executed')
-                self.__last_executed.clear()  # CLEANUP - prevent memory leak
+@event.listens_for(db.session, "after_commit")
+def _reschedule_changed_tasks(session):
+    changed = session.info.pop(_CHANGED_TASKS, None)
+    if not changed:
+        return
+    for device_id, task_id in changed:
+        SCHEDULE_CACHE.invalidate(device_id, task_id)
+    ENGINE.notify_devices({device_id for device_id, _ in changed})
 
-            # 4) Obligatory sleep
-            log.debug(f"{self}: sleeping for {time_to_next.total_seconds()}")
-            sleep_secs = time_to_next.total_seconds() - self.SAFE_INTERVAL
-            time.sleep(sleep_secs if sleep_secs > 0 else 0.01)
 
-        # end WHILE
-        log.info(f"{self} exiting...")
-        self._stop_scheduler()
+@event.listens_for(db.session, "after_rollback")
+def _forget_changed_tasks(session):
+    session.info.pop(_CHANGED_TASKS, None)
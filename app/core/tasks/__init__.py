@@ -1,16 +1,19 @@
 import functools
 import logging
-import math
 import traceback
 from datetime import datetime
 from enum import Enum
 
-from croniter import croniter, CroniterNotAlphaError
+from app import Config
+from app.core.cron import (
+    compile_cron, next_fire_times, CronError, IntervalExpression, INTERVAL_PREFIX
+)
 
 from app.models import Task
 from app import db
 
 AVAILABLE_TASKS = {}
+STATUS_CRON = 'status'  # keyword: each STATUS_INTERVAL_SECONDS
 
 
 class TaskException(Exception):
@@ -28,6 +31,7 @@ class TaskType(Enum):
     INTERVAL = "interval"
     STATUS = "status"
     HISTORY = "history"
+    HISTORY_CLEANUP = "history-cleanup"
     ON = "on"
     OFF = "off"
 
@@ -44,10 +48,12 @@ class ScheduledTask:
     Unique object defining a single task execution
     """
 
-    def __init__(self, task_id, scheduled_time, runnable):
+    def __init__(self, task_id, scheduled_time, runnable, cron=None, phase=0.0):
         self.task_id = task_id
         self.scheduled_time = scheduled_time
         self.runnable = runnable
+        self.cron = cron
+        self.phase = phase
 
     def __eq__(self, other):
         return self.__hash__() == other.__hash__()
@@ -58,27 +64,80 @@ class ScheduledTask:
     def __repr__(self):
         return f"<{self.runnable.type or 'N/A'} (id={self.task_id}, time={self.scheduled_time})>"
 
+    @staticmethod
+    def resolve_cron(cron):
+        """'status' keyword -> interval trigger, each STATUS_INTERVAL_SECONDS"""
+        if cron != STATUS_CRON:
+            return cron
+        from app import config
+        seconds = (config or {}).get('STATUS_INTERVAL_SECONDS') \
+            or Config.STATUS_INTERVAL_SECONDS
+        return f"{INTERVAL_PREFIX}{int(seconds)}s"
+
     @classmethod
-    def from_db_object(cls, task_db: Task):
-        """Create the object and calculate next scheduled time."""
+    def get_next_time(cls, cron, start=None, phase=0.0):
+        """
+        Next fire time (UTC) strictly after 'start' (defaults to now).
+        Phase (0-1) shifts interval triggers, crons ignore it.
+        """
+        start = start or datetime.utcnow()
+        expression = compile_cron(cls.resolve_cron(cron))
+        if isinstance(expression, IntervalExpression):
+            return expression.next_after(start, phase=phase)
+        return expression.next_after(start)
+
+    @classmethod
+    def get_next_times(cls, crons, start=None, phase=0.0):
+        """Batch version of 'get_next_time', each distinct cron is computed once."""
+        start = start or datetime.utcnow()
+        crons = [cls.resolve_cron(cron) for cron in crons]
+
+        def __is_interval(cron):
+            return cron.startswith(INTERVAL_PREFIX)
+
+        times = iter(next_fire_times([c for c in crons if not __is_interval(c)], start))
+        return [cls.get_next_time(cron, start, phase) if __is_interval(cron) else next(times)[0]
+                for cron in crons]
+
+    def next(self):
+        """
+        The following execution of the same task (no DB access needed).
+        Missed executions (e.g. system was suspended) are skipped.
+        """
+        if not self.cron:
+            return None
+        start = max(self.scheduled_time, datetime.utcnow())
+        return ScheduledTask(self.task_id, self.get_next_time(self.cron, start, self.phase),
+                             self.runnable, cron=self.cron, phase=self.phase)
+
+    @classmethod
+    def compile(cls, task_db: Task):
+        """
+        Everything needed for scheduling that doesn't change in time.
+        :return: (cron, runnable) or None for paused tasks
+        """
         if task_db.paused:
             return None
         try:
-            # if cron is set to 'status', run each 10s todo: configurable
-            if task_db.cron == 'status':
-                time = datetime.utcnow()
-                next_ten_seconds = math.ceil(time.second / 10) * 10
-                next_minute = time.minute
-                if next_ten_seconds > 50:
-                    next_ten_seconds = 0
-                    next_minute = next_minute + 1 if next_minute < 59 else 0
-                time = time.replace(second=next_ten_seconds, minute=next_minute, microsecond=0)
-            else:
-                time = croniter(task_db.cron).get_next(datetime)
-            runnable = TaskRunnable.from_database_task(task_db)
-            return ScheduledTask(task_db.id, time, runnable)
-        except CroniterNotAlphaError:
+            cls.get_next_time(task_db.cron)  # validate
+        except CronError:
             raise TaskException(f"{task_db}: invalid cron definition '{task_db.cron}'")
+        return task_db.cron, TaskRunnable.from_database_task(task_db)
+
+    @classmethod
+    def from_compiled(cls, task_id, compiled, scheduled_time=None, phase=0.0):
+        """Calculate next scheduled time of an already compiled task."""
+        cron, runnable = compiled
+        scheduled_time = scheduled_time or cls.get_next_time(cron, phase=phase)
+        return ScheduledTask(task_id, scheduled_time, runnable, cron=cron, phase=phase)
+
+    @classmethod
+    def from_db_object(cls, task_db: Task):
+        """Create the object and calculate next scheduled time."""
+        compiled = cls.compile(task_db)
+        if not compiled:
+            return None
+        return cls.from_compiled(task_db.id, compiled)
 
 
 class TaskRunnable(object):
@@ -90,7 +149,7 @@ class TaskRunnable(object):
     type = "abstract"
 
     def __init__(self, task_id: int):
-        if not db.session.query(Task).filter_by(id=task_id).first():
+        if not db.session.query(Task).get(task_id):
             raise TaskNotCreatedException(f"No such task '{task_id}'.")
         self.task_id = task_id
 
@@ -1,5 +1,8 @@
+from datetime import datetime, timedelta
+
 from app import db
 from app.core.device import Device as PhysicalDevice
+from app.core.history import HISTORY, DELETE_BATCH_SIZE
 from app.system.device_controller import Controller
 from app.models import Task
 from app.core.tasks import TaskRunnable, TaskType, TaskNotCreatedException, TaskException
@@ -27,7 +30,7 @@ class Interval(TaskRunnable):
 
     def __init__(self, task_id: int):
         super().__init__(task_id)
-        task = db.session.query(Task).filter_by(id=task_id).first()
+        task = db.session.query(Task).get(task_id)
         if not task.sensor:
             raise TaskNotCreatedException(f"Sensor needed for '{self.type}' task.")
         if not task.control:
@@ -92,22 +95,67 @@ class Status(TaskRunnable):
 
 
 class HistoryLogger(TaskRunnable):
-    """Log sensor values."""
+    """Read & log sensor values (the hourly/daily rollups are updated along)."""
     type = TaskType.HISTORY.value
 
     def _run(self, device: PhysicalDevice):
         controller = Controller(device=device)
+        controller.read_sensors()
         controller.log_sensors()
         return True
 
 
+class HistoryCleanup(TaskRunnable):
+    """
+    Delete sensor history older than the retention windows. Windows (days) are
+    taken from the task metadata ('raw_retention_days', 'rollup_retention_days'),
+    defaulting to the configuration. 0 means keep forever.
+    """
+    type = TaskType.HISTORY_CLEANUP.value
+
+    def __get_days(self, task_db, key, default):
+        days = task_db.task_metadata.get(key, default)
+        try:
+            days = float(days or 0)
+        except (TypeError, ValueError):
+            raise TaskException(f"Invalid '{key}' value: '{days}'.")
+        if days < 0:
+            raise TaskException(f"Invalid '{key}' value: '{days}'.")
+        return days
+
+    def _run(self, device: PhysicalDevice):
+        from app import config
+        task_db = db.session.query(Task).get(self.task_id)
+        sensor_ids = [sensor.id for sensor in task_db.device.sensors]
+        raw_days = self.__get_days(
+            task_db, 'raw_retention_days', config.get('HISTORY_RAW_RETENTION_DAYS', 0))
+        rollup_days = self.__get_days(
+            task_db, 'rollup_retention_days', config.get('HISTORY_ROLLUP_RETENTION_DAYS', 0))
+        batch_size = config.get('HISTORY_CLEANUP_BATCH_SIZE', DELETE_BATCH_SIZE)
+        if not sensor_ids:
+            return True
+
+        now = datetime.utcnow()
+        if raw_days:
+            deleted = HISTORY.delete(
+                sensor_ids, until=now - timedelta(days=raw_days), batch_size=batch_size)
+            self.log.info(f"{device}: {deleted} history samples deleted.")
+        if rollup_days:
+            deleted = HISTORY.delete_rollups(
+                sensor_ids, until=now - timedelta(days=rollup_days), batch_size=batch_size)
+            self.log.info(f"{device}: {deleted} history rollups deleted.")
+        if config.get('HISTORY_INCREMENTAL_VACUUM', False):
+            HISTORY.incremental_vacuum()
+        return True
+
+
 class Toggle(TaskRunnable):
     """Toggle a switch."""
     type = TaskType.TOGGLE.value
 
     def __init__(self, task_id: int):
         super(Toggle, self).__init__(task_id)
-        task = db.session.query(Task).filter_by(id=task_id).first()
+        task = db.session.query(Task).get(task_id)
         if not task.control:
             raise TaskNotCreatedException(f"Control needed for '{self.type}' task.")
 
@@ -2,7 +2,7 @@ import logging
 import traceback
 
 from app import db
-from app.models import Base, Sensor, Control, Device
+from app.models import Base, Sensor, Control, Device, stamped
 
 log = logging.getLogger(__name__)
 NOT_APPLICABLE = 'N/A'
@@ -15,16 +15,19 @@ grow_properties = db.Table(
 )
 
 
+@stamped
 class GrowSystem(Base):
     __items__ = ['id', 'name', 'description', 'properties']
 
     name = db.Column(db.String(80), nullable=False)
     description = db.Column(db.String(80), nullable=True)
+    time_modified = db.Column(db.DateTime, nullable=True)
 
     properties = db.relationship('GrowProperty', secondary=grow_properties, lazy='subquery',
                                  backref=db.backref('grow_systems', lazy=True))
 
 
+@stamped
 class GrowSystemInstance(Base):
     """A grow system instance bound to an actual device, one-to-one."""
     __items__ = Base.__items__ + ['properties']
@@ -41,6 +44,7 @@ class GrowSystemInstance(Base):
 
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship(Device, backref=db.backref('grow_system', lazy=True), uselist=False)
+    time_modified = db.Column(db.DateTime, nullable=True)
 
     @staticmethod
     def create_grow_system_instance(system, device_id):
@@ -62,6 +66,7 @@ class GrowSystemInstance(Base):
         return d
 
 
+@stamped
 class GrowProperty(Base):
     """Predefined and user added property 'types': EC, pH, air temp, etc..."""
     __items__ = ['id', 'name', 'description']
@@ -72,8 +77,10 @@ class GrowProperty(Base):
 
     name = db.Column(db.String(80), nullable=False)
     description = db.Column(db.String(80), nullable=True)
+    time_modified = db.Column(db.DateTime, nullable=True)
 
 
+@stamped
 class GrowPropertyInstance(Base):
     """Actual property instances bound to the real device sensors/controls."""
     __items__ = Base.__items__ + ['control', 'sensor']
@@ -93,6 +100,7 @@ class GrowPropertyInstance(Base):
     grow_system = db.relationship(GrowSystemInstance,
                                   backref=db.backref(
                                       'properties', lazy=False, cascade='all, delete-orphan'))
+    time_modified = db.Column(db.DateTime, nullable=True)
 
     @property
     def name(self):
@@ -5,28 +5,32 @@ from flask import jsonify, request
 from app import db
 from app.grow import bp
 from app.grow.models import GrowSystem, GrowProperty, GrowSystemInstance, GrowPropertyInstance
-from app.models import Device
-from app.utils import parse_id_as_int
+from app.grow.serializers import GrowPropertySerializer, GrowSystemSerializer
+from app.models import Control, Device, Sensor, version_stamp
+from app.serializers import list_response
+from app.utils import conditional, parse_id_as_int
 
 log = logging.getLogger(__name__)
 
 
 @bp.route('/systems', methods=['GET'])
+@conditional(lambda: version_stamp((GrowSystem,), (GrowProperty,)))
 def get_system_blueprints():
-    systems = [s.dictionary for s in db.session.query(GrowSystem).all()]
-    for syst in systems:
-        syst['properties'].sort(key=lambda p: p['name'])
-    return jsonify(systems), 200
+    return list_response(GrowSystemSerializer)
 
 
 @bp.route('/properties', methods=['GET'])
+@conditional(lambda: version_stamp((GrowProperty,)))
 def get_system_properties():
-    properties = [s.dictionary for s in db.session.query(GrowProperty).all()]
-    return jsonify(properties), 200
+    return list_response(GrowPropertySerializer)
 
 
 # TODO: make this a param (filter)
 @bp.route('/systems/<int:device_id>', methods=['GET'])
+@conditional(lambda device_id: version_stamp(
+    (GrowSystemInstance, GrowSystemInstance.device_id == device_id), (GrowPropertyInstance,),
+    (GrowSystem,), (GrowProperty,), (Device, Device.id == device_id),
+    (Sensor, Sensor.device_id == device_id), (Control, Control.device_id == device_id)))
 def get_system(device_id):
     d = db.session \
         .query(GrowSystemInstance) \
@@ -0,0 +1,46 @@
+from app import db
+from app.grow.models import GrowProperty, GrowSystem, grow_properties
+from app.serializers import Serializer, encode
+
+
+class GrowPropertySerializer(Serializer):
+    model = GrowProperty
+    fields = ('id', 'name', 'description')
+
+
+class GrowSystemSerializer(Serializer):
+    model = GrowSystem
+    fields = ('id', 'name', 'description')
+    relations = ('properties',)
+
+    properties = GrowPropertySerializer()
+
+    def to_dict(self, system, properties=None):
+        """properties: already serialized (by name), taken from the relationship if not given"""
+        d = super().to_dict(system)
+        if 'properties' in self.only:
+            if properties is None:
+                properties = sorted(system.properties, key=lambda p: p.name)
+                properties = self.properties.dump(properties) if 'properties' in self.embedded \
+                    else [encode(p.id) for p in properties]
+            d['properties'] = properties
+        return d
+
+    def dump_page(self, limit=None, cursor=None):
+        """Grow systems with their properties - one query each."""
+        rows, next_cursor = self.page(self.select(), limit, cursor)
+        if not rows:
+            return [], next_cursor
+        properties = {}  # by system id
+        if 'properties' in self.only:
+            system_id = grow_properties.c.grow_system_id
+            select = self.properties.select() \
+                .add_columns(system_id) \
+                .join(grow_properties, grow_properties.c.grow_property_id == GrowProperty.id) \
+                .where(system_id.between(rows[0].id, rows[-1].id)) \
+                .order_by(None).order_by(GrowProperty.name)
+            for row in db.session.execute(select):
+                item = self.properties.to_dict(row) if 'properties' in self.embedded \
+                    else encode(row.id)
+                properties.setdefault(row.grow_system_id, []).append(item)
+        return [self.to_dict(row, properties.get(row.id, [])) for row in rows], next_cursor
@@ -0,0 +1,79 @@
+"""
+JSON providers of the app (app.json, i.e. jsonify, request.json): orjson if
+installed, several times faster, the standard library otherwise - picked by
+the JSON_PROVIDER config ("auto", "orjson" or "std").
+
+Both encode the same: datetimes/dates in ISO 8601, enums by value, model
+instances as their dictionary, rows as dicts of their columns and any other
+iterable as a list. Keys keep their order, i.e. as the serializers build them.
+"""
+from datetime import date
+from enum import Enum
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library provider is used instead
+    orjson = None
+
+
+def default(obj):
+    """Objects neither encoder handles natively (orjson does datetimes & enums itself)."""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if hasattr(obj, 'dictionary'):  # app.models.Base
+        return obj.dictionary
+    if hasattr(obj, '_asdict'):  # sqlalchemy Row
+        return obj._asdict()
+    try:
+        return list(iter(obj))
+    except TypeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable") from None
+
+
+class StdJSONProvider(DefaultJSONProvider):
+    """The standard library json, the fallback if orjson is not installed."""
+    default = staticmethod(default)
+    sort_keys = False
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    orjson, responses are written as bytes right away. Like DefaultJSONProvider,
+    compact unless 'compact' is False or in debug mode.
+    """
+    compact = None
+    mimetype = 'application/json'
+
+    @staticmethod
+    def _dumps(obj, indent=False, newline=False):
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0) \
+            | (orjson.OPT_APPEND_NEWLINE if newline else 0)  # rather than copying the bytes
+        return orjson.dumps(obj, default=default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        return self._dumps(obj, indent=bool(kwargs.get('indent'))).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self._dumps(obj, indent, newline=True),
+                                        mimetype=self.mimetype)
+
+
+def json_provider(app):
+    """The provider of the app's JSON_PROVIDER config."""
+    name = app.config.get('JSON_PROVIDER', 'auto')
+    if name not in ('auto', 'orjson', 'std'):
+        raise ValueError(f"Unknown JSON_PROVIDER '{name}', expected 'auto', 'orjson' or 'std'")
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON_PROVIDER 'orjson' needs orjson installed (pip install orjson)")
+    if name == 'std' or orjson is None:
+        return StdJSONProvider(app)
+    return OrjsonProvider(app)
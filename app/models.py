@@ -1,15 +1,17 @@
+import calendar
 import json
 import logging
 import math
 from datetime import datetime
 
-from sqlalchemy import event, desc
-from sqlalchemy.orm import relationship
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import object_session, relationship
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm.collections import InstrumentedList
 
 from app import db
-from app.core.cache import CACHE
 from app.core.device import Device as PhysicalDevice
+from app.core.events import EVENTS
 from app.core.device import StatusResponse
 
 log = logging.getLogger(__name__)
@@ -24,8 +26,29 @@ class InvalidValieError(Exception):
     pass
 
 
+class EpochDateTime(TypeDecorator):
+    """Naive UTC datetime stored as integer epoch seconds."""
+    impl = db.Integer
+    cache_ok = True
+
+    @staticmethod
+    def to_epoch(value: datetime):
+        return calendar.timegm(value.utctimetuple())
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return self.to_epoch(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return datetime.utcfromtimestamp(value)
+
+
 class Base(db.Model):
     __items__ = ['id']  # use to specify REST available items
+    __stamp__ = 'time_modified'  # column of the last change, if stamped
 
     __abstract__ = True
     id = db.Column(db.Integer, primary_key=True)
@@ -86,6 +109,39 @@ class Base(db.Model):
         raise InvalidValieError(f'\'float\' cast failed for value {value}')
 
 
+def stamped(model):
+    """
+    Class decorator: the model's __stamp__ column holds the time of its last
+    actual change (see version_stamp).
+    """
+    def touch(mapper, connection, target):
+        setattr(target, model.__stamp__, datetime.utcnow())
+
+    def touch_if_modified(mapper, connection, target):
+        # (before_update is called for any dirty instance, even without net changes)
+        if inspect(target).session.is_modified(target):
+            touch(mapper, connection, target)
+
+    event.listen(model, 'before_insert', touch)
+    event.listen(model, 'before_update', touch_if_modified)
+    return model
+
+
+def version_stamp(*parts):
+    """
+    Cheap DB-side version of rows: the count and last change of each
+    (stamped model, *criteria), in a single query. Changes with any insert,
+    update or delete made by any process.
+    """
+    columns = []
+    for model, *criteria in parts:
+        columns.append(db.select(func.count(model.id)).where(*criteria).scalar_subquery())
+        columns.append(db.select(func.max(getattr(model, model.__stamp__)))
+                       .where(*criteria).scalar_subquery())
+    return tuple(db.session.execute(db.select(*columns)).one())
+
+
+@stamped
 class Sensor(Base):
     """
     A Read only sensor on the device (e.g. a temperature sensor)
@@ -97,6 +153,9 @@ class Sensor(Base):
     description = db.Column(db.String(80), nullable=True)
     _value = db.Column(db.String(80), default='-1')
     unit = db.Column(db.String(80), nullable=True)
+    time_modified = db.Column(db.DateTime, nullable=True)
+    # bumped on any history change, i.e. cached history of any process is stale
+    history_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Careful with this, could slow things down significantly.
     # history (=backref) - list of historic values
@@ -104,7 +163,7 @@ class Sensor(Base):
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship('Device',
                              backref=db.backref(
-                                 'sensors', lazy=False, cascade='all, delete-orphan'))
+                                 'sensors', lazy='selectin', cascade='all, delete-orphan'))
 
     def __repr__(self):
         return f"<Sensor (name={self.name}, value={self.last_value} {self.unit}," \
@@ -113,17 +172,22 @@ class Sensor(Base):
     @property
     def last_value(self):
         """return typed value, bool"""
+        return self.typed_value(self._value)
+
+    @classmethod
+    def typed_value(cls, value):
+        """Stored value as bool or float, if it parses."""
         try:
-            return self.parse_bool(self._value)
+            return cls.parse_bool(value)
         except TypeError:
             pass
 
         try:
-            return self.parse_float(self._value)
+            return cls.parse_float(value)
         except TypeError:
             pass
 
-        return self._value
+        return value
 
     @last_value.setter
     def last_value(self, value):
@@ -143,33 +207,14 @@ class Sensor(Base):
         self._value = str(value)
 
     def get_recent_average(self, count=5):
-        history = db.session.query(HistoryItem) \
-            .filter(HistoryItem.sensor == self) \
-            .order_by(desc(HistoryItem.id)) \
-            .limit(count) \
-            .all()
-
-        avg = sum([item.value for item in history]) / (len(history) or 1)
-        return avg
+        from app.core.history import HISTORY
+        values = HISTORY.get_recent(self.id, count=count)
+        return sum(values) / (len(values) or 1)
 
-    def get_last_values(self, since=None, count=None):
+    def get_last_values(self, since=None, count=None, until=None):
         """Return a desired number of history items as DICT since a specific timestamp"""
-        def reduce_history_item(item):
-            try:
-                return {'timestamp': item.timestamp, 'value': item.value}
-            except (KeyError, AttributeError):
-                return None
-
-        if since:
-            history = db.session.query(HistoryItem) \
-                .filter(
-                    HistoryItem.sensor == self,
-                    HistoryItem.timestamp >= since
-                ).all()
-            history = [reduce_history_item(it) for it in history]
-        else:
-            history = [reduce_history_item(it) for it in self.history]
-        history.sort(key=lambda i: i['timestamp'])
+        from app.core.history import HISTORY
+        history = HISTORY.get_range(self.id, since=since, until=until)
         if not history:
             return []
 
@@ -181,7 +226,18 @@ class Sensor(Base):
                     yield sequence[int(math.ceil(i * length / num))]
             gen = takespread(history, count)
             history = [next(gen) for _ in range(count)]
-        return history
+
+        as_bool = self.value_type == 'bool'
+        return [{'timestamp': timestamp, 'value': bool(value) if as_bool else value}
+                for timestamp, value in history]
+
+    def get_downsampled_values(self, since=None, until=None, bucket=None, points=None):
+        """
+        Return history aggregated (min/max/avg/last) into buckets, either 'bucket'
+        seconds wide or sized to produce at most 'points' items.
+        """
+        from app.core.history import HISTORY
+        return HISTORY.get_buckets(self.id, width=bucket, points=points, since=since, until=until)
 
     @property
     def value_type(self):
@@ -189,12 +245,11 @@ class Sensor(Base):
 
     @property
     def dictionary(self):
-        d = self._to_dict()
-        d['last_value'] = self.last_value
-        d['type'] = self.value_type
-        return d
+        from app.serializers import SensorSerializer
+        return SensorSerializer().to_dict(self)
 
 
+@stamped
 class Control(Base):
     """
     A controllable entity on the device (e.g. a switch)
@@ -206,11 +261,12 @@ class Control(Base):
     _state = db.Column(db.Boolean, default=False)  # deprecated
     value = db.Column(db.String(80), default=NOT_APPLICABLE)
     input = db.Column(db.String(80), nullable=True)
+    time_modified = db.Column(db.DateTime, nullable=True)
 
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship('Device',
                              backref=db.backref(
-                                 'controls', lazy=False, cascade='all, delete-orphan'))
+                                 'controls', lazy='selectin', cascade='all, delete-orphan'))
 
     def __repr__(self):
         return f"<Control (name={self.name}, device={self.device_id})>"
@@ -221,26 +277,33 @@ class Control(Base):
 
     @property
     def parsed_value(self):
-        return self.parse_value(self.value)
+        return self.typed_value(self.input, self.value)
 
     def parse_value(self, value):
         """Return appropriate type of the value, based on 'input' attribute."""
-        if self.input == 'bool':
-            return self.parse_bool(value)
-        elif self.input == 'int':
-            return self.parse_int(value)
-        elif self.input == 'float':
-            return self.parse_float(value)
+        if self.input in ['bool', 'int', 'float']:
+            return self.typed_value(self.input, value)
+        return self.value
+
+    @classmethod
+    def typed_value(cls, input, value):
+        """The value typed by the input ('bool', 'int' or 'float'), as is for others."""
+        if input == 'bool':
+            return cls.parse_bool(value)
+        elif input == 'int':
+            return cls.parse_int(value)
+        elif input == 'float':
+            return cls.parse_float(value)
         else:
-            return self.value
+            return value
 
     @property
     def dictionary(self):
-        d = self._to_dict()
-        d['value'] = self.parsed_value
-        return d
+        from app.serializers import ControlSerializer
+        return ControlSerializer().to_dict(self)
 
 
+@stamped
 class Task(Base):
     """
     A schedule-able action to be performed on the device
@@ -262,6 +325,9 @@ class Task(Base):
     last_run = db.Column(db.DateTime, nullable=True)
     last_run_success = db.Column(db.Boolean(), default=False)
     last_run_error = db.Column(db.String(80), nullable=True)
+    time_modified = db.Column(db.DateTime, nullable=True)
+    # last change of any __schedule_items__ (see schedule_version)
+    schedule_modified = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     control_id = db.Column(db.Integer, db.ForeignKey(Control.id))
     control = relationship(Control, uselist=False)
@@ -271,7 +337,11 @@ class Task(Base):
 
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship(
-        'Device', backref=db.backref('tasks', lazy=False, cascade='all, delete-orphan'))
+        'Device', backref=db.backref('tasks', lazy='selectin', cascade='all, delete-orphan'))
+
+    # attributes the compiled schedule depends on (i.e. not 'last_run', etc...)
+    __schedule_items__ = ['cron', 'type', 'paused', '_task_meta',
+                          'control_id', 'sensor_id', 'device_id']
 
     def __repr__(self):
         s = self.sensor.name if self.sensor else "NaN"
@@ -279,15 +349,22 @@ class Task(Base):
         return f"<Task (id={self.id}, name={self.name}, device={self.device_id}, " \
                f"cron={self.cron}, sensor={s}, control={c})>"
 
+    @property
+    def schedule_stamp(self):
+        return tuple(getattr(self, item) for item in self.__schedule_items__)
+
+    @classmethod
+    def schedule_version(cls, device_id):
+        """
+        Cheap DB-side stamp of the device's schedule (task count, last change),
+        changes with task edits made by any process.
+        """
+        return tuple(db.session.query(func.count(cls.id), func.max(cls.schedule_modified))
+                     .filter(cls.device_id == device_id).one())
+
     @property
     def task_metadata(self):
-        if not self._task_meta:
-            return {}
-        try:
-            return json.loads(self._task_meta) or {}
-        except (TypeError, json.JSONDecodeError) as e:
-            log.error(f"Failed to decode JSON '{self._task_meta}': {e}")
-            return {}
+        return self.load_metadata(self._task_meta)
 
     @task_metadata.setter
     def task_metadata(self, md: dict):
@@ -300,13 +377,20 @@ class Task(Base):
     def task_metadata(self):
         self._task_meta = None
 
+    @staticmethod
+    def load_metadata(task_meta):
+        if not task_meta:
+            return {}
+        try:
+            return json.loads(task_meta) or {}
+        except (TypeError, json.JSONDecodeError) as e:
+            log.error(f"Failed to decode JSON '{task_meta}': {e}")
+            return {}
+
     @property
     def dictionary(self):
-        d = self._to_dict()
-        d["meta"] = self.task_metadata
-        d["sensor"] = self.sensor.dictionary if self.sensor else None
-        d["control"] = self.control.dictionary if self.control else None
-        return d
+        from app.serializers import TaskSerializer
+        return TaskSerializer().to_dict(self)
 
     @staticmethod
     def set_success(task_id):
@@ -315,6 +399,7 @@ class Task(Base):
             t.last_run = datetime.utcnow()
             t.last_run_success = True
             t.last_run_error = None
+            EVENTS.emit(db.session(), t, task_event)
             db.session.commit()
 
     @staticmethod
@@ -324,9 +409,11 @@ class Task(Base):
             t.last_run = datetime.utcnow()
             t.last_run_success = False
             t.last_run_error = str(exception)
+            EVENTS.emit(db.session(), t, task_event)
             db.session.commit()
 
 
+@stamped
 class Device(Base):
     """
     Device
@@ -354,14 +441,18 @@ class Device(Base):
 
     @property
     def unknown_commands(self):
-        if not self._unknown_commands:
-            return {}
-        return json.loads(self._unknown_commands)
+        return self.load_unknown_commands(self._unknown_commands)
 
     @unknown_commands.setter
     def unknown_commands(self, data: dict):
         self._unknown_commands = json.dumps(data)
 
+    @staticmethod
+    def load_unknown_commands(unknown_commands):
+        if not unknown_commands:
+            return {}
+        return json.loads(unknown_commands)
+
     def put_unknown_command(self, command, value):
         # todo: thread safe?
         if not self._unknown_commands:
@@ -382,13 +473,8 @@ class Device(Base):
 
     @property
     def dictionary(self):
-        d = self._to_dict()
-        d['sensors'] = sorted([s.dictionary for s in self.sensors], key=lambda t: t['id'])
-        d['controls'] = sorted([c.dictionary for c in self.controls], key=lambda t: t['id'])
-        d['tasks'] = sorted([t.dictionary for t in self.tasks], key=lambda t: t['id'])
-        d['scheduler_running'] = CACHE.has_active_scheduler(self.uuid)
-        d['unrecognized'] = self.unknown_commands
-        return d
+        from app.serializers import DeviceSerializer
+        return DeviceSerializer().to_dict(self)
 
     def __repr__(self):
         return f"<Device (uuid={self.uuid}, name={self.name})>"
@@ -458,37 +544,102 @@ class Device(Base):
 
 
 class HistoryItem(Base):
-    """Stored sensor's history data."""
-    __items__ = None
+    """
+    Stored sensor's history data, one numeric sample per row. Bool values are
+    stored as 1.0/0.0, timestamps as UTC epoch seconds.
+    """
+    __items__ = Base.__items__ + ['timestamp', 'value']
+    __table_args__ = (
+        db.Index('ix_history_item_sensor_id_timestamp', 'sensor_id', 'timestamp'),
+    )
 
-    timestamp = db.Column(db.DateTime, nullable=True)
-    _value = db.Column(db.String(80), default='-1')
+    timestamp = db.Column(EpochDateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
 
     sensor_id = db.Column(db.Integer, db.ForeignKey('sensor.id'), nullable=False)
     sensor = db.relationship(
-        'Sensor', backref=db.backref('history', lazy=True, cascade='all, delete-orphan'))
+        'Sensor', backref=db.backref('history', lazy=True, cascade='all, delete-orphan',
+                                     passive_deletes=True))
 
-    @property
-    def dictionary(self):
-        d = self._to_dict()
-        d['value'] = self.value
-        return d
 
-    @property
-    def value(self):
-        """return typed value or string"""
-        try:
-            return self.parse_bool(self._value)
-        except TypeError:
-            pass
-        try:
-            return self.parse_float(self._value)
-        except TypeError:
-            pass
-        return self._value
+class HistoryRollup(Base):
+    """
+    Pre-aggregated sensor's history, one row per sensor, resolution and period.
+    Maintained incrementally as samples are stored (see HistoryStore.append).
+    """
+    __items__ = None
+    __table_args__ = (
+        db.UniqueConstraint('sensor_id', 'resolution', 'timestamp',
+                            name='uq_history_rollup_sensor_id_resolution_timestamp'),
+    )
+
+    resolution = db.Column(db.Integer, nullable=False)  # period length in seconds
+    timestamp = db.Column(EpochDateTime, nullable=False)  # period start
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+    last_value = db.Column(db.Float, nullable=False)
+
+    sensor_id = db.Column(db.Integer, db.ForeignKey('sensor.id'), nullable=False)
+    sensor = db.relationship(
+        'Sensor', backref=db.backref('rollups', lazy=True, cascade='all, delete-orphan',
+                                     passive_deletes=True))
+
+    def add(self, value):
+        self.count = (self.count or 0) + 1
+        self.total = (self.total or 0.0) + value
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = value if self.max_value is None else max(self.max_value, value)
+        self.last_value = value
+
+
+@event.listens_for(Sensor, "before_delete")
+def delete_sensor_history(mapper, connection, target):
+    """
+    History isn't loaded to be deleted (passive_deletes), remove it set-based.
+    Use HistoryStore.clear beforehand to delete large histories in batches.
+    """
+    for model in [HistoryItem, HistoryRollup]:
+        connection.execute(model.__table__.delete().where(model.sensor_id == target.id))
+
+
+@event.listens_for(Task, "before_update")
+def touch_task_schedule(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[item].history.has_changes() for item in Task.__schedule_items__):
+        target.schedule_modified = datetime.utcnow()
+
+
+# Live state events (see EVENTS), the data as in the REST resources
+def sensor_event(sensor):
+    return {'type': 'sensor', 'device_id': str(sensor.device_id), 'data': sensor.dictionary}
+
+
+def control_event(control):
+    return {'type': 'control', 'device_id': str(control.device_id), 'data': control.dictionary}
+
+
+def device_event(device):
+    from app.serializers import DeviceSerializer
+    data = DeviceSerializer(fields=['id', 'is_online', 'last_seen_online']).to_dict(device)
+    return {'type': 'device', 'device_id': str(device.id), 'data': data}
+
+
+def task_event(task):
+    from app.serializers import TaskSerializer
+    data = TaskSerializer(expand=[]).to_dict(task)
+    return {'type': 'task', 'device_id': str(task.device_id), 'data': data}
+
+
+def _emit_on_change(attribute, build):
+    """Emit the event of any actual change of the attribute, however it's set."""
+    def changed(target, value, oldvalue, initiator):
+        if value != oldvalue:
+            EVENTS.emit(object_session(target) or db.session(), target, build)
+    event.listen(attribute, 'set', changed, active_history=True)
 
 
-@event.listens_for(Device, "before_insert")
-@event.listens_for(Device, "before_update")
-def my_before_insert_listener(mapper, connection, target):
-    target.time_modified = datetime.utcnow()
+_emit_on_change(Sensor._value, sensor_event)
+_emit_on_change(Control.value, control_event)
+_emit_on_change(Device.is_online, device_event)
@@ -0,0 +1,263 @@
+"""
+Explicit (REST) representations of the models, encoded the same way as
+Base._to_dict. A serializer reads only its columns, so it takes a model
+instance as well as a row of its select() - listings load plain rows, one
+query per table, which is several times cheaper than building the instances.
+
+Listings (see list_response) take these query arguments:
+    fields  comma separated keys to include, all by default
+    expand  comma separated relations to embed, all by default - the others are lists of ids
+    limit   max. number of items, all by default
+    cursor  continue after the previous page, given in its X-Next-Cursor header
+"""
+from operator import attrgetter
+
+from flask import jsonify, request
+
+from app import db
+from app.core.cache import CACHE
+from app.models import Control, Device, Sensor, Task
+
+
+def encode(value):
+    """Same as Base._to_dict: JSON types as they are, anything else as a string."""
+    if value is None or type(value) in (dict, list, bool):
+        return value
+    return str(value)
+
+
+def _names(value):
+    return None if value is None else [name for name in value.split(',') if name]
+
+
+def list_args(args):
+    """(serializer options, limit, cursor) of the query arguments, raises ValueError"""
+    options = dict(fields=_names(args.get('fields')), expand=_names(args.get('expand')))
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError("'limit' must be positive")
+    cursor = args.get('cursor')
+    if cursor is not None:
+        cursor = int(cursor)
+    return options, limit, cursor
+
+
+def list_response(serializer_class, *args):
+    """
+    Listing of the request's arguments (see the module docstring), 'args'
+    are passed on to serializer.dump_page().
+    """
+    try:
+        options, limit, cursor = list_args(request.args)
+        serializer = serializer_class(**options)
+    except ValueError as e:
+        return f"Invalid listing argument: {e}", 400
+    items, next_cursor = serializer.dump_page(*args, limit=limit, cursor=cursor)
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+
+class Serializer:
+    model = None
+    fields = ()  # columns, as they are (see encode())
+    columns = ()  # other columns to_dict() reads
+    extra = ()  # keys computed by to_dict()
+    relations = ()  # nested items, embedded if expanded, ids otherwise
+
+    def __init__(self, fields=None, expand=None):
+        """fields: keys to include, expand: relations to embed (all by default)"""
+        keys = self.fields + self.extra + self.relations
+        only = set(keys if fields is None else fields)
+        expand = set(self.relations if expand is None else expand)
+        if only - set(keys):
+            raise ValueError(f"unknown field(s) {', '.join(sorted(only - set(keys)))}")
+        if expand - set(self.relations):
+            raise ValueError(f"can't expand {', '.join(sorted(expand - set(self.relations)))}")
+        self.only = only
+        self.embedded = {name for name in self.relations if name in only and name in expand}
+        self.__fields = tuple(name for name in self.fields if name in only)
+        values = attrgetter(*self.__fields) if self.__fields else lambda obj: ()
+        self.__values = values if len(self.__fields) != 1 else lambda obj: (values(obj),)
+
+    @classmethod
+    def select(cls):
+        """Rows of just the columns to_dict() reads, by id."""
+        return db.select(*[getattr(cls.model, name) for name in cls.fields + cls.columns]) \
+            .order_by(cls.model.id)
+
+    def page(self, select, limit=None, cursor=None):
+        """Rows of the select (by id) after the cursor, the next cursor if there are more."""
+        if cursor is not None:
+            select = select.where(self.model.id > cursor)
+        if limit is not None:
+            select = select.limit(limit + 1)
+        rows = db.session.execute(select).all()
+        if limit is not None and len(rows) > limit:
+            return rows[:limit], str(rows[limit - 1].id)
+        return rows, None
+
+    def to_dict(self, obj):
+        return dict(zip(self.__fields, map(encode, self.__values(obj))))
+
+    def dump(self, objects):
+        return [self.to_dict(obj) for obj in objects]
+
+    def dump_page(self, limit=None, cursor=None):
+        rows, next_cursor = self.page(self.select(), limit, cursor)
+        return self.dump(rows), next_cursor
+
+
+class SensorSerializer(Serializer):
+    model = Sensor
+    fields = ('id', 'name', 'description', 'unit')
+    columns = ('_value', 'device_id')
+    extra = ('last_value', 'type')
+
+    def to_dict(self, sensor):
+        d = super().to_dict(sensor)
+        value = Sensor.typed_value(sensor._value)
+        if 'last_value' in self.only:
+            d['last_value'] = value
+        if 'type' in self.only:
+            d['type'] = type(value).__name__
+        return d
+
+
+class ControlSerializer(Serializer):
+    model = Control
+    fields = ('id', 'name', 'description', 'input')
+    columns = ('value', 'device_id')
+    extra = ('value',)
+
+    def to_dict(self, control):
+        d = super().to_dict(control)
+        if 'value' in self.only:
+            d['value'] = Control.typed_value(control.input, control.value)
+        return d
+
+
+class TaskSerializer(Serializer):
+    model = Task
+    fields = ('id', 'name', 'cron', 'type', 'locked', 'paused', 'last_run', 'last_run_success',
+              'last_run_error', 'device_id')
+    columns = ('_task_meta', 'sensor_id', 'control_id')
+    extra = ('meta',)
+    relations = ('sensor', 'control')
+
+    sensors = SensorSerializer()
+    controls = ControlSerializer()
+
+    def to_dict(self, task, sensors=None, controls=None):
+        """
+        sensors, controls: already serialized ones by id, taken from the
+        task's relationships if not given
+        """
+        d = super().to_dict(task)
+        if 'meta' in self.only:
+            d['meta'] = Task.load_metadata(task._task_meta)
+        if 'sensor' in self.embedded:
+            if sensors is None:
+                sensors = {task.sensor_id: self.sensors.to_dict(task.sensor)} \
+                    if task.sensor else {}
+            d['sensor'] = sensors.get(task.sensor_id)
+        elif 'sensor' in self.only:
+            d['sensor'] = encode(task.sensor_id)
+        if 'control' in self.embedded:
+            if controls is None:
+                controls = {task.control_id: self.controls.to_dict(task.control)} \
+                    if task.control else {}
+            d['control'] = controls.get(task.control_id)
+        elif 'control' in self.only:
+            d['control'] = encode(task.control_id)
+        return d
+
+    def dump_page(self, device_id, limit=None, cursor=None):
+        """The device's tasks, with the sensors/controls they use."""
+        rows, next_cursor = self.page(self.select().where(Task.device_id == device_id),
+                                      limit, cursor)
+        related = {}
+        for name, serializer in (('sensor', self.sensors), ('control', self.controls)):
+            if name in self.embedded:
+                select = serializer.select().where(serializer.model.device_id == device_id)
+                related[f'{name}s'] = {row.id: serializer.to_dict(row)
+                                       for row in db.session.execute(select)}
+        return [self.to_dict(row, **related) for row in rows], next_cursor
+
+
+class DeviceSerializer(Serializer):
+    model = Device
+    fields = ('id', 'time_modified', 'last_seen_online', 'uuid', 'name', 'url', 'type',
+              'is_online', 'scheduler_error')
+    columns = ('_unknown_commands',)
+    extra = ('owned', 'scheduler_running', 'initializing', 'unrecognized')
+    relations = ('sensors', 'controls', 'tasks')
+
+    def __init__(self, fields=None, expand=None):
+        super().__init__(fields, expand)
+        self.sensors = SensorSerializer()
+        self.controls = ControlSerializer()
+        # the tasks' sensors/controls are embedded along with the device's
+        self.tasks = TaskSerializer(expand=[name[:-1] for name in self.embedded
+                                            if name in ('sensors', 'controls')])
+
+    def to_dict(self, device, sensors=None, controls=None, tasks=None):
+        """sensors, controls, tasks: already serialized, taken from the relationships if not given"""
+        d = super().to_dict(device)
+        for name, items in (('sensors', sensors), ('controls', controls), ('tasks', tasks)):
+            if name not in self.only:
+                continue
+            if items is None:
+                items = sorted(getattr(device, name), key=lambda item: item.id)
+                items = getattr(self, name).dump(items) if name in self.embedded \
+                    else [encode(item.id) for item in items]
+            d[name] = items
+        # the devices are initialized & scheduled by their owner process (see CACHE.device_state)
+        if 'owned' in self.only:
+            d['owned'] = CACHE.is_owner
+        if 'scheduler_running' in self.only or 'initializing' in self.only:
+            running, initializing = CACHE.device_state(device.uuid, device.id)
+            if 'scheduler_running' in self.only:
+                d['scheduler_running'] = running
+            if 'initializing' in self.only:
+                d['initializing'] = initializing
+        if 'unrecognized' in self.only:
+            d['unrecognized'] = Device.load_unknown_commands(device._unknown_commands)
+        return d
+
+    def __children(self, name, first_id, last_id, **kwargs):
+        """The page's sensors/controls/tasks (dicts or ids) by device id, and by their id."""
+        serializer = getattr(self, name)
+        model = serializer.model
+        expanded = name in self.embedded
+        select = serializer.select() if expanded \
+            else db.select(model.id, model.device_id).order_by(model.id)
+        select = select.where(model.device_id.between(first_id, last_id))
+        by_device, by_id = {}, {}
+        for row in db.session.execute(select):
+            by_id[row.id] = item = serializer.to_dict(row, **kwargs) if expanded \
+                else encode(row.id)
+            by_device.setdefault(row.device_id, []).append(item)
+        return by_device, by_id
+
+    def dump_page(self, limit=None, cursor=None):
+        """Devices with their sensors, controls and tasks - one query per table."""
+        rows, next_cursor = self.page(self.select(), limit, cursor)
+        if not rows:
+            return [], next_cursor
+        first_id, last_id = rows[0].id, rows[-1].id  # the page is a range of ids
+        children, loaded = {}, {}
+        for name in self.relations:
+            if name not in self.only:
+                continue
+            kwargs = {}
+            if name == 'tasks':
+                kwargs = {f'{related}s': loaded.get(f'{related}s', {})
+                          for related in self.tasks.embedded}
+            children[name], loaded[name] = self.__children(name, first_id, last_id, **kwargs)
+        return [self.to_dict(row, **{name: items.get(row.id, [])
+                                     for name, items in children.items()})
+                for row in rows], next_cursor
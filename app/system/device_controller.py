@@ -1,14 +1,16 @@
-import datetime
 import logging
+from functools import partial
 
 from app import db
-from app.core.cache import CACHE
-from app.core.device import DeviceType, DeviceException, scan
+from app.core.cache import CACHE, HISTORY_CACHE
+from app.core.history import HISTORY
+from app.core.device import Device as PhysicalDevice, DeviceType, DeviceException, \
+    StatusResponse, probe, scan
 from app.core.device.http import HttpDevice
 from app.core.device.serial import SerialDevice
 from app.core.device.mock import MockedDevice
 
-from app.models import Device, Control, Task, HistoryItem
+from app.models import Device, Control, Task, InvalidValieError
 from app.core.scheduler import Scheduler
 from app.core.tasks import TaskType
 from app.system.device_mapper import DeviceMapper
@@ -21,10 +23,22 @@ class ControllerError(Exception):
     pass
 
 
+class DeviceNotOwnedError(ControllerError):
+    """The devices are owned (talked to) by another process."""
+    pass
+
+
+def ensure_owner():
+    if not CACHE.is_owner:
+        pid = f" (pid {CACHE.owner_pid})" if CACHE.owner_pid else ""
+        raise DeviceNotOwnedError(f"Devices are owned by another process{pid}.")
+
+
 class Controller(object):
     """Wrapper for device, performs actions and updates models accordingly.
     Catches all device exceptions."""
     def __init__(self, device):
+        ensure_owner()
         try:
             self.device = DeviceMapper.from_anything(device)
         except KeyError:
@@ -66,16 +80,56 @@ class Controller(object):
         finally:
             db.session.commit()
 
+    def read_sensors(self):
+        """Read all attached sensors (one batched request) and update db models."""
+        device = self.device.model
+        sensors = device.sensors
+        try:
+            responses = self.device.physical.read_sensors(sensor.name for sensor in sensors)
+            for sensor in sensors:
+                try:
+                    sensor.last_value = responses[sensor.name].value
+                except InvalidValieError as e:
+                    log.error(f"Sensor's value not allowed: '{e}'")
+        except DeviceException as e:
+            log.error(f"{self.device.physical} read sensors failed: {e}")
+            device.is_online = False
+        finally:
+            db.session.commit()
+
     def log_sensors(self):
-        """Create history items for all attached sensors."""
-        time = datetime.datetime.utcnow()
-        for sensor in self.device.model.sensors:
-            item = HistoryItem(timestamp=time, _value=str(sensor.last_value), sensor=sensor)
-            db.session.add(item)
+        """Store current values of all attached sensors (one bulk insert)."""
+        sensors = self.device.model.sensors
+        HISTORY.append([(sensor.id, sensor.last_value) for sensor in sensors])
+        sensor_ids = [sensor.id for sensor in sensors]
         db.session.commit()
+        for sensor_id in sensor_ids:
+            HISTORY_CACHE.invalidate(sensor_id)
+
+
+def apply_push(physical_device, data):
+    """
+    Update the models with data the device sent on its own, e.g. a changed
+    sensor value: {"temp": {"type": "sensor", "value": 21.5}}. Runs in the
+    device's push thread, so the session is closed afterwards.
+    """
+    if type(data) is not dict:
+        log.debug(f"{physical_device}: ignoring push {data}")
+        return
+    status = StatusResponse.from_response_data({'status': 'ok', **data})
+    try:
+        if status.is_success:
+            Device.from_status_response(physical_device, status, create=False)
+            db.session.commit()
+    finally:
+        db.session.close()
+
+
+PhysicalDevice.push_listeners.append(apply_push)
 
 
 def register_device(url):
+    ensure_owner()
     device = HttpDevice(url=url)
 
     if not device.is_site_online():
@@ -114,8 +168,18 @@ def ensure_system_tasks_are_created(device_db):
                     type=TaskType.HISTORY.value, locked=True)
         db.session.add(task)
 
-    # 3) Create history clean-up task
-    # todo: implement
+    # 3) Create the locked history clean-up task (if not yet present and configured).
+    if not db.session.query(Task) \
+            .filter_by(device=device_db, name='history-cleanup') \
+            .first():
+        from app import config
+        configured_cron = config.get('HISTORY_CLEANUP_CRON', None)
+        if not configured_cron:
+            log.warning("HISTORY_CLEANUP_CRON not set-up, sensor history is kept forever.")
+        else:
+            task = Task(name='history-cleanup', cron=configured_cron, device=device_db,
+                        type=TaskType.HISTORY_CLEANUP.value, locked=True)
+            db.session.add(task)
 
 
 def init_device(physical_device):
@@ -138,6 +202,7 @@ def init_device(physical_device):
 
 
 def run_scheduler(uuid):
+    ensure_owner()
     if CACHE.has_active_scheduler(uuid):
         return
     physical_device = CACHE.get_active_device_by_uuid(uuid)
@@ -153,34 +218,78 @@ def run_scheduler(uuid):
     db.session.commit()
 
 
+def stop_scheduler(uuid):
+    if CACHE.has_active_scheduler(uuid):
+        CACHE.get_active_scheduler(uuid).terminate()
+        CACHE.remove_scheduler(uuid)
+
+
+def release_device(physical_device):
+    """Stop scheduling the cached device, drop it from the cache and close it."""
+    stop_scheduler(physical_device.uuid)
+    if CACHE.get_active_device_by_uuid(physical_device.uuid) is physical_device:
+        CACHE.remove_active_device(physical_device)
+    physical_device.close()
+
+
 def scan_devices():
-    """Run scan functions - for each device type."""
+    """Run scan functions - for each device type, return the ProbeReport."""
+    ensure_owner()
+    for physical_device in CACHE.get_all_active_devices():
+        release_device(physical_device)  # e.g. its serial port is scanned again
     CACHE.clear_devices()
-    found_devices = scan()
-    for device in found_devices:
+    report = scan(report=True)
+    for device in report.devices:
         if init_device(device):
             CACHE.add_active_device(device)
             run_scheduler(device.uuid)
-    return found_devices
+    return report
+
+
+def connect_device(type_, url, uuid=None):
+    """Create the physical device object and health-check it, None (closed) if unreachable."""
+    if type_ == DeviceType.SERIAL:
+        port, baud = SerialDevice.port_baud(url)
+        physical_device = SerialDevice(port=port, baud=baud)
+    elif type_ == DeviceType.WIFI:
+        physical_device = HttpDevice(url)
+    elif type_ == DeviceType.MOCK:
+        physical_device = MockedDevice(uid=uuid)
+    else:
+        raise ControllerError(f'Unsupported device type: {type_}')
+
+    try:
+        healthy = physical_device.health_check()
+    except Exception:
+        physical_device.close()
+        raise
+    if not healthy:
+        log.error(f'Unreachable device: {physical_device}')
+        physical_device.close()
+        return None
+    return physical_device
 
 
 def refresh_devices(devices=None, strict=True):
-    """Init (reconnect & cache) all devices found in the db."""
+    """
+    Init (reconnect & cache) all devices found in the db. Devices are probed
+    concurrently (see app.core.device.probe), the ProbeReport is returned.
+    """
+    ensure_owner()
     if not devices:
         devices = db.session.query(Device).all()
         log.info(f'Initializing {len(devices)} devices found in the db).')
 
+    connectors = {}
     for device in devices:
-        # 1) If cached, stop scheduling and remove.
+        # 1) If cached, stop scheduling, remove and close (it's reconnected below).
         log.info(f'Initializing {device}')
-        if CACHE.get_active_device_by_uuid(device.uuid):
+        cached = CACHE.get_active_device_by_uuid(device.uuid)
+        if cached:
             log.debug(f'Already cached, removing...')
-            if CACHE.has_active_scheduler(device.uuid):
-                CACHE.get_active_scheduler(device.uuid).terminate()
-                CACHE.remove_scheduler(device.uuid)
-            CACHE.remove_active_device(device)
+            release_device(cached)
 
-        # 2) Try to create the appropriate physical device object.
+        # 2) The appropriate physical device object is created & health-checked by the probe.
         try:
             type_ = DeviceType(device.type)
         except ValueError:
@@ -188,31 +297,31 @@ def refresh_devices(devices=None, strict=True):
                 raise ControllerError(f'Unrecognized device type: {device.type}')
             log.error(f'Unrecognized device type: {device.type}')
             continue
-
-        if type_ == DeviceType.SERIAL:
-            port, baud = SerialDevice.port_baud(device.url)
-            physical_device = SerialDevice(port=port, baud=baud)
-        elif type_ == DeviceType.WIFI:
-            physical_device = HttpDevice(device.url)
-        elif type_ == DeviceType.MOCK:
-            physical_device = MockedDevice.from_model(device)
-        else:
+        if type_ not in (DeviceType.SERIAL, DeviceType.WIFI, DeviceType.MOCK):
             if strict:
                 raise ControllerError(f'Unsupported device type: {type_}')
             log.error(f'Unsupported device type: {type_}')
             continue
+        connectors[device.id] = partial(connect_device, type_, device.url, device.uuid)
+
+    report = probe(connectors)
 
-        # 3) Health-check.
-        if not physical_device.health_check():
+    for device in devices:
+        if device.id not in connectors:
+            continue
+        physical_device = report.reachable.get(device.id)
+        if not physical_device:
             device.is_online = False
-            if strict:
-                raise ControllerError(f'Unreachable device: {physical_device}')
-            log.error(f'Unreachable device: {physical_device}')
             continue
 
-        # 4) Create the locked 'system' tasks (if not yet present).
+        # 3) Create the locked 'system' tasks (if not yet present).
         ensure_system_tasks_are_created(device)
 
         device.is_online = True
-        db.session.commit()
         CACHE.add_active_device(physical_device)
+    db.session.commit()
+
+    if strict and report.unreachable:
+        device_id, reason = next(iter(report.unreachable.items()))
+        raise ControllerError(f'Unreachable device: {device_id} ({reason})')
+    return report
@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from app import db
+from app.core.cache import CACHE
+from app.core.events import EVENTS
+from app.models import Device, Control
+from app.system.device_controller import Controller, ControllerError, DeviceNotOwnedError, \
+    ensure_owner, run_scheduler, stop_scheduler, register_device, scan_devices, refresh_devices
+
+log = logging.getLogger(__name__)
+
+OPERATIONS = dict()
+
+
+def operation(fn):
+    """Device operation, run by the owner process (see DeviceBridge.call)."""
+    OPERATIONS[fn.__name__] = fn
+    return fn
+
+
+@operation
+def action(device_id, control_id, value=None):
+    device = db.session.query(Device).get(device_id)
+    control = db.session.query(Control).get(control_id)
+    if not device or not control:
+        raise ControllerError(f"No such device/control: {device_id}/{control_id}")
+    Controller(device).action(control, value=value)
+
+
+@operation
+def start_scheduler(uuid):
+    run_scheduler(uuid)
+
+
+@operation
+def terminate_scheduler(uuid):
+    stop_scheduler(uuid)
+
+
+@operation
+def register(url):
+    register_device(url)
+
+
+@operation
+def scan():
+    return scan_devices().to_dict()
+
+
+@operation
+def refresh(device_ids=None):
+    devices = db.session.query(Device).filter(Device.id.in_(device_ids)).all() \
+        if device_ids else None
+    return refresh_devices(devices=devices).to_dict()
+
+
+@operation
+def state():
+    return CACHE.snapshot()
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One connection: requests answered in order, or a 'subscribe' stream."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                _send(self.request, {'error': "Malformed request.", 'type': 'ControllerError'})
+                continue
+            if request.get('op') == 'subscribe':
+                self.server.subscribe(self.request)
+                continue
+            _send(self.request, self.server.execute(request.get('op'), request.get('args') or {}))
+
+    def finish(self):
+        self.server.unsubscribe(self.request)
+        super().finish()
+
+
+class DeviceOwnerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the device operations to the other processes on a local Unix
+    socket, and publishes the device state (CACHE.snapshot) to subscribers
+    whenever it changes, along with the live events (EVENTS).
+    """
+    daemon_threads = True
+    PUBLISH_INTERVAL_SECONDS = 5  # re-check, e.g. a scheduler stopped on its own
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a previous owner (we hold the lock now)
+        super().__init__(path, _Handler)
+        self.path = path
+        self.__subscribers = set()
+        self.__lock = threading.Lock()
+        self.__changed = threading.Event()
+        self.__state = None
+        self.__events = queue.Queue()
+        CACHE.listeners.append(self.__changed.set)
+        EVENTS.listeners.append(self.__events.put)
+
+    def __repr__(self):
+        return f"<DeviceOwnerServer (path={self.path}, subscribers={len(self.__subscribers)})>"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='device-owner-ipc', daemon=True).start()
+        threading.Thread(target=self.__publish, name='device-owner-pub', daemon=True).start()
+        threading.Thread(target=self.__forward_events, name='device-owner-events',
+                         daemon=True).start()
+
+    def stop(self):
+        CACHE.listeners.remove(self.__changed.set)
+        EVENTS.listeners.remove(self.__events.put)
+        self.shutdown()
+        self.server_close()
+        self.__changed.set()
+        self.__events.put(None)
+        with self.__lock:
+            for connection in self.__subscribers:
+                connection.shutdown(socket.SHUT_RDWR)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    @staticmethod
+    def execute(op, args):
+        fn = OPERATIONS.get(op)
+        if not fn:
+            return {'error': f"Unknown operation: '{op}'.", 'type': 'ControllerError'}
+        try:
+            with db.app.app_context():
+                return {'result': fn(**args)}
+        except Exception as e:
+            log.error(f"Device operation '{op}' failed: {e}")
+            return {'error': str(e), 'type': type(e).__name__}
+        finally:
+            db.session.remove()
+
+    def subscribe(self, connection):
+        with self.__lock:
+            self.__subscribers.add(connection)
+            _send(connection, {'state': CACHE.snapshot()})
+
+    def unsubscribe(self, connection):
+        with self.__lock:
+            self.__subscribers.discard(connection)
+
+    def __send_all(self, message):
+        """(!) caller holds the lock"""
+        for connection in list(self.__subscribers):
+            try:
+                _send(connection, message)
+            except OSError:
+                self.__subscribers.discard(connection)
+
+    def __publish(self):
+        while self.socket.fileno() != -1:
+            self.__changed.wait(self.PUBLISH_INTERVAL_SECONDS)
+            self.__changed.clear()
+            with self.__lock:
+                state = CACHE.snapshot()
+                if state == self.__state:
+                    continue
+                self.__state = state
+                self.__send_all({'state': state})
+
+    def __forward_events(self):
+        for e in iter(self.__events.get, None):
+            with self.__lock:
+                self.__send_all({'event': e})
+
+
+class DeviceBridge:
+    """
+    Device operations of the routes: run right away in the owner process,
+    sent to the owner over its socket from the other processes. The owner's
+    device state is mirrored into CACHE.owner_state meanwhile, its events
+    are re-published to this process' EVENTS subscribers.
+    """
+    TIMEOUT = 60  # seconds, a whole scan/refresh is waited for
+    RECONNECT_SECONDS = 2
+
+    def __init__(self):
+        self.path = None
+        self.server = None
+        self.__subscriber = None
+
+    def __repr__(self):
+        return f"<DeviceBridge (path={self.path}, serving={self.server is not None})>"
+
+    def serve(self, path):
+        """Owner: serve the other processes."""
+        self.path = path
+        self.server = DeviceOwnerServer(path)
+        self.server.start()
+
+    def connect(self, path):
+        """Other processes: forward to the owner, subscribe to its state."""
+        self.path = path
+        if self.__subscriber is None or not self.__subscriber.is_alive():
+            self.__subscriber = threading.Thread(target=self.__subscribe, args=(path,),
+                                                 name='device-owner-sub', daemon=True)
+            self.__subscriber.start()
+
+    def close(self):
+        if self.server:
+            self.server.stop()
+            self.server = None
+        self.path = None
+
+    def call(self, op, **args):
+        """
+        Run the operation (see OPERATIONS) in the owner process and return its
+        (JSON) result. Its errors are raised as ControllerError.
+        """
+        if CACHE.is_owner:
+            return OPERATIONS[op](**args)
+        if not self.path:
+            ensure_owner()  # i.e. raise, there's no socket to reach the owner
+        return self.request(op, **args)
+
+    def request(self, op, **args):
+        """Send the operation to the owner process, over its socket."""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.TIMEOUT)
+                connection.connect(self.path)
+                _send(connection, {'op': op, 'args': args})
+                response = json.loads(connection.makefile('rb').readline() or 'null')
+        except (OSError, ValueError) as e:
+            raise DeviceNotOwnedError(f"Device owner not reachable ({self.path}): {e}")
+        if not response:
+            raise DeviceNotOwnedError(f"Device owner closed the connection ({self.path}).")
+        if 'error' in response:
+            if response.get('type') == DeviceNotOwnedError.__name__:
+                raise DeviceNotOwnedError(response['error'])
+            raise ControllerError(response['error'])
+        return response.get('result')
+
+    def __subscribe(self, path):
+        while self.path == path:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                    connection.connect(path)
+                    _send(connection, {'op': 'subscribe'})
+                    for line in connection.makefile('rb'):
+                        message = json.loads(line)
+                        if 'event' in message:
+                            EVENTS.publish(message['event'])
+                        else:
+                            CACHE.owner_state = message.get('state')
+            except (OSError, ValueError) as e:
+                log.debug(f"Device owner subscription ({path}) failed: {e}")
+            CACHE.owner_state = None
+            time.sleep(self.RECONNECT_SECONDS)
+
+
+BRIDGE = DeviceBridge()
@@ -1,18 +1,21 @@
+import json
 import logging
-from datetime import datetime, timedelta
-from functools import lru_cache
+from datetime import datetime
 
-from croniter import croniter, CroniterNotAlphaError, CroniterBadCronError
-from flask import jsonify, request
+from flask import current_app, jsonify, request
 
+from app.core.cron import compile_cron, CronError
 from app.core.plugins import plugin_manager
 from app.system import bp
-from app.system.device_controller import (
-    Controller, ControllerError,
-    run_scheduler, register_device, scan_devices, refresh_devices
-)
-from app.core.cache import CACHE
-from app.models import db, Device, Task, Control, Sensor, HistoryItem
+from app.system.device_controller import ControllerError, DeviceNotOwnedError
+from app.system.ipc import BRIDGE
+from app.core.cache import CACHE, HISTORY_CACHE
+from app.core.events import EVENTS
+from app.core.history import HISTORY
+from app.grow.models import GrowProperty, GrowPropertyInstance, GrowSystem, GrowSystemInstance
+from app.models import db, Device, Task, Control, Sensor, EpochDateTime, version_stamp
+from app.serializers import DeviceSerializer, TaskSerializer, list_response
+from app.utils import conditional
 
 log = logging.getLogger(__name__)
 
@@ -32,23 +35,73 @@ def root():
     # version
     # up-time
     # cache?
+    state = CACHE.state()  # the device owner's (see app.system.ipc)
     data = {
         'version': '0.0.1',
         'up-time': 2123452,
-        'active devices': [str(d) for d in CACHE.get_all_active_devices()],
-        'tasks': sorted(plugin_manager.available_tasks)
+        'active devices': state['active'] if state else None,
+        'initializing devices': len(state['initializing']) if state else None,
+        'devices owned': CACHE.is_owner,
+        'devices owner pid': CACHE.owner_pid,
+        'tasks': sorted(plugin_manager.available_tasks),
+        'history cache': HISTORY_CACHE.stats,
     }
     return jsonify(data)
 
 
+def _device_version(device_id=None, *parts):
+    """
+    Version stamp of the device(s) with their sensors, controls, tasks and the
+    owner's device state, and of any other parts (see version_stamp).
+    """
+    def part(model, column):
+        return (model,) if device_id is None else (model, column == device_id)
+
+    return version_stamp(part(Device, Device.id), part(Sensor, Sensor.device_id),
+                         part(Control, Control.device_id), part(Task, Task.device_id),
+                         *parts) + (CACHE.is_owner, CACHE.state())
+
+
+@bp.route('/events', methods=['GET'])
+def stream_events():
+    """
+    Server-Sent Events of the device state changes as they are committed:
+    'sensor'/'control' values, 'device' online/offline, 'task' run results
+    (see app.models.sensor_event, etc.). With 'devices' (comma separated ids)
+    only those devices' events. A 'resync' event means some events were
+    dropped (a slow client), i.e. re-fetch the state.
+    """
+    devices = request.args.get('devices')
+    device_ids = None if devices is None else {d for d in devices.split(',') if d}
+    keepalive = current_app.config.get('EVENTS_KEEPALIVE_SECONDS', 15)
+    subscription = EVENTS.subscribe(device_ids)
+
+    def stream():
+        try:
+            while True:
+                e = subscription.get(timeout=keepalive)
+                if e is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: {e['type']}\ndata: {json.dumps(e)}\n\n"
+        finally:
+            EVENTS.unsubscribe(subscription)
+
+    return current_app.response_class(stream(), mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache',
+                                               'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/devices', methods=['GET'])
+@conditional(_device_version)
 def all_devices():
-    devices = db.session.query(Device).all()
-    response = [d.dictionary for d in devices]
-    return jsonify(response)
+    return list_response(DeviceSerializer)
 
 
 @bp.route('/devices/<int:device_id>', methods=['GET'])
+@conditional(lambda device_id: _device_version(
+    device_id, (GrowSystemInstance, GrowSystemInstance.device_id == device_id),
+    (GrowPropertyInstance,), (GrowSystem,), (GrowProperty,)))
 def get_device(device_id):
     device = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     data = device.dictionary
@@ -71,6 +124,11 @@ def get_device(device_id):
 def delete_device(device_id):
     d = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     try:
+        BRIDGE.call('terminate_scheduler', uuid=d.uuid)
+    except DeviceNotOwnedError as e:
+        return f"Delete failed '{e}'", 503
+    try:
+        HISTORY.clear([sensor.id for sensor in d.sensors])
         db.session.delete(d)
         db.session.commit()
     except Exception as e:
@@ -79,61 +137,93 @@ def delete_device(device_id):
 
 
 @bp.route('/devices/<int:device_id>/sensors', methods=['GET'])
+@conditional(lambda device_id: version_stamp((Sensor, Sensor.device_id == device_id)))
 def get_device_sensors(device_id):
     d = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     return jsonify([s.dictionary for s in d.sensors])
 
 
-@lru_cache(maxsize=16)
-def cached_call(current_hour, sensor_id, since_, count_):
-    """Cache the least recently called histories. Assuming the client
-    mostly doesn't need very precise data, it can sent rounded-up timestamps.
-    In combination with the current hour datetime, the response can than
-    be cached here, to further lower server load."""
-    sensor = db.session.query(Sensor).filter_by(id=_get_id(sensor_id)).first_or_404()
-    return sensor.get_last_values(since=since_, count=count_)
+def _get_millis_arg(name):
+    """Optional timestamp query argument in MILLISECONDS -> naive UTC datetime."""
+    millis = request.args.get(name)
+    if not millis:
+        return None
+    return datetime.utcfromtimestamp(int(millis) / 1000)  # convert millis -> seconds
 
 
-@bp.route('/devices/<int:device_id>/sensors/<int:sensor_id>/history', methods=['GET'])
-def get_device_sensor_history(device_id, sensor_id):
-    # expect timestamp in MILLISECONDS, don't make any assumptions
-    timestamp_millis_string = request.args.get("since")
-    since_datetime = None
-    if timestamp_millis_string:
-        try:
-            since_datetime = datetime.fromtimestamp(
-                int(timestamp_millis_string)/1000  # convert millis -> seconds
-            )
-        except (TypeError, ValueError) as e:
-            return f"'{timestamp_millis_string}' Invalid value 'since' supplied: {e}", 400
-    count = None
-    if request.args.get("count"):
-        try:
-            count = int(request.args.get("count"))
-        except (TypeError, ValueError) as e:
-            return f"Invalid value 'count' supplied: {e}", 400
+def _get_positive_int_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    value = int(value)
+    if value < 1:
+        raise ValueError(f"'{name}' must be positive")
+    return value
 
-    # Don't cache the most recent queries
-    if (since_datetime and datetime.now() - since_datetime < timedelta(days=1, hours=12)) \
-       or (count and count < 100):
-        sensor = db.session.query(Sensor).filter_by(id=_get_id(sensor_id)).first_or_404()
-        return jsonify(sensor.get_last_values(since=since_datetime, count=count)), 200
 
-    # Cache the result with the current hour datetime as well.
-    now = datetime.utcnow()
-    now = datetime(now.year, now.month, now.day, now.hour, 0, 0)
-    items = cached_call(now, sensor_id, since_datetime, count)
-    return jsonify(items), 200
+def _floor_datetime(value, seconds):
+    if not value:
+        return value
+    epoch = EpochDateTime.to_epoch(value)
+    return datetime.utcfromtimestamp(epoch - epoch % seconds)
+
+
+@bp.route('/devices/<int:device_id>/sensors/<int:sensor_id>/history', methods=['GET'])
+def get_device_sensor_history(device_id, sensor_id):
+    """
+    Sensor history. With 'bucket' (seconds) or 'points' (max. number of items)
+    the history is downsampled, each item holding min/max/avg/last of its bucket.
+
+    'since'/'until' are rounded down (to the bucket or HISTORY_CACHE_GRANULARITY_SECONDS),
+    so that similar requests share a cached response. Cached responses are keyed by
+    the sensor's history version, so they are stale once the history changes in
+    any process.
+    """
+    # expect timestamps in MILLISECONDS, don't make any assumptions
+    try:
+        since_datetime = _get_millis_arg("since")
+        until_datetime = _get_millis_arg("until")
+    except (TypeError, ValueError, OverflowError) as e:
+        return f"Invalid value 'since'/'until' supplied: {e}", 400
+    try:
+        count = _get_positive_int_arg("count")
+        bucket = _get_positive_int_arg("bucket")
+        points = _get_positive_int_arg("points")
+    except (TypeError, ValueError) as e:
+        return f"Invalid value 'count'/'bucket'/'points' supplied: {e}", 400
+
+    granularity = bucket or current_app.config.get('HISTORY_CACHE_GRANULARITY_SECONDS', 60)
+    since_datetime = _floor_datetime(since_datetime, granularity)
+    until_datetime = _floor_datetime(until_datetime, granularity)
+    sensor = db.session.query(Sensor).filter_by(id=_get_id(sensor_id)).first_or_404()
+    key = (sensor_id, sensor.history_version, since_datetime, until_datetime, count, bucket,
+           points)
+    cached = HISTORY_CACHE.get(key)
+    if cached is not None:
+        return current_app.response_class(cached, mimetype='application/json'), 200
+
+    generation = HISTORY_CACHE.generation(sensor_id)
+    if bucket or points:
+        items = sensor.get_downsampled_values(
+            since=since_datetime, until=until_datetime, bucket=bucket, points=points)
+    else:
+        items = sensor.get_last_values(since=since_datetime, until=until_datetime, count=count)
+    response = jsonify(items)
+    HISTORY_CACHE.set(key, response.get_data(), tag=sensor_id, generation=generation)
+    return response, 200
 
 
 @bp.route('/devices/<int:device_id>/sensors/<int:sensor_id>/history', methods=['DELETE'])
 def clear_sensor_history(device_id, sensor_id):
+    """Delete the history, optionally only 'since'/'until' (timestamps in MILLISECONDS)."""
     sensor = db.session.query(Sensor).filter_by(id=_get_id(sensor_id)).first_or_404()
-    entire_history = db.session.query(HistoryItem).filter_by(sensor_id=sensor.id)
-    for item in entire_history:
-        db.session.delete(item)
-    db.session.commit()
-    return 'History cleared.', 200
+    try:
+        since_datetime = _get_millis_arg("since")
+        until_datetime = _get_millis_arg("until")
+    except (TypeError, ValueError, OverflowError) as e:
+        return f"Invalid value 'since'/'until' supplied: {e}", 400
+    deleted = HISTORY.clear([sensor.id], since=since_datetime, until=until_datetime)
+    return f"History cleared, {deleted} items deleted.", 200
 
 
 @bp.route('/devices/<int:device_id>/sensors/<int:sensor_id>', methods=['POST'])
@@ -152,6 +242,7 @@ def post_device_sensor(device_id, sensor_id):
 
 
 @bp.route('/devices/<int:device_id>/controls', methods=['GET'])
+@conditional(lambda device_id: version_stamp((Control, Control.device_id == device_id)))
 def get_device_controls(device_id):
     d = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     db.session.query()
@@ -175,9 +266,12 @@ def post_device_control(device_id, control_id):
 
 
 @bp.route('/devices/<int:device_id>/tasks', methods=['GET'])
+@conditional(lambda device_id: version_stamp((Task, Task.device_id == device_id),
+                                             (Sensor, Sensor.device_id == device_id),
+                                             (Control, Control.device_id == device_id)))
 def get_device_tasks(device_id):
     d = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
-    return jsonify([t.dictionary for t in d.tasks])
+    return list_response(TaskSerializer, d.id)
 
 
 @bp.route('/devices/<int:device_id>/tasks/<int:task_id>', methods=['DELETE'])
@@ -246,8 +340,8 @@ def post_device_tasks(device_id):
 
     if data.get("cron"):
         try:
-            croniter(data["cron"])
-        except (CroniterNotAlphaError, CroniterBadCronError):
+            compile_cron(data["cron"]).next_after(datetime.utcnow())
+        except CronError:
             return f"Invalid cron definition: '{data['cron']}'", 400
         task.cron = data.get("cron")
 
@@ -269,7 +363,7 @@ def post_device_tasks(device_id):
     task_info = f"<id={task.id}name={task.name}>"
 
     if created:  # start up the scheduler for the device
-        run_scheduler(device.uuid)
+        BRIDGE.call('start_scheduler', uuid=device.uuid)
     return (f"New task created: {task_info}", 201) if created \
         else (f"Task {task_info} modified: ", 200)
 
@@ -308,8 +402,11 @@ def device_action(device_id):
         .filter_by(name=data["control"], device=device_db) \
         .first_or_404(description=f"No such control {data['control']}")
     try:
-        Controller(device_db).action(control, value=data.get('value', None))
+        BRIDGE.call('action', device_id=device_db.id, control_id=control.id,
+                    value=data.get('value', None))
         return f"{device_db.name}: '{control.name}' cmd success", 200
+    except DeviceNotOwnedError as e:
+        return f"{device_db.name}: '{control.name}' cmd failed: {e}", 503
     except ControllerError as e:
         return f"{device_db.name}: '{control.name}' cmd failed: {e}", 500
 
@@ -363,6 +460,7 @@ def delete_sensor(device_id, sensor_id):
     device = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     sensor = db.session.query(Sensor).filter_by(id=_get_id(sensor_id)).first_or_404()
 
+    HISTORY.clear([sensor.id])
     name = sensor.name
     device.put_unknown_command(name, sensor.last_value)
     db.session.delete(sensor)
@@ -374,7 +472,9 @@ def delete_sensor(device_id, sensor_id):
 def device_run_scheduler(device_id):
     device_db = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     try:
-        run_scheduler(device_db.uuid)
+        BRIDGE.call('start_scheduler', uuid=device_db.uuid)
+    except DeviceNotOwnedError as e:
+        return f"{e}", 503
     except ControllerError as e:
         return f"{e}", 500
     return f"'{device_db.name}' executor started.", 200
@@ -388,7 +488,9 @@ def route_register_device():
 
     url = data['url']
     try:
-        register_device(url)
+        BRIDGE.call('register', url=url)
+    except DeviceNotOwnedError as e:
+        return f"Device registration failed: {e}", 503
     except ControllerError as e:
         return f"Device registration failed: {e}", 500
     return f"Device '{url}' registered", 201
@@ -396,9 +498,11 @@ def route_register_device():
 
 @bp.route('/devices/scan', methods=['POST'])
 def route_scan_devices():
-    """Performs scan for new (yet unrecognized) devices."""
-    found_devices = scan_devices()
-    return f"Scan complete, {len(found_devices)} found devices {found_devices}.", 200
+    """Performs scan for new (yet unrecognized) devices, returns the probe report."""
+    try:
+        return jsonify(BRIDGE.call('scan')), 200
+    except DeviceNotOwnedError as e:
+        return f"Scan failed: {e}", 503
 
 
 @bp.route('/devices/<string:device_id>/refresh', methods=['POST'])
@@ -407,7 +511,9 @@ def route_refresh_device(device_id):
     to initialize them and store in cache (if not already there)."""
     device_db = db.session.query(Device).filter_by(id=_get_id(device_id)).first_or_404()
     try:
-        refresh_devices(devices=[device_db])
+        BRIDGE.call('refresh', device_ids=[device_db.id])
+    except DeviceNotOwnedError as e:
+        return f'Failed to refresh: {e}', 503
     except ControllerError as e:
         return f'Failed to refresh: {e}', 500
     return "Refresh done", 200
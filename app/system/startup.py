@@ -0,0 +1,123 @@
+import fcntl
+import logging
+import os
+import threading
+
+from app import db
+from app.core.cache import CACHE
+from app.models import Device
+from app.system.device_controller import refresh_devices
+from app.system.ipc import BRIDGE
+
+log = logging.getLogger(__name__)
+
+
+class StartupSupervisor:
+    """
+    Initializes the db devices in a background thread, so the app serves
+    requests right away (devices report 'initializing' meanwhile). Only the
+    process holding the lock file does it, i.e. owns the devices - other
+    (e.g. gunicorn worker) processes leave the hardware alone and report
+    they don't own the devices (see CACHE.is_owner).
+    """
+
+    def __init__(self):
+        self.__lock_file = None
+        self.__thread = None
+        self.report = None
+
+    def __repr__(self):
+        return f"<StartupSupervisor (owner={self.is_owner}, running={self.is_running})>"
+
+    @property
+    def is_owner(self):
+        return self.__lock_file is not None
+
+    @property
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def acquire(self, path):
+        """
+        Try to become the device owner, the lock is held until the process exits.
+        The owner's pid is kept in the lock file, so the others can report it.
+        """
+        if self.is_owner:
+            return True
+        lock_file = open(path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.seek(0)
+            pid = lock_file.read().strip()
+            lock_file.close()
+            CACHE.set_owner(False, int(pid) if pid.isdigit() else None)
+            return False
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self.__lock_file = lock_file
+        CACHE.set_owner(True, os.getpid())
+        return True
+
+    def start(self, lock_path=None):
+        """Start initializing the devices (if this process owns them)."""
+        if lock_path and not self.acquire(lock_path):
+            log.info(f"Devices are owned by another process ({lock_path}), skipping init.")
+            return False
+        if self.is_running:
+            return True
+
+        CACHE.set_initializing([device.id for device in db.session.query(Device).all()])
+        self.__thread = threading.Thread(target=self.__run, name='startup-supervisor')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        if self.__thread:
+            self.__thread.join(timeout)
+        return not self.is_running
+
+    def __run(self):
+        try:
+            self.report = refresh_devices(strict=False)
+        except Exception as e:
+            log.exception(f"Start-up device initialization failed: {e}")
+        finally:
+            CACHE.set_initialized()
+            db.session.close()
+
+
+SUPERVISOR = StartupSupervisor()
+
+
+def start_devices(config):
+    """Start-up device initialization according to STARTUP_REFRESH."""
+    mode = config.get('STARTUP_REFRESH', 'blocking')
+    if mode == 'off':
+        return
+    if mode == 'blocking':
+        refresh_devices()
+    elif mode == 'background':
+        own_devices(config)
+    else:
+        raise ValueError(f"Unknown STARTUP_REFRESH mode: '{mode}'.")
+
+
+def own_devices(config):
+    """
+    Become the device owner (init the devices in the background and serve the
+    other processes on DEVICE_SOCKET), or forward to the owner if there is one.
+    :return: whether this process owns the devices
+    """
+    socket_path = config.get('DEVICE_SOCKET')
+    if BRIDGE.server:
+        return True
+    if not SUPERVISOR.start(lock_path=config.get('STARTUP_LOCK_FILE')):
+        if socket_path:
+            BRIDGE.connect(socket_path)
+        return False
+    if socket_path:
+        BRIDGE.serve(socket_path)
+    return True
@@ -1,5 +1,10 @@
+import hashlib
 import logging
 import traceback
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request
 
 
 log = logging.getLogger(__name__)
@@ -15,3 +20,37 @@ def parse_id_as_int(string_or_int):
             traceback.print_exc()
     log.error("Supplied id value must be 'str' or 'int'")
     return None
+
+
+def conditional(stamp):
+    """
+    Route decorator for conditional GETs: weak ETag (and Last-Modified, of the
+    datetimes in it) of stamp(**view_args) - a cheap version of everything the
+    response shows, see app.models.version_stamp. If the client's copy is
+    current, 304 Not Modified is returned before the view runs.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = stamp(*args, **kwargs)
+            etag = hashlib.sha1(repr(version).encode()).hexdigest()[:20]
+            modified = max((v for v in version if isinstance(v, datetime)), default=None)
+            if modified:
+                modified = modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+            if request.if_none_match:  # takes precedence (RFC 7232)
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                fresh = since is not None and modified is not None and modified <= since
+            if fresh:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag, weak=True)
+                if modified:
+                    response.last_modified = modified
+            return response
+        return wrapper
+    return decorator
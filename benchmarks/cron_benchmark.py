@@ -0,0 +1,53 @@
+"""
+Compiled cron expressions vs. croniter on a realistic task set: hundreds of
+devices, each with the default history logging task ('*/20 * * * *') plus a few
+user tasks.
+
+    python -m benchmarks.cron_benchmark [devices]
+"""
+import random
+import sys
+import timeit
+from datetime import datetime
+
+from croniter import croniter
+
+from app.core.cron import compile_cron, next_fire_times
+
+USER_CRONS = ['0 8 * * *', '0 20 * * *', '*/5 * * * *', '30 6 * * mon-fri', '0 */2 * * *']
+
+
+def task_set(devices):
+    random.seed(devices)
+    crons = []
+    for _ in range(devices):
+        crons.append('*/20 * * * *')
+        crons.extend(random.sample(USER_CRONS, 2))
+    return crons
+
+
+def with_croniter(crons, start):
+    return [croniter(cron, start).get_next(datetime) for cron in crons]
+
+
+def with_compiled(crons, start):
+    return [compile_cron(cron).next_after(start) for cron in crons]
+
+
+def with_batch(crons, start):
+    return next_fire_times(crons, start)
+
+
+def main(devices=300, repeat=5):
+    crons = task_set(devices)
+    start = datetime.utcnow()
+    assert with_croniter(crons, start) == with_compiled(crons, start)
+
+    print(f"{devices} devices, {len(crons)} tasks, best of {repeat}:")
+    for fn in (with_croniter, with_compiled, with_batch):
+        best = min(timeit.repeat(lambda: fn(crons, start), number=1, repeat=repeat))
+        print(f"  {fn.__name__:<14} {best * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,70 @@
+"""
+GET /devices on an in-memory db: devices with 20 sensors, 2 controls and
+the system tasks each. Request time should grow linearly with the device
+count, with the number of queries staying the same. For comparison, the
+same listing serialized from model instances (Device.dictionary).
+
+    python -m benchmarks.devices_benchmark [devices] [sensors]
+"""
+import sys
+import timeit
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.config import TestConfig
+from app.models import Control, Device, Sensor, Task
+
+
+def populate(start, stop, sensors):
+    for i in range(start, stop):
+        device = Device(name=f"device-{i}", uuid=f"uuid-{i}", type='mock', url=f"mocked://{i}")
+        for j in range(sensors):
+            sensor = Sensor(name=f"sensor-{j}", description=f"sensor {j}", unit='°C',
+                            device=device)
+            sensor.last_value = 20 + j / 10
+        switch = Control(name='switch', description='switch', input='bool', value='True',
+                         device=device)
+        Control(name='dimmer', description='dimmer', input='float', value='0.5', device=device)
+        Task(name='status', cron='status', type='status', locked=True, device=device)
+        Task(name='history-logger', cron='*/20 * * * *', type='history', locked=True,
+             device=device)
+        Task(name='toggle', cron='0 8 * * *', type='toggle', control=switch, device=device)
+        db.session.add(device)
+    db.session.commit()
+
+
+def dump_instances():
+    db.session.remove()
+    return [device.dictionary for device in db.session.query(Device)]
+
+
+def main(devices=200, sensors=20, repeat=5):
+    app = create_app(TestConfig)
+    app.debug = False  # compact JSON, as in production
+    client = app.test_client()
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: queries.append(1))
+
+    print(f"GET /devices, {sensors} sensors per device, best of {repeat}:")
+    with app.app_context():
+        db.create_all()
+        populated = 0
+        for count in sorted({devices // 4, devices // 2, devices}):
+            populate(populated, count, sensors)
+            populated = count
+            db.session.remove()
+
+            queries.clear()
+            assert len(client.get('/devices').json) == count
+            query_count = len(queries)
+            best = min(timeit.repeat(lambda: client.get('/devices'), number=1, repeat=repeat))
+            instances = min(timeit.repeat(dump_instances, number=1, repeat=repeat))
+            print(f"  {count:>5} devices {best * 1000:8.2f} ms "
+                  f"({best * 1e6 / count:6.1f} us/device, {query_count} queries), "
+                  f"from instances {instances * 1000:8.2f} ms")
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,62 @@
+"""
+Encoding the heaviest responses with each JSON provider (see app.json_provider):
+the GET /devices listing (devices with 20 sensors, 2 controls and the system
+tasks each) and a sensor's history. Encode time (best of repeat) and the
+allocations while encoding (tracemalloc peak), compact JSON as in production.
+
+    python -m benchmarks.json_benchmark [devices] [history items]
+"""
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+
+from app import create_app, db
+from app.config import TestConfig
+from app.json_provider import OrjsonProvider, StdJSONProvider, orjson
+from app.serializers import DeviceSerializer
+from benchmarks.devices_benchmark import populate
+
+
+def history(count):
+    start = datetime(2026, 1, 1)
+    return [{'timestamp': start + timedelta(seconds=20 * i, microseconds=i),
+             'value': 20 + i % 50 / 10} for i in range(count)]
+
+
+def allocated(encode):
+    tracemalloc.start()
+    encode()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(devices=200, items=50000, repeat=5):
+    app = create_app(TestConfig)
+    app.debug = False
+    providers = [StdJSONProvider] + ([OrjsonProvider] if orjson else [])
+
+    with app.app_context():
+        db.create_all()
+        populate(0, devices, 20)
+        payloads = {f"/devices ({devices} devices)": DeviceSerializer().dump_page()[0],
+                    f"history ({items} items)": history(items)}
+        db.drop_all()
+
+        for name, payload in payloads.items():
+            print(f"{name}, best of {repeat}:")
+            for provider_class in providers:
+                provider = provider_class(app)
+
+                def encode():
+                    return provider.response(payload).get_data()
+
+                size = len(encode())
+                best = min(timeit.repeat(encode, number=1, repeat=repeat))
+                print(f"  {provider_class.__name__:<16} {best * 1000:8.2f} ms, "
+                      f"{size / 1024:8.1f} KiB, allocated {allocated(encode) / 1024:8.1f} KiB")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -11,16 +11,53 @@ DEBUG = True
 # Serial connection defaults
 SERIAL_PREFIX = "ttyUSB"  # used during serial scan
 BAUD_RATE = 19200
+SERIAL_PROTOCOL = "auto"  # "framed" (request ids, pipelined), "legacy" or "auto"
+
+# Wi-Fi (HTTP) connection defaults
+HTTP_CONNECT_TIMEOUT_SECONDS = 3
+HTTP_READ_TIMEOUT_SECONDS = 10
+HTTP_POOL_SIZE = 4  # keep-alive connections per device
+HTTP_ONLINE_CHECK_TTL_SECONDS = 5  # i.e. how long is the 'site online' check trusted
+
+# Circuit breaker: a device failing repeatedly is not talked to for a while (doubled each time)
+BREAKER_FAILURE_THRESHOLD = 3  # consecutive failed commands
+BREAKER_BACKOFF_SECONDS = 5
+BREAKER_MAX_BACKOFF_SECONDS = 300
+BREAKER_JITTER = 0.2  # +-20% randomization, devices failing together are not retried together
+
+# Identical concurrent read-only requests (status, sensors) share a single round trip,
+COMMAND_COALESCE_SECONDS = 0.5  # its result is reused for this long
+
+# Device discovery (scan & refresh)
+DISCOVERY_MAX_WORKERS = 16  # devices probed simultaneously
+DISCOVERY_TIMEOUT_SECONDS = 30  # whole scan/refresh deadline, slower devices are unreachable
+
+# Start-up: "background" (serve right away, init devices in a thread), "blocking" or "off"
+STARTUP_REFRESH = "background"
+STARTUP_LOCK_FILE = os.path.join(basedir, 'devices.lock')  # only the process holding it owns the devices
+DEVICE_SOCKET = os.path.join(basedir, 'devices.sock')  # the owner serves the other processes on it
 
 # Device status
 STATUS_INTERVAL_SECONDS = 10  # i.e. how often is status issued
 SENSOR_HISTORY_LOGGING_CRON = "*/20 * * * *"  # i.e. how often is sensor's value saved
 
+# Sensor history clean-up
+HISTORY_CLEANUP_CRON = "30 3 * * *"  # i.e. when is the old history deleted
+HISTORY_RAW_RETENTION_DAYS = 90  # raw samples, 0 = keep forever
+HISTORY_ROLLUP_RETENTION_DAYS = 730  # hourly/daily rollups, 0 = keep forever
+HISTORY_CLEANUP_BATCH_SIZE = 5000  # rows deleted per transaction
+HISTORY_INCREMENTAL_VACUUM = False  # sqlite only, needs 'PRAGMA auto_vacuum = INCREMENTAL'
+
+# Sensor history query cache
+HISTORY_CACHE_TTL_SECONDS = 300
+HISTORY_CACHE_MAX_BYTES = 4 * 1024 * 1024
+HISTORY_CACHE_GRANULARITY_SECONDS = 60  # 'since'/'until' are rounded down to this
+
 # Scheduler
 RECONNECT_ATTEMPTS = 10
-IDLE_INTERVAL_SECONDS = STATUS_INTERVAL_SECONDS  # deprecated
-SAFE_INTERVAL = 1.8  # seconds left to ignore and execute right away
-MAX_WORKERS = 4  # max threads to execute simultaneously
+IDLE_INTERVAL_SECONDS = STATUS_INTERVAL_SECONDS  # i.e. how often is the device health-checked
+SAFE_INTERVAL = 1.8  # deprecated
+MAX_WORKERS = None  # threads shared by all devices, None = sized for the device count
 
 # 'Protocol' settings
 STATUS_OK = "ok"
@@ -29,7 +66,8 @@ PRECONFIGURED_COMMAND = {
     "ping": "ping",
     "status": "status",
     "control_prefix": "action_",
-    "sensor_prefix": "read_"
+    "sensor_prefix": "read_",
+    "read": "read"  # batched: {"request": "read", "sensors": [...]}
 }
 
 PLUGIN_PATHS = ["/home/jobrauer/Documents/app_pluginsqapwo"]
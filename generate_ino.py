@@ -4,6 +4,7 @@ SENSORS = ["temp", "hum", "water_level"]
 CONTROLS = ["switch_01", "switch_02"]
 ACTION_PREFIX = "action_"
 READ_PREFIX = "read_"
+READ = "read"
 
 
 def get_read_method_name(string):
@@ -38,6 +39,11 @@ def generate(sensors: list, controls: list):
         response[\"{item}\"] = {get_read_method_name(item)};""" for item in sensors
     ])
 
+    batched_read_clauses = "\n".join([
+        f"""            }} else if (name == \"{item}\") {{
+                response[\"{item}\"] = {get_read_method_name(item)};""" for item in sensors
+    ])
+
     pins_c = "\n".join([
         f"#define {item.upper()} <X> // TODO: set pin number" for item in controls
     ])
@@ -66,22 +72,38 @@ void togglePin(int PIN) {{
   }}
 }}
 
+// Framed protocol: the request 'id' (if any) is echoed in the response.
+JSONVar requestId;
+bool hasRequestId = false;
+
+void sendJson(JSONVar response) {{
+    if (hasRequestId) {{
+        response["id"] = requestId;
+    }}
+    sendResponse(JSON.stringify(response));
+}}
+
 void handleStatus() {{
     JSONVar response;
     response["status"] = "ok";
 {fill_response_sensors}
 {fill_response_controls}
-    sendResponse(JSON.stringify(response));
+    sendJson(response);
 }}
 
 void handleAction(String body) {{
 
     JSONVar myObject = JSON.parse(body);
     
+    hasRequestId = false;
     if (JSON.typeof(myObject) == "undefined") {{
         handleError("Parsing JSON failed.");
         return;
     }}
+    hasRequestId = myObject.hasOwnProperty("id");
+    if (hasRequestId) {{
+        requestId = myObject["id"];
+    }}
     if (!myObject.hasOwnProperty("request")) {{
         handleError("JSON needs to have exactly one keyword <request>");
         return;
@@ -96,7 +118,19 @@ void handleAction(String body) {{
     }}
     
     JSONVar response;
-    if (request == "info") {{
+    if (request == "{READ}") {{
+        // batched: {{"request": "{READ}", "sensors": ["temp", ...]}}
+        JSONVar names = myObject["sensors"];
+        for (int i = 0; i < names.length(); i++) {{
+            String name = (const char*) names[i];
+            if (false) {{
+{batched_read_clauses}
+            }} else {{
+                handleError("UNKNOWN_SENSOR " + name);
+                return;
+            }}
+        }}
+    }} else if (request == "info") {{
         response["uuid"]= getUuid();
 {else_if_clauses_controls}
 {else_if_clauses_sensors}
@@ -106,7 +140,7 @@ void handleAction(String body) {{
         return;
     }}
     response["status"] = "ok";
-    sendResponse(JSON.stringify(response));
+    sendJson(response);
 }}
 
 void handleError(String msg) {{
@@ -114,13 +148,13 @@ void handleError(String msg) {{
     // TODO: implement custom error fields
     message["cause"] = msg;
     
-    sendResponse(JSON.stringify(message));
+    sendJson(message);
 }}
 
 //=====================  sensors  =====================//
 
 void sendResponse(String body) {{
-    // TODO: implement
+    // TODO: implement, one response per line (e.g. Serial.println(body))
 }}
 
 String getUuid() {{
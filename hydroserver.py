@@ -1,10 +1,15 @@
+import logging
 import sys
+import time
+
+import click
 
 from app import create_app
 from app.core.cache import CACHE
 from app.models import db, Device
 
 app = create_app()
+log = logging.getLogger(__name__)
 
 
 @app.shell_context_processor
@@ -12,6 +17,17 @@ def make_shell_context():
     return {'db': db, 'Device': Device, 'cache': CACHE}
 
 
+@app.cli.command('serve-devices')
+def serve_devices():
+    """Run as the device owner, e.g. next to multiple gunicorn workers."""
+    from app.system.startup import own_devices
+    if not own_devices(app.config):
+        raise click.ClickException("Devices are owned by another process.")
+    log.info(f"Serving the devices on {app.config.get('DEVICE_SOCKET')}.")
+    while True:
+        time.sleep(3600)
+
+
 def init():
     args = sys.argv
     if 'db' in args:
@@ -21,7 +37,7 @@ def init():
         pass
 
     # Start-up: loading (health-check) devices from database, caching
-    from app.system.device_controller import refresh_devices
-    refresh_devices()
+    from app.system.startup import start_devices
+    start_devices(app.config)
 
 init()
@@ -0,0 +1,97 @@
+"""numeric sensor history
+
+Revision ID: 5c1e8d2a7f43
+Revises: e2f70869d0bd
+Create Date: 2026-10-18 10:12:41.318245
+
+"""
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8d2a7f43'
+down_revision = 'e2f70869d0bd'
+branch_labels = None
+depends_on = None
+
+TO_EPOCH = {
+    'sqlite': "CAST(strftime('%s', timestamp) AS INTEGER)",
+    'postgresql': "CAST(EXTRACT(EPOCH FROM timestamp) AS INTEGER)",
+    'mysql': "UNIX_TIMESTAMP(timestamp)",
+}
+FROM_EPOCH = {
+    'sqlite': "datetime(_timestamp, 'unixepoch')",
+    'postgresql': "to_timestamp(_timestamp) AT TIME ZONE 'UTC'",
+    'mysql': "FROM_UNIXTIME(_timestamp)",
+}
+
+
+def _is_number(value):
+    """Same values as HistoryStore.to_number accepts (and every dialect can cast)."""
+    if value in ('True', 'true', 'False', 'false'):
+        return True
+    if '_' in value:
+        return False  # python only
+    try:
+        return math.isfinite(float(value))
+    except ValueError:
+        return False
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('_timestamp', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('value', sa.Float(), nullable=True))
+
+    # samples without a timestamp are useless for a time-series, samples which
+    # are not numbers (e.g. 'N/A', 'None' of never read sensors) or the unset
+    # column default ('-1') would be invented by the cast, delete them
+    op.execute("DELETE FROM history_item WHERE timestamp IS NULL OR _value IS NULL "
+               "OR _value = '-1'")
+    bind = op.get_bind()
+    values = [row[0] for row in bind.execute(sa.text("SELECT DISTINCT _value FROM history_item"))]
+    invalid = [value for value in values if not _is_number(value)]
+    delete = sa.text("DELETE FROM history_item WHERE _value IN :values") \
+        .bindparams(sa.bindparam('values', expanding=True))
+    for i in range(0, len(invalid), 500):
+        bind.execute(delete, {'values': invalid[i:i + 500]})
+
+    op.execute(f"UPDATE history_item SET _timestamp = {TO_EPOCH[dialect]}, value = CASE "
+               "WHEN _value IN ('True', 'true') THEN 1.0 "
+               "WHEN _value IN ('False', 'false') THEN 0.0 "
+               "ELSE CAST(_value AS REAL) END")
+
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.drop_column('timestamp')
+        batch_op.drop_column('_value')
+
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.alter_column('_timestamp', new_column_name='timestamp',
+                              existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('value', existing_type=sa.Float(), nullable=False)
+
+    op.create_index('ix_history_item_sensor_id_timestamp', 'history_item',
+                    ['sensor_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    op.drop_index('ix_history_item_sensor_id_timestamp', table_name='history_item')
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.alter_column('timestamp', new_column_name='_timestamp',
+                              existing_type=sa.Integer(), nullable=True)
+
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('timestamp', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('_value', sa.String(length=80), nullable=True))
+
+    op.execute(f"UPDATE history_item SET timestamp = {FROM_EPOCH[dialect]}, "
+               "_value = CAST(value AS VARCHAR(80))")
+
+    with op.batch_alter_table('history_item', schema=None) as batch_op:
+        batch_op.drop_column('_timestamp')
+        batch_op.drop_column('value')
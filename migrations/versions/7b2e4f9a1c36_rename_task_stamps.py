@@ -0,0 +1,36 @@
+"""rename task stamps
+
+Revision ID: 7b2e4f9a1c36
+Revises: 3f9c2b7d5e14
+Create Date: 2026-10-18 19:12:44.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4f9a1c36'
+down_revision = '3f9c2b7d5e14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # task.time_modified (schedule changes) -> schedule_modified,
+    # task.time_updated (any change) -> time_modified, as on the other models
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.alter_column('time_modified', new_column_name='schedule_modified',
+                              existing_type=sa.DateTime(), existing_nullable=True)
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.alter_column('time_updated', new_column_name='time_modified',
+                              existing_type=sa.DateTime(), existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.alter_column('time_modified', new_column_name='time_updated',
+                              existing_type=sa.DateTime(), existing_nullable=True)
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.alter_column('schedule_modified', new_column_name='time_modified',
+                              existing_type=sa.DateTime(), existing_nullable=True)
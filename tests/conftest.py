@@ -7,7 +7,8 @@ from app.core.device import http
 from app.system.device_controller import init_device
 from app.system.device_mapper import DeviceMapper
 from app.models import Control, Sensor, Task, Device
-from app.core.cache import CACHE
+from app.core.cache import CACHE, HISTORY_CACHE
+from app.core.scheduler import ENGINE
 from tests.constants import WIFI_DEVICE
 
 
@@ -27,6 +28,9 @@ def app_setup():
 def db_setup():
     db.create_all()
     yield
+    ENGINE.clear()  # stop scheduling devices of this test
+    ENGINE.wait_idle(timeout=5)
+    HISTORY_CACHE.clear()
     db.drop_all()
     db.session.remove()
 
@@ -0,0 +1,81 @@
+import pytest
+
+from app.core.device import DeviceCommunicationException, DeviceUnavailableException
+from app.core.device.breaker import CircuitBreaker, State
+
+
+def test_breaker_states():
+    breaker = CircuitBreaker('dev', threshold=2, backoff=10, jitter=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == State.OPEN
+    assert not breaker.allow()
+    assert 9 < breaker.retry_in <= 10
+
+    breaker.retry_at = 0  # backoff elapsed
+    assert breaker.allow()
+    assert breaker.state == State.HALF_OPEN
+    assert not breaker.allow()  # a single probe
+
+    breaker.record_failure()
+    assert breaker.state == State.OPEN
+    assert 19 < breaker.retry_in <= 20  # doubled
+
+    breaker.retry_at = 0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == State.CLOSED
+    assert breaker.failures == 0 and breaker.opened == 0
+
+
+def test_breaker_backoff_capped():
+    breaker = CircuitBreaker('dev', threshold=1, backoff=10, max_backoff=15, jitter=0.2)
+    for _ in range(5):
+        breaker.record_failure()
+        assert breaker.retry_in <= 15 * 1.2
+
+
+@pytest.fixture
+def dead_device(mocked_device):
+    sent = []
+
+    def send_raw(request):
+        sent.append(request)
+        raise DeviceCommunicationException("unplugged")
+
+    mocked_device._send_raw = send_raw
+    mocked_device.breaker.jitter = 0
+    return mocked_device, sent
+
+
+def test_send_command_short_circuited(dead_device):
+    device, sent = dead_device
+    for _ in range(device.breaker.threshold):
+        with pytest.raises(DeviceCommunicationException):
+            device.send_command('status')
+    assert device.breaker.state == State.OPEN
+
+    sent.clear()
+    with pytest.raises(DeviceUnavailableException):
+        device.send_command('status')
+    assert not device.health_check()
+    assert not sent  # not even tried
+
+    device.breaker.retry_at = 0
+    with pytest.raises(DeviceCommunicationException):
+        device.send_command('status')
+    assert len(sent) == 1  # the probe, no retries
+    assert device.breaker.state == State.OPEN
+
+
+def test_send_command_recovers(dead_device):
+    device, _ = dead_device
+    for _ in range(device.breaker.threshold):
+        with pytest.raises(DeviceCommunicationException):
+            device.send_command('status')
+
+    device._send_raw = lambda request: {'status': 'ok'}
+    device.breaker.retry_at = 0
+    assert device.send_command('status') == {'status': 'ok'}
+    assert device.breaker.state == State.CLOSED
@@ -1,11 +1,20 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import mock
 import pytest
 
-from app.system.device_controller import init_device
+from app import db
+from app.models import Sensor
+from app.system.device_controller import Controller, init_device
 from app.core.device import DeviceException, DeviceCommunicationException, DeviceResponse, mock
+from app.core.device import DeviceUnavailableException
 from app.core.device import Status
 from app.core.device.serial import SerialDevice
 from app.core.device.http import HttpDevice
+from app.core.device.loop import IO_LOOP
 from app.system.device_mapper import DeviceMapper
 
 
@@ -33,7 +42,7 @@ def test_init_device(db_setup):
     assert init_device(d)
     device_db = DeviceMapper.from_physical(d).model
     assert device_db
-    assert len(device_db.tasks) == 2  # status/history
+    assert len(device_db.tasks) == 3  # status/history/history-cleanup
 
 
 @pytest.mark.parametrize("baud", [None, 19200])
@@ -119,3 +128,199 @@ def test_communication_error(error_device, method_params):
 def test_health_check_negative(error_device):
     error_device._is_responding = lambda: False
     assert not error_device.health_check()
+
+
+def test_apply_push(mocked_device, mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    sensor_id = sensor.id
+    mocked_device._on_push({"temp": {"type": "sensor", "value": 22.5}})
+
+    assert db.session.query(Sensor).get(sensor_id).last_value == 22.5
+
+
+def test_read_sensors_batched(mocked_device):
+    requests = []
+
+    def send_raw(request):
+        requests.append(request)
+        return {'status': 'ok', 'temp': 21.5, 'hum': {'type': 'sensor', 'value': 40}}
+
+    mocked_device._send_raw = send_raw
+    responses = mocked_device.read_sensors(['temp', 'hum'])
+    assert {name: r.value for name, r in responses.items()} == {'temp': 21.5, 'hum': 40}
+    assert requests == [{'request': 'read', 'sensors': ['temp', 'hum']}]
+    assert mocked_device.batched_read
+
+
+def test_read_sensors_fallback(mocked_device):
+    requests = []
+
+    def send_raw(request):
+        requests.append(request)
+        if request['request'] == 'read':
+            return {'cause': 'UNKNOWN_CMD read'}
+        return {'status': 'ok', 'value': 1}
+
+    mocked_device._send_raw = send_raw
+    responses = mocked_device.read_sensors(['temp', 'hum'])
+    assert {name: r.value for name, r in responses.items()} == {'temp': 1, 'hum': 1}
+    assert mocked_device.batched_read is False
+
+    requests.clear()
+    mocked_device.read_sensors(['temp', 'hum'])
+    assert [r['request'] for r in requests] == ['read_temp', 'read_hum']  # not retried
+
+
+def test_read_sensors_failed(mocked_device):
+    requests = []
+
+    def send_raw(request):
+        requests.append(request)
+        if request['request'] == 'read':
+            return {'cause': 'UNKNOWN_SENSOR hum'}
+        return {'status': 'ok', 'value': 1}
+
+    mocked_device._send_raw = send_raw
+    responses = mocked_device.read_sensors(['temp', 'hum'])
+    assert {name: r.value for name, r in responses.items()} == {'temp': 1, 'hum': 1}
+    assert mocked_device.batched_read is None  # supported, just failed
+
+    requests.clear()
+    mocked_device.read_sensors(['temp', 'hum'])
+    assert requests[0] == {'request': 'read', 'sensors': ['temp', 'hum']}
+
+
+def test_controller_read_sensors(mocked_device, mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    mocked_device._send_raw = lambda request: {'status': 'ok', 'temp': 19.5}
+    Controller(mocked_device).read_sensors()
+    assert sensor.last_value == 19.5
+
+
+@pytest.fixture
+def slow_device(mocked_device):
+    sent = []
+
+    def send_raw(request):
+        sent.append(request['request'])
+        time.sleep(0.2)
+        return {'status': 'ok', 'request': request['request']}
+
+    mocked_device._send_raw = send_raw
+    return mocked_device, sent
+
+
+def test_send_command_coalesced(slow_device):
+    device, sent = slow_device
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(device.send_command, ['status'] * 8 + ['read_temp'] * 8))
+    assert sorted(sent) == ['read_temp', 'status']
+    assert [r['request'] for r in responses] == ['status'] * 8 + ['read_temp'] * 8
+
+    responses[0]['request'] = 'changed'  # every caller gets its own copy
+    assert responses[1]['request'] == 'status'
+
+
+def test_send_command_coalesce_window(slow_device):
+    device, sent = slow_device
+    device.coalesce_seconds = 10
+    device.send_command('status')
+    device.send_command('status')
+    assert sent == ['status']  # reused
+
+    device.send_command('action_switch')  # not coalesced, the status is stale now
+    device.send_command('action_switch')
+    device.send_command('status')
+    assert sent == ['status', 'action_switch', 'action_switch', 'status']
+
+
+def test_send_command_read_in_flight_during_write(mocked_device):
+    sent, reading, release = [], threading.Event(), threading.Event()
+
+    def send_raw(request):
+        sent.append(request['request'])
+        if request['request'] == 'status' and len(sent) == 1:
+            reading.set()
+            release.wait(timeout=5)  # the status is read before the control changes
+        return {'status': 'ok', 'request': request['request']}
+
+    mocked_device._send_raw = send_raw
+    mocked_device.coalesce_seconds = 10
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        stale = pool.submit(mocked_device.send_command, 'status')
+        assert reading.wait(timeout=5)
+        mocked_device.send_command('action_switch')
+        release.set()
+        stale.result(timeout=5)
+    mocked_device.send_command('status')
+    assert sent == ['status', 'action_switch', 'status']  # the stale status is not reused
+
+
+def test_send_command_flights_landed(slow_device):
+    device, _ = slow_device
+    device.send_command('status')
+    device.send_command('read_temp')
+    assert not device._Device__flights
+
+
+def test_send_command_coalesced_failure(mocked_device):
+    calls = []
+
+    def send_raw(request):
+        calls.append(1)
+        time.sleep(0.2)
+        raise DeviceCommunicationException("unplugged")
+
+    mocked_device._send_raw = send_raw
+    mocked_device.coalesce_seconds = 10
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(mocked_device.send_command, 'status', 0) for _ in range(4)]
+    assert all(isinstance(f.exception(), DeviceCommunicationException) for f in futures)
+    assert len(calls) == 1
+
+    with pytest.raises(DeviceCommunicationException):
+        mocked_device.send_command('status', retries=0)
+    assert len(calls) == 2  # failures are not reused
+
+
+def test_sync_shim_not_from_loop(mocked_device):
+    async def nested():
+        return IO_LOOP.run(mocked_device.read_status_async())
+
+    with pytest.raises(RuntimeError):
+        IO_LOOP.run(nested(), timeout=5)
+    assert IO_LOOP.run(mocked_device.read_status_async(), timeout=5).is_success
+
+
+def test_send_command_async_coalesced(mocked_device):
+    sent = []
+
+    async def send_raw_async(request):
+        sent.append(request['request'])
+        await asyncio.sleep(0.2)
+        return {'status': 'ok', 'request': request['request']}
+
+    async def send_all(commands):
+        return await asyncio.gather(*[mocked_device.send_command_async(c) for c in commands])
+
+    mocked_device._send_raw_async = send_raw_async
+    responses = IO_LOOP.run(send_all(['status'] * 8 + ['action_switch'] * 2), timeout=5)
+    assert sorted(sent) == ['action_switch', 'action_switch', 'status']
+    assert [r['request'] for r in responses] == ['status'] * 8 + ['action_switch'] * 2
+
+
+def test_send_command_async_breaker(mocked_device):
+    calls = []
+
+    async def send_raw_async(request):
+        calls.append(request['request'])
+        raise DeviceCommunicationException("unplugged")
+
+    mocked_device._send_raw_async = send_raw_async
+    mocked_device.breaker.threshold = 2
+    for _ in range(2):
+        with pytest.raises(DeviceCommunicationException):
+            IO_LOOP.run(mocked_device.send_command_async('status', retries=0), timeout=5)
+    with pytest.raises(DeviceUnavailableException):
+        IO_LOOP.run(mocked_device.send_command_async('status', retries=0), timeout=5)
+    assert len(calls) == 2  # the open circuit short-circuits
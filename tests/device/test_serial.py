@@ -1,9 +1,253 @@
+import asyncio
+import json
+import queue
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
 from app.system.device_controller import refresh_devices
 from app.core.cache import CACHE
 from app.core.device import DeviceException
-from app.core.device.serial import SerialDevice
+from app.core.device import serial
+from app.core.device.loop import IO_LOOP
+from app.core.device.serial import SerialDevice, Protocol
+
+
+class FakeSerial:
+    """
+    Answers every request with its name. Framed sketch echoes the 'id' (and may
+    answer in reverse order), legacy one doesn't. readline blocks for a while
+    like the real one (time.sleep is patched, so a Condition is used).
+    """
+
+    def __init__(self, framed=True, reverse=False, noise=None):
+        self.framed = framed
+        self.reverse = reverse
+        self.lines = list(noise or [])
+        self.writes = []
+        self.ready = threading.Condition()
+        self.closed = False
+
+    def __call__(self, port, baud, timeout=None):
+        return self
+
+    def write(self, data):
+        self.writes.append(data)
+        text = data.decode('utf-8')
+        requests = [json.loads(line) for line in text.splitlines() if line]
+        responses = []
+        for request in requests:
+            response = {'status': 'ok', 'uuid': 'fake-uuid', 'request': request['request']}
+            if self.framed and 'id' in request:
+                response['id'] = request['id']
+            responses.append(json.dumps(response).encode('utf-8') + b'\n')
+        self.push(*(reversed(responses) if self.reverse else responses))
+
+    def push(self, *lines):
+        with self.ready:
+            self.lines.extend(lines)
+            self.ready.notify_all()
+
+    def readline(self):
+        with self.ready:
+            self.ready.wait_for(lambda: self.lines, timeout=0.05)
+            return self.lines.pop(0) if self.lines else b''
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class PipeSerial(FakeSerial):
+    """
+    FakeSerial over a socket pair: the port's (non-blocking) end is read and
+    written by the shared I/O loop, the sketch answers from a thread.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.port, self.sketch = socket.socketpair()
+        self.port.setblocking(False)  # as opened by pyserial
+        self.push(*self.lines)
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def push(self, *lines):
+        self.sketch.sendall(b''.join(lines))
+
+    def serve(self):
+        """Answer the requests as they arrive (complete JSON values only)."""
+        decoder, whitespace = json.JSONDecoder(), re.compile(r'\s*')
+        buffer = ''
+        while True:
+            try:
+                chunk = self.sketch.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk.decode('utf-8')
+            position = complete = 0
+            try:
+                while True:
+                    _, position = decoder.raw_decode(buffer, whitespace.match(buffer, position).end())
+                    complete = whitespace.match(buffer, position).end()  # incl. the newline
+            except ValueError:
+                pass  # the rest is still being written
+            if complete:
+                FakeSerial.write(self, buffer[:complete].encode('utf-8'))
+                buffer = buffer[complete:]
+
+    def write(self, data):
+        raise AssertionError("Should be written by the I/O loop.")
+
+    def readline(self):
+        raise AssertionError("Should be read by the I/O loop.")
+
+    def close(self):
+        if not self.closed:
+            self.port.close()
+            self.sketch.close()
+        super().close()
+
+
+@pytest.fixture(params=[FakeSerial, PipeSerial], ids=["thread", "loop"])
+def fake_serial(request):
+    return request.param
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(serial.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+@pytest.fixture()
+def connect(monkeypatch, sleeps):
+    """SerialDevice over the given FakeSerial, its reader is stopped afterwards."""
+    devices = []
+
+    def connect(fake, protocol):
+        monkeypatch.setattr(serial, 'Serial', fake)
+        devices.append(SerialDevice('fake', 9600, protocol=protocol))
+        return devices[-1]
+
+    yield connect
+    for device in devices:
+        device.reset_serial()
+
+
+@pytest.mark.parametrize("framed, expected", [
+    (True, Protocol.FRAMED),
+    (False, Protocol.LEGACY),
+], ids=["framed", "legacy"])
+def test_protocol_detection(connect, fake_serial, framed, expected):
+    device = connect(fake_serial(framed=framed), 'auto')
+    assert device.is_responding
+    assert device.protocol == expected
+    assert device.read_status().is_success
+
+
+def test_framed_pipelined(connect, fake_serial, sleeps):
+    fake = fake_serial(framed=True, reverse=True, noise=[b'booting...\n'])
+    device = connect(fake, 'framed')
+    sleeps.clear()
+
+    requests = [{'request': f'read_{i}'} for i in range(5)]
+    responses = device._send_many(requests)
+    assert [r['request'] for r in responses] == [r['request'] for r in requests]
+    assert len(fake.writes[-1].splitlines()) == 5  # written back-to-back
+    assert not sleeps
+
+
+def test_framed_missing_response(monkeypatch, connect, fake_serial):
+    monkeypatch.setattr(SerialDevice, 'TIMEOUT', 0.2)
+    fake = fake_serial(framed=True)
+    device = connect(fake, 'framed')
+    fake.framed = False  # ids not echoed anymore
+    with pytest.raises(DeviceException):
+        device._send_raw({'request': 'status'})
+    assert not device.is_responding
+
+
+def test_framed_concurrent_callers(connect, fake_serial):
+    device = connect(fake_serial(framed=True, reverse=True), 'framed')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(device.send_command, [f'read_{i}' for i in range(32)]))
+    assert [r['request'] for r in responses] == [f'read_{i}' for i in range(32)]
+
+
+def test_legacy(connect, fake_serial):
+    fake = fake_serial(framed=False)
+    device = connect(fake, 'legacy')
+    assert device.protocol == Protocol.LEGACY
+    assert device.send_command('read_temp')['request'] == 'read_temp'
+    assert json.loads(fake.writes[-1]) == {'request': 'read_temp'}  # bare, no id
+
+
+def test_push(monkeypatch, connect, fake_serial):
+    pushed = queue.Queue()
+    monkeypatch.setattr(SerialDevice, 'push_listeners', [lambda d, data: pushed.put((d, data))])
+    fake = fake_serial(framed=True)
+    device = connect(fake, 'framed')
+
+    fake.push(b'debug output\n', b'{"temp": {"type": "sensor", "value": 22}}\n')
+    assert pushed.get(timeout=1) == (device, {'temp': {'type': 'sensor', 'value': 22}})
+    assert device.send_command('status')['request'] == 'status'  # still in sync
+
+
+def test_close(connect, fake_serial):
+    fake = fake_serial(framed=True)
+    device = connect(fake, 'framed')
+    device.close()
+    assert not device.is_connected
+    deadline = time.monotonic() + 5  # closed by the reader
+    while not fake.closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake.closed
+    with pytest.raises(DeviceException):
+        device._send_raw({'request': 'status'})
+
+
+def test_framed_written_when_writable(connect):
+    fake = PipeSerial(framed=True)
+    fake.port.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    device = connect(fake, 'framed')
+
+    requests = [{'request': f'read_{i}', 'padding': 'x' * 1024} for i in range(256)]
+    responses = device._send_many(requests)
+    assert [r['request'] for r in responses] == [r['request'] for r in requests]
+    assert len(fake.writes) > 2  # the rest was written once the port took it
+
+
+def test_send_async(connect, fake_serial):
+    device = connect(fake_serial(framed=True, reverse=True), 'framed')
+
+    async def read_all():
+        return await asyncio.gather(*[device.send_command_async(f'read_{i}') for i in range(16)])
+
+    responses = IO_LOOP.run(read_all(), timeout=5)
+    assert [r['request'] for r in responses] == [f'read_{i}' for i in range(16)]
+    assert IO_LOOP.run(device.read_status_async(), timeout=5).is_success
+
+
+def test_send_async_timeout(monkeypatch, connect, fake_serial):
+    monkeypatch.setattr(SerialDevice, 'TIMEOUT', 0.2)
+    fake = fake_serial(framed=True)
+    device = connect(fake, 'framed')
+    fake.framed = False
+    with pytest.raises(DeviceException):
+        IO_LOOP.run(device._send_raw_async({'request': 'status'}), timeout=5)
+    assert not device.is_responding
 
 
 @pytest.mark.parametrize("url_expected", [
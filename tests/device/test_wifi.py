@@ -1,7 +1,76 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mock
 import pytest
+import requests
 
+from app import Config
 from app.core.device.http import HttpDevice
-from app.core.device import StatusResponse
+from app.core.device.loop import IO_LOOP
+from app.core.device import StatusResponse, DeviceCommunicationException, Status
+
+
+@pytest.fixture
+def http_requests(monkeypatch):
+    """Requests sent through any session, answered by a status response."""
+    sent = []
+
+    def request(session, method, url, **kwargs):
+        sent.append((method, kwargs.get('timeout')))
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'status': 'ok', 'uuid': 'wifi-uuid'}
+        return response
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+    return sent
+
+
+class DeviceHandler(BaseHTTPRequestHandler):
+    """Wi-Fi device sketch: GET '/' is the online check, POSTed requests are answered by name."""
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        self.answer(200, b'')
+
+    def do_POST(self):
+        self.server.handlers.append(self)
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['request']
+        self.server.requests.append((request, self.client_address))
+        if request == 'fail':
+            return self.answer(500, b'broken')
+        body = json.dumps({'status': 'ok', 'uuid': 'wifi-uuid', 'request': request,
+                           'temp': json.dumps({'type': 'sensor', 'value': 21})}).encode()
+        if request != 'chunked':
+            return self.answer(200, body)
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in (body[:10], body[10:], b''):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def answer(self, status_code, body):
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def wifi_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DeviceHandler)
+    server.daemon_threads = True
+    server.requests, server.handlers = [], []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
 
 
 @pytest.mark.parametrize("invalid_url", [
@@ -29,3 +98,80 @@ def test_read_status(actual_wifi_device):
     assert status.data['uuid']
     assert status.controls
     assert status.sensors
+
+
+def test_session_and_timeouts(http_requests):
+    device = HttpDevice(url="http://wifi-device")
+    assert device.uuid == 'wifi-uuid'
+    assert device.read_status().is_success
+    timeout = (Config.HTTP_CONNECT_TIMEOUT_SECONDS, Config.HTTP_READ_TIMEOUT_SECONDS)
+    assert http_requests == [('GET', timeout), ('POST', timeout), ('POST', timeout)]
+
+
+def test_timeouts_from_app_config(monkeypatch, app_setup, http_requests):
+    monkeypatch.setitem(app_setup.config, 'HTTP_CONNECT_TIMEOUT_SECONDS', 1)
+    monkeypatch.setitem(app_setup.config, 'HTTP_READ_TIMEOUT_SECONDS', 2)
+    device = HttpDevice(url="http://wifi-device")
+    assert device.timeout == (1, 2)
+
+
+def test_online_check_cached(monkeypatch, app_setup, http_requests):
+    device = HttpDevice(url="http://wifi-device")
+    for _ in range(5):
+        assert device.is_responding
+    assert [method for method, _ in http_requests] == ['GET', 'POST']
+
+    monkeypatch.setitem(app_setup.config, 'HTTP_ONLINE_CHECK_TTL_SECONDS', 0)
+    assert device.is_connected
+    assert [method for method, _ in http_requests] == ['GET', 'POST', 'GET']
+
+
+def test_request_timeout(monkeypatch, http_requests):
+    device = HttpDevice(url="http://wifi-device")
+
+    def timeout(*args, **kwargs):
+        raise requests.Timeout()
+
+    monkeypatch.setattr(requests.Session, 'request', timeout)
+    with pytest.raises(DeviceCommunicationException):
+        device._send_raw({'request': 'status'})
+    assert not device.is_responding
+    assert not device.is_connected  # remembered, not checked again
+
+
+def test_send_async(wifi_server):
+    device = HttpDevice(url=wifi_server.url)
+    assert IO_LOOP.run(device.read_status_async(), timeout=5).is_success
+    responses = [IO_LOOP.run(device.send_command_async(request), timeout=5)
+                 for request in ('read_temp', 'chunked', 'read_hum')]
+    assert [r['request'] for r in responses] == ['read_temp', 'chunked', 'read_hum']
+    assert responses[1]['temp'] == {'type': 'sensor', 'value': 21}  # decoded
+    awaited = wifi_server.requests[1:]  # after the one of the init
+    assert len({client for _, client in awaited}) == 1  # one kept-alive connection
+    device.close()
+
+
+def test_send_async_http_error(wifi_server):
+    device = HttpDevice(url=wifi_server.url)
+    response = IO_LOOP.run(device.send_command_async('fail'), timeout=5)
+    assert response['status'] == Status.FAIL
+    assert response['reason'] == 'HTTP 500, broken'
+
+
+def test_send_async_closed_idle_connection(wifi_server):
+    device = HttpDevice(url=wifi_server.url)
+    IO_LOOP.run(device.send_command_async('read_temp'), timeout=5)
+    for handler in wifi_server.handlers:
+        handler.connection.shutdown(socket.SHUT_RDWR)  # e.g. the device's keep-alive timeout
+    response = IO_LOOP.run(device.send_command_async('read_hum', retries=0), timeout=5)
+    assert response['request'] == 'read_hum'
+
+
+def test_send_async_unreachable():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    device = HttpDevice(url=f"http://127.0.0.1:{port}/")
+    with pytest.raises(DeviceCommunicationException):
+        IO_LOOP.run(device._send_raw_async({'request': 'status'}), timeout=5)
+    assert not device.is_responding
@@ -44,6 +44,38 @@ def test_get_system_blueprints(setup, app_setup):
         assert response.json
 
 
+def test_get_system_blueprints_listing(setup_blueprints, app_setup):
+    props, _, system = setup_blueprints
+    with app_setup.test_client() as client:
+        systems = client.get('/grow/systems?fields=id,properties&expand=').json
+        assert {'id': str(system.id), 'properties': [str(props[1].id), str(props[0].id),
+                                                     str(props[2].id)]} in systems
+
+        response = client.get('/grow/properties?fields=name&limit=1')
+        assert response.status_code == 200
+        assert len(response.json) == 1 and list(response.json[0]) == ['name']
+        cursor = response.headers['X-Next-Cursor']
+        response = client.get(f'/grow/properties?fields=id&cursor={cursor}')
+        assert all(int(p['id']) > int(cursor) for p in response.json)
+        assert 'X-Next-Cursor' not in response.headers
+
+        assert client.get('/grow/properties?expand=properties').status_code == 400
+
+
+def test_get_system_blueprints_not_modified(setup_blueprints, app_setup):
+    props, _, system = setup_blueprints
+    with app_setup.test_client() as client:
+        etag = client.get('/grow/systems').headers['ETag']
+        assert client.get('/grow/systems', headers={'If-None-Match': etag}).status_code == 304
+
+        system.properties.remove(props[2])  # only the association changes
+        db.session.commit()
+        response = client.get('/grow/systems', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        listed = next(s for s in response.json if s['id'] == str(system.id))
+        assert str(props[2].id) not in [p['id'] for p in listed['properties']]
+
+
 def test_get_system_instance(mocked_device_with_sensor_and_control, setup, app_setup):
     device, _, _ = mocked_device_with_sensor_and_control
     url = f'/grow/systems/{device.id}'
@@ -14,7 +14,7 @@ def sensor_and_history(mocked_device_with_sensor_and_control):
     for _ in range(100):
         val = random.randint(0, 100)
         history_values.append(val)
-        db.session.add(HistoryItem(sensor=sensor, _value=val, timestamp=datetime.utcnow()))
+        db.session.add(HistoryItem(sensor=sensor, value=val, timestamp=datetime.utcnow()))
     db.session.commit()
     return sensor, history_values
 
@@ -22,23 +22,23 @@ def sensor_and_history(mocked_device_with_sensor_and_control):
 @pytest.mark.parametrize("data_since_expected", [
     (
             {
-                datetime(2020, 8, 30, 12, 30): "12",
-                datetime(2020, 8, 30, 13, 30): "12",
-                datetime(2020, 8, 30, 14, 30): "12",
+                datetime(2020, 8, 30, 12, 30): 12,
+                datetime(2020, 8, 30, 13, 30): 12,
+                datetime(2020, 8, 30, 14, 30): 12,
             }, datetime(2020, 8, 30, 12, 40), 2
     ),
     (
             {
-                datetime(2020, 8, 30, 12, 30): "12",
-                datetime(2020, 8, 30, 13, 30): "12",
-                datetime(2020, 8, 30, 14, 30): "12",
+                datetime(2020, 8, 30, 12, 30): 12,
+                datetime(2020, 8, 30, 13, 30): 12,
+                datetime(2020, 8, 30, 14, 30): 12,
             }, datetime(2020, 8, 31, 12, 40), 0
     ),
     (
             {
-                datetime(2020, 8, 30, 12, 30): "12",
-                datetime(2020, 8, 30, 13, 30): "12",
-                datetime(2020, 8, 30, 14, 30): "12",
+                datetime(2020, 8, 30, 12, 30): 12,
+                datetime(2020, 8, 30, 13, 30): 12,
+                datetime(2020, 8, 30, 14, 30): 12,
             }, datetime(2020, 8, 29, 12, 40), 3
     ),
 ], ids=["2/3", "after_zero", "before_all"])
@@ -46,7 +46,7 @@ def test_get_last_values_since(mocked_device_with_sensor_and_control, data_since
     _, sensor, _ = mocked_device_with_sensor_and_control
     data, since, expected = data_since_expected
     for date, val in data.items():
-        db.session.add(HistoryItem(sensor=sensor, _value=val, timestamp=date))
+        db.session.add(HistoryItem(sensor=sensor, value=val, timestamp=date))
     db.session.commit()
 
     filtered = sensor.get_last_values(since=since)
@@ -59,7 +59,7 @@ def test_get_last_values_count(mocked_device_with_sensor_and_control, count, wan
     _, sensor, _ = mocked_device_with_sensor_and_control
     for _ in range(count):
         val = random.randint(0, 100)
-        db.session.add(HistoryItem(sensor=sensor, _value=val, timestamp=datetime.utcnow()))
+        db.session.add(HistoryItem(sensor=sensor, value=val, timestamp=datetime.utcnow()))
     db.session.commit()
 
     if wanted_count > count:
@@ -77,10 +77,10 @@ def test_sensor_query_performance(mocked_device_with_sensor_and_control, count):
     old_time = datetime(2020, 9, 23, 12, 20)
     for _ in range(count):
         val = random.randint(0, 100)
-        db.session.add(HistoryItem(sensor=sensor, _value=val, timestamp=old_time))
+        db.session.add(HistoryItem(sensor=sensor, value=val, timestamp=old_time))
     for _ in range(count):
         val = random.randint(0, 100)
-        db.session.add(HistoryItem(sensor=sensor, _value=val, timestamp=datetime.utcnow()))
+        db.session.add(HistoryItem(sensor=sensor, value=val, timestamp=datetime.utcnow()))
     db.session.commit()
 
     def x_test_code():
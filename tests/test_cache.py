@@ -1,6 +1,8 @@
+import time
+
 import pytest
 
-from app.core.cache import CACHE
+from app.core.cache import CACHE, ResultCache
 
 
 def test_add(mocked_device):
@@ -25,3 +27,42 @@ def test_remove(mocked_device):
 @pytest.mark.parametrize("uuid", [None, 123, -100, "", "122adas"])
 def test_get_negative(uuid):
     assert CACHE.get_active_device_by_uuid(uuid) is None
+
+
+def test_result_cache_ttl(monkeypatch):
+    cache = ResultCache(ttl=10, max_bytes=100)
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    assert cache.set('key', b'value', tag=1)
+    assert cache.get('key') == b'value'
+    now[0] += 11
+    assert cache.get('key') is None
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+    assert cache.stats['entries'] == 0
+
+
+def test_result_cache_size_eviction():
+    cache = ResultCache(ttl=10, max_bytes=10)
+    cache.set('a', b'1234', tag=1)
+    cache.set('b', b'1234', tag=1)
+    cache.get('a')  # 'b' is now the least recently used
+    cache.set('c', b'1234', tag=2)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.stats['bytes'] == 8
+    assert cache.stats['evictions'] == 1
+    assert not cache.set('too big', b'12345678901', tag=1)
+
+
+def test_result_cache_invalidate():
+    cache = ResultCache()
+    cache.set('a', b'1', tag=1)
+    cache.set('b', b'2', tag=2)
+    generation = cache.generation(1)
+    cache.invalidate(1)
+    assert cache.get('a') is None
+    assert cache.get('b') == b'2'
+    # computed before the invalidation, not stored
+    assert not cache.set('a', b'1', tag=1, generation=generation)
+    assert cache.set('a', b'1', tag=1, generation=cache.generation(1))
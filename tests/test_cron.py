@@ -0,0 +1,113 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from croniter import croniter
+
+from app.core.cron import (
+    compile_cron, next_fire_times, get_phase,
+    CronExpression, CroniterExpression, IntervalExpression, CronError
+)
+
+EXPRESSIONS = [
+    '* * * * *',
+    '*/20 * * * *',
+    '0 0 13 * 5',
+    '0 0 */2 * 1',
+    '15 10 * * sun',
+    '0 0 * * 7',
+    '5/15 3-6 * jan-mar mon-fri',
+    '0,30 */3 1,15 * *',
+    '59 23 31 12 *',
+    '0 12 29 2 *',
+    '@hourly',
+    '0 9 15 * */1',
+    '0 9 */1 * 1',
+    '0 9 */2 * 1',
+    '0 9 15 * */2',
+]
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_same_as_croniter(expression):
+    random.seed(expression)
+    compiled = compile_cron(expression)
+    assert isinstance(compiled, CronExpression)
+    for _ in range(200):
+        start = datetime(2020, 1, 1) + timedelta(seconds=random.randint(0, 3 * 365 * 86400))
+        assert compiled.next_after(start) == croniter(expression, start).get_next(datetime)
+
+
+def test_day_fields_same_as_croniter():
+    random.seed(0)
+    days = ['*', '*/1', '*/2', '*/10', '15', '1-10/3', '1,31', '5-20']
+    weekdays = ['*', '*/1', '*/2', '1', 'mon-fri', '0,6', '2-4/2', '7']
+    for _ in range(1000):
+        expression = f"0 9 {random.choice(days)} * {random.choice(weekdays)}"
+        start = datetime(2020, 1, 1) + timedelta(seconds=random.randint(0, 3 * 365 * 86400))
+        if start.month == 2:
+            continue  # croniter skips the 1st of March from February
+        assert CronExpression(expression).next_after(start) \
+            == croniter(expression, start).get_next(datetime), expression
+
+
+def test_compiled_once():
+    assert compile_cron('*/20 * * * *') is compile_cron('*/20 * * * *')
+
+
+@pytest.mark.parametrize("expression", ['0 0 L * *', '1 2 3 4 5 6'])
+def test_croniter_fallback(expression):
+    start = datetime(2021, 1, 1)
+    compiled = compile_cron(expression)
+    assert isinstance(compiled, CroniterExpression)
+    assert compiled.next_after(start) == croniter(expression, start).get_next(datetime)
+
+
+@pytest.mark.parametrize("expression", [
+    'x y', '61 * * * *', '*/0 * * * *', None, 'status', 'every:', 'every:0s', 'every:5d'
+])
+def test_invalid(expression):
+    with pytest.raises(CronError):
+        compile_cron(expression)
+
+
+def test_never_fires():
+    with pytest.raises(CronError):
+        compile_cron('0 0 30 2 *').next_after(datetime(2021, 1, 1))
+
+
+def test_next_fire_times():
+    start = datetime(2021, 1, 1, 10, 5)
+    times = next_fire_times(['*/20 * * * *', '@hourly', '*/20 * * * *'], start, count=3)
+    assert times[0] == times[2] == [datetime(2021, 1, 1, 10, 20),
+                                    datetime(2021, 1, 1, 10, 40),
+                                    datetime(2021, 1, 1, 11, 0)]
+    assert times[1][0] == datetime(2021, 1, 1, 11, 0)
+
+
+@pytest.mark.parametrize("expression,seconds", [
+    ('every:15s', 15), ('every:15', 15), ('every:2m', 120), ('every:1h', 3600),
+    ('Every:15S', 15), (' every:15s ', 15)
+])
+def test_interval(expression, seconds):
+    compiled = compile_cron(expression)
+    assert isinstance(compiled, IntervalExpression)
+    assert compiled.seconds == seconds
+
+    start = datetime(2021, 1, 1, 10, 0, 0)
+    first, second = compiled.next_n(start, 2)
+    assert first == start + timedelta(seconds=seconds)
+    assert second - first == timedelta(seconds=seconds)
+
+
+def test_interval_phase():
+    compiled = compile_cron('every:20s')
+    start = datetime(2021, 1, 1, 10, 0, 0)
+    assert compiled.next_after(start, phase=0.5) == datetime(2021, 1, 1, 10, 0, 10)
+    assert compiled.next_after(datetime(2021, 1, 1, 10, 0, 10), phase=0.5) \
+        == datetime(2021, 1, 1, 10, 0, 30)
+
+
+def test_phase_is_stable():
+    assert get_phase('some-uuid') == get_phase('some-uuid')
+    assert 0 <= get_phase('some-uuid') < 1
@@ -1,3 +1,7 @@
+import threading
+import time
+
+import mock
 import pytest
 from app.system.device_controller import *
 from app.models import Device, Task
@@ -92,6 +96,84 @@ def test_refresh_devices(mocked_device, mocked_device_and_db):
     assert CACHE.get_active_device(mocked_device_and_db)
 
 
+def test_refresh_devices_report(mocked_device, mocked_device_and_db):
+    unreachable = Device(name='wifi-dev', uuid='wifi-uuid', type='wifi', url=None)
+    db.session.add(unreachable)
+    db.session.commit()
+
+    report = refresh_devices(strict=False)
+    assert list(report.reachable) == [mocked_device_and_db.id]
+    assert list(report.unreachable) == [unreachable.id]
+    assert not db.session.query(Device).get(unreachable.id).is_online
+    assert db.session.query(Device).get(mocked_device_and_db.id).is_online
+
+    with pytest.raises(ControllerError):
+        refresh_devices()
+
+
+def test_probe():
+    def slow(seconds, result=True):
+        def connect():
+            time.sleep(seconds)
+            return result
+        return connect
+
+    def failing():
+        raise DeviceException("boom")
+
+    connectors = {f"slow-{i}": slow(0.2) for i in range(8)}
+    connectors.update({'failing': failing, 'none': slow(0, None), 'hung': slow(5, None)})
+    report = probe(connectors, max_workers=11, timeout=1)
+
+    assert sorted(report.reachable) == sorted(f"slow-{i}" for i in range(8))
+    assert report.unreachable['failing'] == "boom"
+    assert set(report.unreachable) == {'failing', 'none', 'hung'}
+    assert report.elapsed < 2  # concurrently, not waiting for the hung one
+    assert report.to_dict()['unreachable']['none'] == "Not responding."
+
+
+def test_probe_closes_late_devices():
+    late, connected = mock.Mock(), threading.Event()
+
+    def connect():
+        connected.wait(timeout=5)
+        return late
+
+    report = probe({'late': connect}, timeout=0.1)
+    assert 'late' in report.unreachable
+    connected.set()
+    deadline = time.monotonic() + 5
+    while not late.close.called and time.monotonic() < deadline:
+        time.sleep(0.01)
+    late.close.assert_called_once()
+
+
+def test_connect_device_closes_unreachable(monkeypatch):
+    closed = []
+    monkeypatch.setattr(MockedDevice, 'health_check', lambda self: False)
+    monkeypatch.setattr(MockedDevice, 'close', lambda self: closed.append(self))
+    assert connect_device(DeviceType.MOCK, None, 'some-uuid') is None
+    assert len(closed) == 1
+
+
+def test_refresh_devices_closes_cached(mocked_device, mocked_device_and_db, monkeypatch):
+    closed = []
+    monkeypatch.setattr(mocked_device, 'close', lambda: closed.append(mocked_device),
+                        raising=False)
+    refresh_devices(devices=[mocked_device_and_db])
+    assert closed == [mocked_device]
+    assert CACHE.get_active_device(mocked_device_and_db) is not mocked_device
+
+
+def test_scan_devices(db_setup, monkeypatch):
+    monkeypatch.setenv("MOCK_DEV", "2")
+    report = scan_devices()
+    assert len(report.devices) == 2
+    for device in report.devices:
+        assert CACHE.get_active_device_by_uuid(device.uuid)
+        stop_scheduler(device.uuid)
+
+
 def test_init_device(db_setup, mocked_device):
     init_device(mocked_device)
     device = db.session.query(Device).filter_by(uuid=mocked_device.uuid).first()
@@ -122,3 +204,12 @@ def test_run_scheduler_no_device_cached(db_setup, device):
         run_scheduler(device.uuid)
 
     assert not CACHE.has_active_scheduler(device.uuid)
+
+
+def test_no_cleanup_task_without_cron(monkeypatch, mocked_device_and_db):
+    import app
+    monkeypatch.setitem(app.config, 'HISTORY_CLEANUP_CRON', None)
+    ensure_system_tasks_are_created(mocked_device_and_db)
+    db.session.commit()
+    names = {t.name for t in db.session.query(Task).filter_by(device_id=mocked_device_and_db.id)}
+    assert names == {'status', 'history-logger'}
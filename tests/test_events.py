@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from app import db
+from app.core.events import EVENTS, Subscription
+from app.models import Device, Task
+
+
+@pytest.fixture
+def subscription():
+    subscription = EVENTS.subscribe()
+    yield subscription
+    EVENTS.unsubscribe(subscription)
+
+
+def _events(subscription):
+    events = []
+    while (e := subscription.get(timeout=0)) is not None:
+        events.append(e)
+    return events
+
+
+def test_published_on_commit(subscription, mocked_device_with_sensor_and_control):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    _events(subscription)
+
+    sensor.last_value = 21.5
+    sensor.last_value = 22.5  # published once
+    control.value = "False"
+    assert not _events(subscription)
+    db.session.commit()
+
+    events = {e['type']: e for e in _events(subscription)}
+    assert set(events) == {'sensor', 'control'}
+    assert events['sensor']['device_id'] == str(device.id)
+    assert events['sensor']['data']['last_value'] == 22.5
+    assert events['control']['data']['value'] is False
+
+
+def test_not_published(subscription, mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    sensor.last_value = 21.5
+    db.session.commit()
+    _events(subscription)
+
+    sensor.last_value = 21.5  # no change
+    db.session.commit()
+    sensor.last_value = 30
+    db.session.rollback()
+    assert not _events(subscription)
+
+
+def test_device_and_task_events(subscription, mocked_device_and_db, task_factory):
+    device = mocked_device_and_db
+    task = task_factory(device, 'status')
+    device.is_online = True
+    db.session.commit()
+    Task.set_failed(task.id, "timeout")
+
+    device_event, task_event = _events(subscription)
+    assert device_event['type'] == 'device' and device_event['data']['is_online'] is True
+    assert task_event['type'] == 'task' and task_event['data']['id'] == str(task.id)
+    assert task_event['data']['last_run_error'] == "timeout"
+    assert not task_event['data']['last_run_success']
+
+
+def test_subscription_filter_and_overflow():
+    subscription = Subscription(device_ids={'1'}, size=2)
+    assert subscription.wants({'device_id': '1'})
+    assert not subscription.wants({'device_id': '2'})
+    for i in range(3):
+        subscription.put({'type': 'sensor', 'device_id': '1'})
+    assert subscription.get(timeout=0) == {'type': 'resync'}
+    assert subscription.get(timeout=0) is None
+
+
+def test_stream(app_setup, db_setup, monkeypatch):
+    monkeypatch.setitem(app_setup.config, 'EVENTS_KEEPALIVE_SECONDS', 0.01)
+    with app_setup.test_client() as client:
+        response = client.get('/events?devices=1,2', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        chunks = iter(response.response)
+        assert next(chunks) == b": keep-alive\n\n"
+
+        EVENTS.publish({'type': 'device', 'device_id': '3', 'data': {}})
+        EVENTS.publish({'type': 'device', 'device_id': '2', 'data': {'is_online': False}})
+        chunk = next(chunks)
+        while chunk.startswith(b":"):
+            chunk = next(chunks)
+        event, data = chunk.decode().split("\n")[:2]
+        assert event == "event: device"
+        assert json.loads(data[len("data: "):])['device_id'] == '2'
+        response.close()
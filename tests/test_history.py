@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.core.history import HISTORY, HOUR, DAY
+from app.core.tasks import TaskRunnable, TaskType
+from app.models import HistoryItem, HistoryRollup, Sensor, Task
+from app.system.device_controller import Controller
+
+
+def test_append(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    stored = HISTORY.append([(sensor.id, 12.5), (sensor.id, "True"), (sensor.id, "N/A")])
+    db.session.commit()
+
+    assert stored == 2
+    assert [value for _, value in HISTORY.get_range(sensor.id)] == [12.5, 1.0]
+
+
+def test_epoch_timestamp(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    time = datetime(2021, 1, 1, 10, 0)
+    HISTORY.append([(sensor.id, 1)], timestamp=time)
+    db.session.commit()
+
+    assert db.session.query(HistoryItem).first().timestamp == time
+    assert db.session.execute("SELECT timestamp FROM history_item").scalar() == 1609495200
+
+
+def test_get_range(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(10):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(hours=i))
+    db.session.commit()
+
+    history = HISTORY.get_range(sensor.id, since=start + timedelta(hours=2),
+                                until=start + timedelta(hours=5))
+    assert [value for _, value in history] == [2, 3, 4, 5]
+    assert history[0][0] == start + timedelta(hours=2)
+    assert HISTORY.get_recent(sensor.id, count=3) == [9, 8, 7]
+
+
+def test_bool_sensor_history(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    sensor._value = "True"
+    HISTORY.append([(sensor.id, sensor.last_value)])
+    db.session.commit()
+
+    assert sensor.get_last_values() == [{'timestamp': HISTORY.get_range(sensor.id)[0][0],
+                                        'value': True}]
+
+
+def test_log_sensors(mocked_device, mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    sensor.last_value = 21.5
+    db.session.commit()
+
+    Controller(mocked_device).log_sensors()
+    assert [value for _, value in HISTORY.get_range(sensor.id)] == [21.5]
+
+
+def test_get_buckets(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(12):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(minutes=20 * i))
+    db.session.commit()
+
+    buckets = HISTORY.get_buckets(sensor.id, width=3600)
+    assert len(buckets) == 4
+    assert buckets[1] == {'timestamp': start + timedelta(hours=1), 'value': 4.0,
+                          'min': 3, 'max': 5, 'avg': 4.0, 'last': 5, 'count': 3}
+
+    buckets = HISTORY.get_buckets(sensor.id, points=5, since=start + timedelta(minutes=10))
+    assert len(buckets) <= 5
+    assert sum(b['count'] for b in buckets) == 11
+    assert buckets[0]['timestamp'] == start + timedelta(minutes=20)
+
+
+def test_get_buckets_empty(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    assert HISTORY.get_buckets(sensor.id, points=10) == []
+    assert HISTORY.get_buckets(sensor.id, width=60) == []
+
+
+def test_rollups(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1, 23)
+    for i in range(6):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(minutes=20 * i))
+    db.session.commit()
+
+    hourly = db.session.query(HistoryRollup).filter_by(sensor_id=sensor.id, resolution=HOUR) \
+        .order_by(HistoryRollup.timestamp).all()
+    assert [(r.timestamp, r.count, r.total, r.min_value, r.max_value, r.last_value)
+            for r in hourly] == [(start, 3, 3.0, 0, 2, 2),
+                                 (start + timedelta(hours=1), 3, 12.0, 3, 5, 5)]
+    daily = db.session.query(HistoryRollup).filter_by(sensor_id=sensor.id, resolution=DAY)
+    assert [r.count for r in daily] == [3, 3]
+
+
+@pytest.mark.parametrize("width, aligned, expected", [
+    (60, False, None),
+    (3600, True, HOUR),
+    (5400, False, HOUR),
+    (5400, True, None),
+    (7 * DAY, True, DAY),
+])
+def test_rollup_resolution(width, aligned, expected):
+    assert HISTORY.get_rollup_resolution(width, aligned=aligned) == expected
+
+
+def test_get_buckets_from_rollups(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(30 * 24):
+        HISTORY.append([(sensor.id, i % 24)], timestamp=start + timedelta(hours=i))
+    db.session.commit()
+    raw = HISTORY.get_buckets(sensor.id, width=DAY)
+
+    # only rollups are read
+    db.session.query(HistoryItem).delete()
+    db.session.commit()
+    assert HISTORY.get_buckets(sensor.id, width=DAY) == raw
+    assert len(raw) == 30
+    assert raw[0] == {'timestamp': start, 'value': 11.5, 'min': 0, 'max': 23,
+                      'avg': 11.5, 'last': 23, 'count': 24}
+    # raw samples cleaned-up, bounds come from the rollups
+    buckets = HISTORY.get_buckets(sensor.id, points=10)
+    assert 0 < len(buckets) <= 10
+    assert sum(b['count'] for b in buckets) == 30 * 24
+
+
+def test_get_buckets_points_partly_cleaned(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(30 * 24):
+        HISTORY.append([(sensor.id, i % 24)], timestamp=start + timedelta(hours=i))
+    db.session.commit()
+    HISTORY.delete([sensor.id], until=start + timedelta(days=20))  # raw of the last 10 days left
+
+    buckets = HISTORY.get_buckets(sensor.id, points=10)
+    assert 0 < len(buckets) <= 10
+    assert sum(b['count'] for b in buckets) == 30 * 24
+
+
+def test_delete_batched(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(10):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(hours=i))
+    db.session.commit()
+
+    assert HISTORY.delete([sensor.id], since=start + timedelta(hours=8), batch_size=3) == 2
+    assert HISTORY.delete([sensor.id], until=start + timedelta(hours=5), batch_size=3) == 6
+    assert [value for _, value in HISTORY.get_range(sensor.id)] == [6, 7]
+    assert HISTORY.delete_rollups([sensor.id], batch_size=4) == 11  # 10 hourly + 1 daily
+
+
+def test_history_cleanup_task(mocked_device, mocked_device_with_sensor_and_control,
+                              task_factory):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    now = datetime.utcnow()
+    for days in [1000, 100, 10, 0]:
+        HISTORY.append([(sensor.id, days)], timestamp=now - timedelta(days=days))
+    db.session.commit()
+
+    task = task_factory(sensor.device, TaskType.HISTORY_CLEANUP.value,
+                        meta={'raw_retention_days': 30, 'rollup_retention_days': 365})
+    task_id, sensor_id = task.id, sensor.id
+    TaskRunnable.from_database_task(task).run(mocked_device)
+
+    assert db.session.query(Task).get(task_id).last_run_success
+    assert [value for _, value in HISTORY.get_range(sensor_id)] == [10, 0]
+    assert db.session.query(HistoryRollup).filter_by(sensor_id=sensor_id).count() == 6
+
+
+def test_history_logger_task(mocked_device, mocked_device_with_sensor_and_control,
+                             task_factory):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    requests = []
+
+    def send_raw(request):
+        requests.append(request)
+        return {'status': 'ok', sensor.name: 19.5}
+
+    mocked_device._send_raw = send_raw
+    task = task_factory(sensor.device, TaskType.HISTORY.value)
+    sensor_id = sensor.id
+    TaskRunnable.from_database_task(task).run(mocked_device)
+
+    assert [r['request'] for r in requests] == ['read']
+    assert [value for _, value in HISTORY.get_range(sensor_id)] == [19.5]
+
+
+def test_history_cleanup_invalid_metadata(mocked_device, mocked_device_with_sensor_and_control,
+                                          task_factory):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    task = task_factory(sensor.device, TaskType.HISTORY_CLEANUP.value,
+                        meta={'raw_retention_days': 'a month'})
+    task_id = task.id
+    TaskRunnable.from_database_task(task).run(mocked_device)
+    assert not db.session.query(Task).get(task_id).last_run_success
+
+
+def test_incremental_vacuum_disabled(db_setup):
+    assert not HISTORY.incremental_vacuum()
+
+
+def test_clear_rebuilds_rollups(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(6):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(minutes=20 * i))
+    db.session.commit()
+
+    deleted = HISTORY.clear([sensor.id], since=start + timedelta(minutes=40),
+                            until=start + timedelta(minutes=60))
+    assert deleted == 2
+    expected = HISTORY.get_buckets(sensor.id, width=HOUR)
+    assert [b['count'] for b in expected] == [2, 2]
+    db.session.query(HistoryItem).delete()
+    db.session.commit()
+    assert HISTORY.get_buckets(sensor.id, width=HOUR) == expected  # from rollups
+    assert HISTORY.get_buckets(sensor.id, width=DAY)[0]['count'] == 4
+
+
+def test_clear_keeps_rollups_of_cleaned_samples(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    start = datetime(2021, 1, 1)
+    for i in range(6):
+        HISTORY.append([(sensor.id, i)], timestamp=start + timedelta(minutes=20 * i))
+    db.session.commit()
+    HISTORY.delete([sensor.id], until=start + timedelta(minutes=59))  # raw retention
+
+    HISTORY.clear([sensor.id], since=start + timedelta(minutes=30),
+                  until=start + timedelta(minutes=70))
+
+    def counts(resolution):
+        return [r.count for r in db.session.query(HistoryRollup)
+                .filter_by(sensor_id=sensor.id, resolution=resolution)
+                .order_by(HistoryRollup.timestamp)]
+    assert counts(HOUR) == [3, 2]  # the first hour has no raw samples left, kept as it was
+    assert counts(DAY) == [6]
+
+
+def test_rollups_upserted(mocked_device_with_sensor_and_control):
+    _, sensor, _ = mocked_device_with_sensor_and_control
+    timestamp = datetime(2021, 1, 1, 10)
+    HISTORY.append([(sensor.id, 2), (sensor.id, 5)], timestamp=timestamp)
+    HISTORY.append([(sensor.id, 1)], timestamp=timestamp + timedelta(minutes=1))
+    db.session.commit()
+    rollup = db.session.query(HistoryRollup).filter_by(sensor_id=sensor.id, resolution=HOUR).one()
+    assert (rollup.count, rollup.total, rollup.min_value, rollup.max_value, rollup.last_value) \
+        == (3, 8.0, 1, 5, 1)
+
+
+def test_sensor_delete_removes_history(mocked_device_and_db):
+    sensor = Sensor(device=mocked_device_and_db, name="to_delete")
+    db.session.add(sensor)
+    db.session.commit()
+    HISTORY.append([(sensor.id, 1), (sensor.id, 2)])
+    db.session.commit()
+
+    db.session.delete(sensor)
+    db.session.commit()
+    assert not db.session.query(HistoryItem).count()
+    assert not db.session.query(HistoryRollup).count()
@@ -0,0 +1,97 @@
+import json
+import socket
+import time
+
+import pytest
+
+from app.core.cache import CACHE
+from app.core.events import EVENTS
+from app.system.device_controller import ControllerError, DeviceNotOwnedError
+from app.system.ipc import BRIDGE, DeviceBridge, DeviceOwnerServer
+
+
+@pytest.fixture
+def owner_server(app_setup, tmp_path):
+    server = DeviceOwnerServer(str(tmp_path / 'devices.sock'))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bridge(owner_server):
+    bridge = DeviceBridge()
+    bridge.path = owner_server.path
+    yield bridge
+    bridge.path = None
+    CACHE.owner_state = None
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_request(bridge, mocked_device, mocked_device_with_sensor_and_control):
+    device, _, control = mocked_device_with_sensor_and_control
+    assert bridge.request('action', device_id=device.id, control_id=control.id) is None
+    assert str(mocked_device) in bridge.request('state')['active']
+
+
+def test_request_errors(bridge, db_setup):
+    with pytest.raises(ControllerError, match='No such device'):
+        bridge.request('action', device_id=123, control_id=456)
+    with pytest.raises(ControllerError, match='Unknown operation'):
+        bridge.request('explode')
+
+
+def test_owner_not_reachable(tmp_path):
+    bridge = DeviceBridge()
+    bridge.path = str(tmp_path / 'nobody.sock')
+    with pytest.raises(DeviceNotOwnedError):
+        bridge.request('state')
+
+
+def test_subscribe(bridge, db_setup):
+    bridge.connect(bridge.path)
+    _wait_for(lambda: CACHE.owner_state is not None)
+
+    CACHE.set_initializing([42])
+    _wait_for(lambda: CACHE.owner_state['initializing'] == [42])
+    CACHE.set_initialized()
+    _wait_for(lambda: CACHE.owner_state['initializing'] == [])
+
+
+def test_subscribe_events(owner_server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(5)
+        connection.connect(owner_server.path)
+        connection.sendall(b'{"op": "subscribe"}\n')
+        lines = connection.makefile('rb')
+        assert 'state' in json.loads(lines.readline())
+
+        event = {'type': 'device', 'device_id': '1', 'data': {'is_online': True}}
+        EVENTS.publish(event)
+        assert json.loads(lines.readline()) == {'event': event}
+
+
+def test_forwarded_by_routes(app_setup, monkeypatch, mocked_device_with_sensor_and_control):
+    device, _, control = mocked_device_with_sensor_and_control
+    requests = []
+    CACHE.set_owner(False, 4321)
+    try:
+        with app_setup.test_client() as client:
+            url = f'/devices/{device.id}/action'
+            r = client.post(url, json={'control': control.name})
+            assert r.status_code == 503  # no socket to forward to
+            assert 'pid 4321' in r.get_data(as_text=True)
+
+            monkeypatch.setattr(BRIDGE, 'path', '/some/devices.sock')
+            monkeypatch.setattr(BRIDGE, 'request', lambda op, **args: requests.append((op, args)))
+            assert client.post(url, json={'control': control.name}).status_code == 200
+    finally:
+        CACHE.set_owner(True)
+    assert requests == [('action', {'device_id': device.id, 'control_id': control.id,
+                                    'value': None})]
@@ -0,0 +1,56 @@
+import enum
+import json
+from datetime import date, datetime, timezone
+
+import pytest
+
+from app.json_provider import OrjsonProvider, StdJSONProvider, json_provider, orjson
+
+providers = [StdJSONProvider,
+             pytest.param(OrjsonProvider, marks=pytest.mark.skipif(
+                 orjson is None, reason="orjson not installed"))]
+
+
+class Mode(enum.Enum):
+    AUTO = 'auto'
+
+
+class Item:
+    dictionary = {'id': '1'}
+
+
+@pytest.mark.parametrize("provider_class", providers)
+def test_dumps(app_setup, provider_class):
+    provider = provider_class(app_setup)
+    obj = {'z': 1, 'timestamps': [datetime(2026, 1, 2, 3, 4, 5, 6), datetime(2026, 1, 2),
+                                  datetime(2026, 1, 2, tzinfo=timezone.utc), date(2026, 1, 2)],
+           'mode': Mode.AUTO, 'ids': frozenset([1]), 'item': Item()}
+    assert json.loads(provider.dumps(obj)) == {
+        'z': 1,
+        'timestamps': ["2026-01-02T03:04:05.000006", "2026-01-02T00:00:00",
+                       "2026-01-02T00:00:00+00:00", "2026-01-02"],
+        'mode': 'auto', 'ids': [1], 'item': {'id': '1'}}
+    assert list(provider.loads(provider.dumps(obj))) == ['z', 'timestamps', 'mode', 'ids', 'item']
+    with pytest.raises(TypeError):
+        provider.dumps(object())
+
+
+@pytest.mark.parametrize("provider_class", providers)
+def test_response(app_setup, provider_class):
+    provider = provider_class(app_setup)
+    app_setup.debug = False
+    response = provider.response(timestamp=datetime(2026, 1, 2))
+    assert response.mimetype == 'application/json'
+    assert response.get_data() == b'{"timestamp":"2026-01-02T00:00:00"}\n'
+    app_setup.debug = True  # indented
+    assert provider.response([1]).get_data() == b'[\n  1\n]\n'
+
+
+def test_json_provider(app_setup, monkeypatch):
+    monkeypatch.setitem(app_setup.config, 'JSON_PROVIDER', 'std')
+    assert isinstance(json_provider(app_setup), StdJSONProvider)
+    monkeypatch.setitem(app_setup.config, 'JSON_PROVIDER', 'auto')
+    assert isinstance(json_provider(app_setup), OrjsonProvider if orjson else StdJSONProvider)
+    monkeypatch.setitem(app_setup.config, 'JSON_PROVIDER', 'ujson')
+    with pytest.raises(ValueError):
+        json_provider(app_setup)
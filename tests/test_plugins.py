@@ -8,7 +8,8 @@ from app.core.tasks import TaskRunnable, TaskType
 from app.models import Task
 
 
-@pytest.mark.parametrize('task_type', ['status', 'toggle', 'interval', 'history'])
+@pytest.mark.parametrize('task_type', ['status', 'toggle', 'interval', 'history',
+                                       'history-cleanup'])
 def test_builtin_from_database_task(mocked_device, mocked_device_with_sensor_and_control,
                                     task_factory, task_type):
     from app.core.plugins import plugin_manager
@@ -1,10 +1,15 @@
+import datetime
 import random
 import time
 
+import pytest
+
 from app.system.device_controller import *
-from app.core.cache import CACHE
+from app.core.cache import CACHE, HISTORY_CACHE
+from app.core.history import HISTORY
 from app.core.tasks import TaskType
-from app.models import Task, HistoryItem
+from app.models import Task, HistoryItem, Sensor
+from app.serializers import DeviceSerializer
 
 
 def test_root(app_setup):
@@ -23,6 +28,103 @@ def test_get_devices(db_setup, app_setup, mocked_device):
         assert r.status_code == 200
 
 
+def test_get_devices_serialized(app_setup, mocked_device_with_sensor_and_control, task_factory):
+    """The listing (loaded as rows) is the same as the devices' own dictionaries."""
+    device, sensor, control = mocked_device_with_sensor_and_control
+    task_factory(device, TaskType.TOGGLE.value, control=control, meta={"step": 1})
+    with app_setup.test_client() as client:
+        r = client.get("/devices")
+    assert r.status_code == 200
+    listed = next(d for d in r.json if d['id'] == str(device.id))
+    assert listed == device.dictionary
+    task = next(t for t in listed['tasks'] if t['type'] == TaskType.TOGGLE.value)
+    assert task['control'] == listed['controls'][0] and task['meta'] == {"step": 1}
+    assert listed['sensors'][0]['type'] == type(sensor.last_value).__name__
+
+
+def test_get_devices_fields(app_setup, mocked_device_with_sensor_and_control):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    with app_setup.test_client() as client:
+        r = client.get("/devices?fields=id,name,is_online")
+        assert r.status_code == 200
+        assert {'id': str(device.id), 'name': device.name, 'is_online': device.is_online} in r.json
+
+        r = client.get("/devices?fields=id,sensors,controls&expand=controls")
+        listed = next(d for d in r.json if d['id'] == str(device.id))
+        assert listed['sensors'] == [str(sensor.id)]
+        assert listed['controls'] == [control.dictionary]
+
+
+@pytest.mark.parametrize("query", ["fields=id,nope", "expand=nope", "limit=0", "cursor=abc"])
+def test_get_devices_invalid(db_setup, app_setup, query):
+    with app_setup.test_client() as client:
+        assert client.get(f"/devices?{query}").status_code == 400
+
+
+def test_get_device_tasks_paged(app_setup, mocked_device_and_db, task_factory):
+    for _ in range(3):
+        task_factory(mocked_device_and_db, TaskType.STATUS.value)
+    ids = sorted(t.id for t in mocked_device_and_db.tasks)
+    url = f"/devices/{mocked_device_and_db.id}/tasks?fields=id,sensor&expand=&limit=2"
+    with app_setup.test_client() as client:
+        r = client.get(url)
+        assert r.json == [{'id': str(task_id), 'sensor': None} for task_id in ids[:2]]
+        cursor = r.headers['X-Next-Cursor']
+        assert cursor == str(ids[1])
+        r = client.get(f"{url}&cursor={ids[-2]}")
+        assert r.json == [{'id': str(ids[-1]), 'sensor': None}]
+        assert 'X-Next-Cursor' not in r.headers
+
+
+def test_get_devices_not_modified(app_setup, mocked_device_with_sensor_and_control,
+                                  monkeypatch):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    sensor.last_value = 20.5
+    db.session.commit()
+    with app_setup.test_client() as client:
+        r = client.get("/devices")
+        etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+        assert etag.startswith('W/')
+
+        monkeypatch.setattr(DeviceSerializer, 'dump_page', lambda *args, **kwargs: 1 / 0)
+        r = client.get("/devices", headers={'If-None-Match': etag})
+        assert r.status_code == 304 and not r.data  # not serialized
+        assert r.headers['ETag'] == etag
+        r = client.get("/devices", headers={'If-Modified-Since': last_modified})
+        assert r.status_code == 304
+
+        assert sensor.last_value == 20.5  # (loaded, i.e. same value is no change)
+        sensor.last_value = 20.5
+        db.session.commit()
+        assert client.get("/devices", headers={'If-None-Match': etag}).status_code == 304
+        r = client.get(f"/devices/{device.id}/sensors")
+        sensor_etag = r.headers['ETag']
+
+        sensor.last_value = 12.5
+        db.session.commit()
+        monkeypatch.undo()
+        assert client.get("/devices", headers={'If-None-Match': etag}).status_code == 200
+        r = client.get(f"/devices/{device.id}/sensors", headers={'If-None-Match': sensor_etag})
+        assert r.status_code == 200 and r.json[0]['last_value'] == 12.5
+        r = client.get(f"/devices/{device.id}/controls", headers={'If-None-Match': sensor_etag})
+        assert r.status_code == 200
+
+
+def test_get_device_not_modified_owner_state(app_setup, mocked_device, mocked_device_and_db):
+    """The owner's device state isn't in the db, but in the ETag."""
+    with app_setup.test_client() as client:
+        etag = client.get(f"/devices/{mocked_device_and_db.id}").headers['ETag']
+        r = client.get(f"/devices/{mocked_device_and_db.id}", headers={'If-None-Match': etag})
+        assert r.status_code == 304
+        CACHE.set_initializing([mocked_device_and_db.id])
+        try:
+            r = client.get(f"/devices/{mocked_device_and_db.id}",
+                           headers={'If-None-Match': etag})
+        finally:
+            CACHE.set_initialized()
+        assert r.status_code == 200 and r.json['initializing']
+
+
 def test_post_task(app_setup, mocked_device, mocked_device_and_db):
     """Test that posting a new task starts up the scheduler."""
     CACHE.add_active_device(mocked_device)
@@ -81,7 +183,7 @@ def test_get_sensor_history(app_setup, mocked_device_with_sensor_and_control):
     for _ in range(100):
         val = random.randint(0, 100)
         db.session.add(
-            HistoryItem(sensor=sensor, _value=val, timestamp=datetime.datetime.utcnow()))
+            HistoryItem(sensor=sensor, value=val, timestamp=datetime.datetime.utcnow()))
     db.session.commit()
 
     url = f"/devices/{device.id}/sensors/{sensor.id}/history"
@@ -90,3 +192,92 @@ def test_get_sensor_history(app_setup, mocked_device_with_sensor_and_control):
     assert response.status_code == 200
     assert type(response.json) is list
     assert len(response.json) == 100
+
+
+@pytest.mark.parametrize("query, expected_count", [
+    ("points=10", 10),
+    ("bucket=3600", 2),
+    ("points=10&until=0", 0),
+])
+def test_get_sensor_history_downsampled(app_setup, mocked_device_with_sensor_and_control,
+                                        query, expected_count):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    start = datetime.datetime(2021, 1, 1)
+    for i in range(100):
+        HISTORY.append([(sensor.id, i)], timestamp=start + datetime.timedelta(minutes=i))
+    db.session.commit()
+
+    url = f"/devices/{device.id}/sensors/{sensor.id}/history?{query}"
+    with app_setup.test_client() as client:
+        response = client.get(url)
+    assert response.status_code == 200
+    assert len(response.json) == expected_count
+    assert all(item['min'] <= item['avg'] <= item['max'] for item in response.json)
+
+
+@pytest.mark.parametrize("query", ["points=0", "bucket=abc", "since=abc"])
+def test_get_sensor_history_invalid(app_setup, mocked_device_with_sensor_and_control, query):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    url = f"/devices/{device.id}/sensors/{sensor.id}/history?{query}"
+    with app_setup.test_client() as client:
+        assert client.get(url).status_code == 400
+
+
+@pytest.mark.parametrize("query, expected_deleted", [
+    ("", 10),
+    ("since=1609462800000", 9),  # 2021-01-01 01:00
+    ("since=1609462800000&until=1609470000000", 3),  # 01:00 - 03:00
+])
+def test_clear_sensor_history(app_setup, mocked_device_with_sensor_and_control,
+                              query, expected_deleted):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    start = datetime.datetime(2021, 1, 1)
+    for i in range(10):
+        HISTORY.append([(sensor.id, i)], timestamp=start + datetime.timedelta(hours=i))
+    db.session.commit()
+
+    url = f"/devices/{device.id}/sensors/{sensor.id}/history?{query}"
+    with app_setup.test_client() as client:
+        response = client.delete(url)
+    assert response.status_code == 200
+    assert f"{expected_deleted} items deleted" in response.get_data(as_text=True)
+    assert len(HISTORY.get_range(sensor.id)) == 10 - expected_deleted
+
+
+def test_sensor_history_cache(app_setup, mocked_device, mocked_device_with_sensor_and_control):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    sensor.last_value = 1
+    db.session.commit()
+    Controller(mocked_device).log_sensors()
+
+    url = f"/devices/{device.id}/sensors/{sensor.id}/history?since=1000"
+    with app_setup.test_client() as client:
+        assert len(client.get(url).json) == 1
+        hits = HISTORY_CACHE.stats['hits']
+        assert len(client.get(url.replace('1000', '1500')).json) == 1  # same minute
+        assert HISTORY_CACHE.stats['hits'] == hits + 1
+
+        Controller(mocked_device).log_sensors()  # invalidates
+        assert len(client.get(url).json) == 2
+        assert 'history cache' in client.get('/').json
+
+
+def test_sensor_history_cache_other_process(app_setup, mocked_device,
+                                            mocked_device_with_sensor_and_control):
+    device, sensor, control = mocked_device_with_sensor_and_control
+    sensor.last_value = 1
+    db.session.commit()
+    Controller(mocked_device).log_sensors()
+
+    url = f"/devices/{device.id}/sensors/{sensor.id}/history?since=1000"
+    with app_setup.test_client() as client:
+        assert len(client.get(url).json) == 1
+
+        # another worker logged a value: its HISTORY_CACHE was invalidated, not ours
+        db.session.execute(
+            Sensor.__table__.update().where(Sensor.id == sensor.id)
+            .values(history_version=Sensor.history_version + 1))
+        db.session.execute(HistoryItem.__table__.insert().values(
+            sensor_id=sensor.id, value=2.0, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+        assert len(client.get(url).json) == 2
@@ -1,13 +1,24 @@
+import threading
 import time
+import uuid
+from datetime import datetime, timedelta
 
 import pytest
 
 from app import db
 from app.core.cache import CACHE
+from app.core.cron import get_phase
 from app.system.device_mapper import DeviceMapper
-from app.models import Task
-from app.core.scheduler import Scheduler
-from app.core.tasks import TaskType
+from app.models import Device, Task
+from app.core.scheduler import Scheduler, ENGINE
+from app.core.tasks import TaskType, ScheduledTask
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
 
 
 @pytest.fixture()
@@ -53,11 +64,201 @@ def test_get_tasks_from_db_and_edit(mocked_device, mocked_device_with_sensor_and
     # todo
 
 
-def test_terminate(test_config, mocked_device, mocked_device_and_db):
+def test_terminate(mocked_device, mocked_device_and_db, status_task):
     CACHE.add_active_device(mocked_device)
     scheduler = Scheduler(mocked_device)
     scheduler.start()
     assert scheduler.is_running
+    _wait_for(lambda: ENGINE.task_count(mocked_device.uuid) == 1)
     scheduler.terminate()
-    time.sleep(test_config.IDLE_INTERVAL_SECONDS + 0.2)
     assert not scheduler.is_running
+    assert ENGINE.task_count(mocked_device.uuid) == 0  # unregistered
+    assert ENGINE.wait_idle(timeout=5)
+
+
+def test_next_scheduled_task(mocked_device_and_db, status_task):
+    task = ScheduledTask.from_db_object(status_task)
+    next_task = task.next()
+    assert next_task.task_id == task.task_id
+    assert next_task.scheduled_time > task.scheduled_time
+
+
+@pytest.mark.parametrize("start,expected", [
+    (datetime(2021, 1, 1, 10, 59, 55), datetime(2021, 1, 1, 11, 0, 0)),
+    (datetime(2021, 1, 1, 23, 59, 50), datetime(2021, 1, 2, 0, 0, 0)),
+    (datetime(2021, 1, 1, 10, 0, 1, 500), datetime(2021, 1, 1, 10, 0, 10)),
+], ids=["hour", "day", "micro"])
+def test_interval_next_time_wraparound(start, expected):
+    assert ScheduledTask.get_next_time('every:10s', start) == expected
+
+
+def test_status_next_time(test_config):
+    start = datetime(2021, 1, 1, 10, 0, 0)
+    interval = test_config.STATUS_INTERVAL_SECONDS
+    assert ScheduledTask.get_next_time('status', start) == start + timedelta(seconds=interval)
+
+
+def test_status_phase_spread(test_config):
+    """Devices' status tasks don't all fire at the same instant."""
+    start = datetime(2021, 1, 1, 10, 0, 0)
+    times = {ScheduledTask.get_next_time('status', start, phase=get_phase(uuid.uuid4()))
+             for _ in range(100)}
+    assert len(times) > 90
+    assert all(start < t <= start + timedelta(seconds=test_config.STATUS_INTERVAL_SECONDS)
+               for t in times)
+
+
+def test_engine_executes_tasks(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    status_task.cron = 'every:1s'
+    db.session.commit()
+    task_id = status_task.id
+    scheduler = Scheduler(mocked_device)
+    scheduler.start()
+    assert ENGINE.is_running
+    _wait_for(lambda: db.session.query(Task.last_run).filter_by(id=task_id).scalar())
+    scheduler.terminate()
+
+
+def test_engine_notify(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    scheduler = Scheduler(mocked_device)
+    scheduler.start()
+    _wait_for(lambda: ENGINE.task_count(mocked_device.uuid) == 1)
+
+    task = db.session.query(Task).filter_by(id=status_task.id).first()
+    task.paused = True
+    db.session.commit()
+    scheduler.reload()
+    _wait_for(lambda: ENGINE.task_count(mocked_device.uuid) == 0)
+    scheduler.terminate()
+    assert ENGINE.task_count(mocked_device.uuid) == 0
+
+
+def _runnables(scheduler):
+    return {task.task_id: task.runnable for task in scheduler.get_tasks_from_db()}
+
+
+def test_schedule_cache_reused(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    scheduler = Scheduler(mocked_device)
+    assert _runnables(scheduler) == _runnables(scheduler)
+
+    Task.set_success(status_task.id)  # not a schedule change
+    assert _runnables(scheduler)[status_task.id] is _runnables(scheduler)[status_task.id]
+
+
+def test_schedule_cache_invalidated(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    other = Task(device=mocked_device_and_db, type=TaskType.STATUS.value)
+    db.session.add(other)
+    db.session.commit()
+    other_id = other.id
+
+    scheduler = Scheduler(mocked_device)
+    before = _runnables(scheduler)
+    assert len(before) == 2
+
+    task = db.session.query(Task).filter_by(id=status_task.id).first()
+    task.cron = 'status'
+    db.session.commit()
+
+    after = {t.task_id: t for t in scheduler.get_tasks_from_db()}
+    assert after[task.id].cron == 'status'
+    assert after[task.id].runnable is not before[task.id]
+    assert after[other_id].runnable is before[other_id]
+
+    db.session.delete(db.session.query(Task).filter_by(id=other_id).first())
+    db.session.commit()
+    assert set(_runnables(scheduler)) == {task.id}
+
+
+def test_engine_health_checks_do_not_overlap(monkeypatch, test_config, mocked_device,
+                                             mocked_device_and_db):
+    CACHE.add_active_device(mocked_device)
+    scheduler = Scheduler(mocked_device)
+    running, overlaps, calls = [], [], []
+    release = threading.Event()
+
+    def slow_health_check():
+        calls.append(1)
+        if running:
+            overlaps.append(1)
+        running.append(1)
+        release.wait(timeout=5)
+        running.pop()
+
+    scheduler.health_check = slow_health_check
+    ENGINE.start(max_workers=test_config.MAX_WORKERS,
+                 health_check_interval=test_config.IDLE_INTERVAL_SECONDS)
+    monkeypatch.setattr(ENGINE, 'health_check_interval', timedelta(seconds=0.01))
+    scheduler.start()
+    _wait_for(lambda: calls)
+    assert not ENGINE.wait_idle(timeout=0.2)  # the first check still runs...
+    assert len(calls) == 1  # ...and the next one is queued once it finishes
+    release.set()
+    _wait_for(lambda: len(calls) >= 3)
+    scheduler.terminate()
+
+    assert not overlaps
+    assert ENGINE.max_workers >= ENGINE.MIN_WORKERS
+
+
+def test_tasks_changed_by_another_process(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    task_id = status_task.id
+    scheduler = Scheduler(mocked_device)
+    scheduler.start()
+    _wait_for(lambda: ENGINE.task_count(mocked_device.uuid) == 1)
+
+    # no ORM events, as if committed by a different process
+    db.session.execute("UPDATE task SET paused = 1, schedule_modified = :now WHERE id = :id",
+                       {'now': datetime.utcnow(), 'id': task_id})
+    db.session.commit()
+    scheduler.health_check()
+    _wait_for(lambda: ENGINE.task_count(mocked_device.uuid) == 0)
+    scheduler.terminate()
+
+
+def test_health_check_circuit_open(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    scheduler = Scheduler(mocked_device)
+    checks = []
+    mocked_device._is_responding = lambda: checks.append(1) or False
+    mocked_device.breaker.record_failure()
+    mocked_device.breaker.record_failure()
+    mocked_device.breaker.record_failure()  # open
+
+    for _ in range(scheduler.RECONNECT_ATTEMPTS + 1):
+        scheduler.health_check()
+    assert not checks  # the device is left alone
+    assert not scheduler.is_online
+    assert not db.session.query(Device).get(mocked_device_and_db.id).scheduler_error  # not given up
+
+
+def test_schedule_version(mocked_device_and_db, status_task):
+    before = Task.schedule_version(mocked_device_and_db.id)
+    stamp = db.session.query(Task.time_modified).filter_by(id=status_task.id).scalar()
+    Task.set_success(status_task.id)
+    assert Task.schedule_version(mocked_device_and_db.id) == before
+    # any change (as on the other models), not just the schedule
+    assert db.session.query(Task.time_modified).filter_by(id=status_task.id).scalar() > stamp
+
+    task = db.session.query(Task).filter_by(id=status_task.id).first()
+    task.paused = True
+    db.session.commit()
+    assert Task.schedule_version(mocked_device_and_db.id) != before
+
+
+def test_invalid_task_skipped(mocked_device, mocked_device_and_db, status_task):
+    CACHE.add_active_device(mocked_device)
+    invalid = Task(device=mocked_device_and_db, type=TaskType.HISTORY_CLEANUP.value,
+                   cron='not a cron')
+    db.session.add(invalid)
+    db.session.commit()
+    invalid_id, status_id = invalid.id, status_task.id
+
+    scheduler = Scheduler(mocked_device)
+    assert {t.task_id for t in scheduler.get_tasks_from_db()} == {status_id}
+    task = db.session.query(Task).filter_by(id=invalid_id).first()
+    assert task.last_run_error and not task.last_run_success
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from app import db
+from app.core.cache import CACHE
+from app.models import Device
+from app.system.device_controller import Controller, DeviceNotOwnedError
+from app.system.startup import StartupSupervisor, start_devices
+
+
+@pytest.fixture
+def not_owner():
+    CACHE.set_owner(False, 4321)
+    yield
+    CACHE.set_owner(True)
+
+
+def test_supervisor(mocked_device, mocked_device_and_db, tmp_path):
+    CACHE.remove_active_device(mocked_device)
+    supervisor = StartupSupervisor()
+    assert supervisor.start(lock_path=str(tmp_path / 'devices.lock'))
+    assert supervisor.wait(timeout=10)
+
+    assert list(supervisor.report.reachable) == [mocked_device_and_db.id]
+    assert CACHE.get_active_device(mocked_device_and_db)
+    assert not db.session.query(Device).get(mocked_device_and_db.id).dictionary['initializing']
+
+
+def test_supervisor_single_owner(db_setup, tmp_path):
+    lock_path = str(tmp_path / 'devices.lock')
+    owner, other = StartupSupervisor(), StartupSupervisor()
+    assert owner.acquire(lock_path)
+    assert not other.start(lock_path=lock_path)
+    assert not other.is_owner
+    assert not CACHE.is_owner
+    assert CACHE.owner_pid == os.getpid()  # the lock file tells
+    CACHE.set_owner(True)
+
+
+def test_initializing_state(mocked_device_and_db):
+    CACHE.set_initializing([mocked_device_and_db.id])
+    assert mocked_device_and_db.dictionary['initializing']
+    CACHE.set_initialized(mocked_device_and_db.id)
+    assert not mocked_device_and_db.dictionary['initializing']
+
+
+def test_start_devices_modes(db_setup):
+    start_devices({'STARTUP_REFRESH': 'off'})
+    with pytest.raises(ValueError):
+        start_devices({'STARTUP_REFRESH': 'later'})
+
+
+def test_not_owner(app_setup, mocked_device_with_sensor_and_control, not_owner):
+    device, _, control = mocked_device_with_sensor_and_control
+    d = device.dictionary
+    assert not d['owned']
+    assert d['initializing'] is None and d['scheduler_running'] is None
+    with pytest.raises(DeviceNotOwnedError):
+        Controller(device)
+
+    with app_setup.test_client() as client:
+        assert client.get('/').json['devices owner pid'] == 4321
+        r = client.post(f'/devices/{device.id}/action', json={'control': control.name})
+        assert r.status_code == 503
+        assert 'pid 4321' in r.get_data(as_text=True)